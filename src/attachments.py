@@ -0,0 +1,152 @@
+import base64
+import hashlib
+import io
+import os
+from os import path
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+REF_PREFIX = "attachment://"
+
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"ID3", "audio/mpeg"),
+    (b"\xff\xfb", "audio/mpeg"),
+    (b"\xff\xf3", "audio/mpeg"),
+    (b"OggS", "audio/ogg"),
+    (b"fLaC", "audio/flac"),
+]
+
+def detect_mime(data: bytes, name: str=None):
+    # Magic bytes first, then the file extension
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "audio/wav"
+    for signature, mime in SIGNATURES:
+        if data.startswith(signature):
+            return mime
+    if name:
+        import mimetypes
+        mime = mimetypes.guess_type(name)[0]
+        if mime:
+            return mime
+    return "application/octet-stream"
+
+def is_ref(url):
+    return isinstance(url, str) and url.startswith(REF_PREFIX)
+
+class AttachmentStore():
+    """
+    Content-addressed store for images and audio.
+    Files are saved once under their sha256, messages only hold "attachment://<sha256>"
+    references that expand() turns into data URLs when a request is built.
+    :param max_side: downscale larger images to this many pixels on the long side (needs Pillow).
+    :param keep_turns: attachments older than this many user turns are replaced by a
+        short text placeholder in requests. None keeps them all.
+    """
+    def __init__(
+        self,
+        directory: str="~/Rovoam/attachments",
+        max_side: int=None,
+        keep_turns: int=None
+        ):
+        self.directory = path.expanduser(directory)
+        self.max_side = max_side
+        self.keep_turns = keep_turns
+        os.makedirs(self.directory, exist_ok=True)
+
+    def add_file(self, file: str):
+        with open(path.expanduser(file), "rb") as f:
+            data = f.read()
+        return self.add_bytes(data, detect_mime(data, file))
+
+    def add_bytes(self, data: bytes, mime: str=None):
+        # Returns the reference URL
+        mime = mime or detect_mime(data)
+        if mime.startswith("image/"):
+            data, mime = self.downscale(data, mime)
+        digest = hashlib.sha256(data).hexdigest()
+        file = self.file(digest)
+        if not path.exists(file):
+            with open(file + ".mime", "w") as f:
+                f.write(mime)
+            tmp = file + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, file)
+        return REF_PREFIX + digest
+
+    def add_data_url(self, url: str):
+        # data:<mime>;base64,<data>
+        header, _, b64 = url.partition(",")
+        mime = header[len("data:"):].split(";")[0] or None
+        return self.add_bytes(base64.b64decode(b64), mime)
+
+    def downscale(self, data: bytes, mime: str):
+        if Image is None or not self.max_side or mime == "image/gif":
+            return data, mime
+        # Images PIL can't read (SVG, HEIC, truncated files) are kept as they are
+        try:
+            image = Image.open(io.BytesIO(data))
+            if max(image.size) <= self.max_side:
+                return data, mime
+            image.thumbnail((self.max_side, self.max_side))
+            out = io.BytesIO()
+            if mime == "image/png" or image.mode in ("RGBA", "LA", "P"):
+                image.save(out, format="PNG", optimize=True)
+                return out.getvalue(), "image/png"
+            image.convert("RGB").save(out, format="JPEG", quality=85)
+            return out.getvalue(), "image/jpeg"
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return data, mime
+
+    def file(self, digest: str):
+        return path.join(self.directory, digest)
+
+    def mime(self, ref: str):
+        with open(self.file(ref[len(REF_PREFIX):]) + ".mime") as f:
+            return f.read()
+
+    def base64(self, ref: str):
+        with open(self.file(ref[len(REF_PREFIX):]), "rb") as f:
+            return base64.b64encode(f.read()).decode("utf-8")
+
+    def data_url(self, ref: str):
+        return f"data:{self.mime(ref)};base64,{self.base64(ref)}"
+
+    def expand_block(self, block: dict, stale: bool):
+        if block.get("type") == "image_url" and is_ref(block["image_url"].get("url")):
+            ref = block["image_url"]["url"]
+            if stale:
+                return {"type": "text", "text": f"[image {ref[len(REF_PREFIX):][:8]} omitted]"}
+            return {**block, "image_url": {**block["image_url"], "url": self.data_url(ref)}}
+        if block.get("type") == "input_audio" and is_ref(block["input_audio"].get("data")):
+            ref = block["input_audio"]["data"]
+            if stale:
+                return {"type": "text", "text": f"[audio {ref[len(REF_PREFIX):][:8]} omitted]"}
+            return {**block, "input_audio": {**block["input_audio"], "data": self.base64(ref)}}
+        return block
+
+    def expand(self, messages: list):
+        """Copy of messages with references replaced by the data, ready to be sent."""
+        result = []
+        turns = 0
+        # Walk from the end to know how many user turns came after each message
+        for message in reversed(messages):
+            content = message.get("content")
+            if isinstance(content, list):
+                stale = self.keep_turns is not None and turns > self.keep_turns
+                message = {**message, "content": [self.expand_block(block, stale) for block in content]}
+            elif message["role"] == "user":
+                turns += 1
+            result.append(message)
+        result.reverse()
+        return result
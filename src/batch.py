@@ -0,0 +1,191 @@
+"""
+Non-interactive batch runs over JSONL prompts.
+
+python batch.py prompts.jsonl -o results.jsonl -j 8
+cat prompts.jsonl | python batch.py - -o results.jsonl --allow search --allow calc
+
+Every input line is {"id": ..., "prompt": "..."} (id defaults to the line number) or
+just a JSON string. Results are appended to the output as they complete:
+{"id", "result", "error", "seconds"}. The output is the checkpoint: started again with
+the same output file, the run skips ids that already have a result (errors are retried).
+Tools are confirmed by a static policy: --allow name, --allow-all, everything else is refused.
+A summary with throughput and latency percentiles goes to stderr at the end.
+"""
+import argparse
+import importlib
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from confirmation import static_policy
+
+def read_items(lines):
+    # Yields (id, prompt), skipping empty lines
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        item = json.loads(line)
+        if isinstance(item, str):
+            yield str(number), item
+        else:
+            yield str(item.get("id", number)), item.get("prompt", item.get("message"))
+
+def finished_ids(file: str):
+    done = set()
+    if not path.exists(file):
+        return done
+    with open(file, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn last line of a crashed run
+                continue
+            if record.get("error") is None:
+                done.add(str(record["id"]))
+    return done
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+
+def load_factory(spec: str):
+    # "module:function"
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+class BatchRunner():
+    """
+    Runs prompts through agents made by factory() with at most jobs at a time.
+    :param fresh: a new agent for every prompt. Otherwise up to jobs agents are reused,
+        with reset() between prompts.
+    :param confirmation_handler: replaces the confirmation handler of every agent and its sub-agents.
+    """
+    def __init__(
+        self,
+        factory: callable,
+        jobs: int=4,
+        fresh: bool=False,
+        confirmation_handler: callable=None
+        ):
+        self.factory = factory
+        self.jobs = jobs
+        self.fresh = fresh
+        self.confirmation_handler = confirmation_handler or static_policy()
+        self.pool = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def agent(self):
+        if not self.fresh:
+            try:
+                agent = self.pool.get_nowait()
+                agent.reset()
+                return agent
+            except queue.Empty:
+                pass
+        agent = self.factory()
+        if hasattr(agent, "set_confirmation_handler"):
+            agent.set_confirmation_handler(self.confirmation_handler)
+        with self.lock:
+            self.created += 1
+        return agent
+
+    def run_one(self, id: str, prompt: str):
+        start = time.perf_counter()
+        agent = self.agent()
+        try:
+            result, error = agent(prompt), None
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        if not self.fresh:
+            self.pool.put(agent)
+        return {"id": id, "result": result, "error": error, "seconds": round(time.perf_counter() - start, 4)}
+
+    def run(self, items, output, skip: set=None):
+        """
+        items: iterable of (id, prompt), read lazily. output: file object, one JSON line per result.
+        Returns the summary.
+        """
+        skip = skip or set()
+        latencies = []
+        counts = {"done": 0, "errors": 0, "skipped": 0}
+        write_lock = threading.Lock()
+        # Bounds the prompts read ahead of the workers
+        slots = threading.BoundedSemaphore(self.jobs * 2)
+        start = time.perf_counter()
+
+        def finished(future):
+            try:
+                record = future.result()
+                line = json.dumps(record, ensure_ascii=False, default=str)
+                with write_lock:
+                    output.write(line + "\n")
+                    output.flush()
+                    counts["done"] += 1
+                    if record["error"] is not None:
+                        counts["errors"] += 1
+                    latencies.append(record["seconds"])
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for id, prompt in items:
+                if id in skip:
+                    counts["skipped"] += 1
+                    continue
+                slots.acquire()
+                pool.submit(self.run_one, id, prompt).add_done_callback(finished)
+
+        wall_time = time.perf_counter() - start
+        return {
+            **counts,
+            "agents": self.created,
+            "wall_time": round(wall_time, 4),
+            "per_second": round(counts["done"] / wall_time, 4) if wall_time else None,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "max": percentile(latencies, 1.0),
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run Rovoam over a JSONL file of prompts")
+    parser.add_argument("input", help="JSONL file, - for stdin")
+    parser.add_argument("-o", "--output", help="results JSONL, also the checkpoint to resume from (stdout if not given)")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="prompts processed at the same time")
+    parser.add_argument("--fresh", action="store_true", help="a new agent for every prompt instead of reusing them")
+    parser.add_argument("--factory", default="network:build_supervisor", help="module:function that builds an agent")
+    parser.add_argument("--allow", action="append", default=[], help="tool that is confirmed without asking, may repeat")
+    parser.add_argument("--allow-all", action="store_true", help="confirm every tool")
+    parser.add_argument("--restart", action="store_true", help="ignore results already in the output")
+    args = parser.parse_args()
+
+    def log(toolname, description, allowed):
+        if not allowed:
+            print(f"Refused {toolname}: {description}", file=sys.stderr)
+
+    runner = BatchRunner(
+        load_factory(args.factory),
+        jobs=args.jobs,
+        fresh=args.fresh,
+        confirmation_handler=static_policy(args.allow, args.allow_all, log)
+    )
+    skip = set()
+    if args.output and not args.restart:
+        skip = finished_ids(args.output)
+    source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    output = open(args.output, "w" if args.restart else "a", encoding="utf-8") if args.output else sys.stdout
+    try:
+        summary = runner.run(read_items(source), output, skip)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    print(json.dumps(summary), file=sys.stderr)
@@ -0,0 +1,304 @@
+"""
+Offline benchmarks for Agent, Chat and Classifier against mockserver.MockServer.
+
+python benchmark.py                        # all scenarios, JSON to stdout
+python benchmark.py -o bench.json          # save results
+python benchmark.py --compare old.json     # print the difference with an earlier run
+python benchmark.py --only react_tools images --latency 0.05 --tps 200
+python benchmark.py --only --startup-budget 0.05   # only check how fast main.py starts
+python benchmark.py --only --sessions 10000        # memory of 10k idle sessions
+
+For every scenario it reports wall time, LLM round trips, bytes sent and received
+by the client, estimated prompt/completion tokens and peak Python memory.
+"startup" is the time "import main" adds to an empty interpreter and the heavy
+modules that get imported with it (they should only be loaded on first use).
+"idle_sessions" is the memory held by that many agents between requests (as in
+server.py), with compact messages and with the old layout of a dict per message
+and a copy of the ReAct prompt per agent.
+"""
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from os import path
+from openai import OpenAI
+from mockserver import MockServer
+from rovoam import Agent, Chat, Classifier, GetReActPrompt
+from messages import compact
+from history import HistoryManager
+from attachments import AttachmentStore
+from client import get_client
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 200
+
+def allow(toolname, description):
+    return True
+
+def lookup(key: str):
+    """
+    lookup.
+    Returns the value stored under key
+    key: name of the value
+    """
+    return f"value of {key}"
+
+def scenario_answer(server, client):
+    server.script("answer", ["Thought: I know this\nAnswer: Hello!"])
+    agent = Agent(client=client, model="answer")
+    agent("Hi")
+
+def scenario_react_tools(server, client):
+    server.script("react_tools", [
+        'Thought: first\nAction: {"tool": "lookup", "key": "a"}\nPAUSE',
+        'Thought: second\nAction: {"tool": "lookup", "key": "b"}\nPAUSE',
+        'Thought: third\nAction: {"tool": "lookup", "key": "c"}\nPAUSE',
+        "Answer: a, b and c",
+    ])
+    agent = Agent(client=client, model="react_tools", tools=[lookup], confirmation_handler=allow)
+    agent("Get a, b and c")
+
+def scenario_parallel_actions(server, client):
+    server.script("parallel_actions", [
+        'Thought: all at once\n'
+        'Action: {"tool": "lookup", "key": "a"}\n'
+        'Action: {"tool": "lookup", "key": "b"}\n'
+        'Action: {"tool": "lookup", "key": "c"}\nPAUSE',
+        "Answer: a, b and c",
+    ])
+    agent = Agent(client=client, model="parallel_actions", tools=[lookup], confirmation_handler=allow)
+    agent("Get a, b and c")
+
+def scenario_malformed_action(server, client):
+    server.script("malformed_action", [
+        'Action: {"tool": "lookup", "key": }\nPAUSE',
+        'Action: {"tool": "lookup", "key": "a"}\nPAUSE',
+        "Answer: a",
+    ])
+    agent = Agent(client=client, model="malformed_action", tools=[lookup], confirmation_handler=allow)
+    agent("Get a")
+
+def scenario_function_calling(server, client):
+    server.script("function_calling", [
+        {"tool_calls": [{"name": "lookup", "arguments": {"key": "a"}}, {"name": "lookup", "arguments": {"key": "b"}}]},
+        "a and b",
+    ])
+    agent = Agent(client=client, model="function_calling", tools=[lookup], confirmation_handler=allow, function_calling=True)
+    agent("Get a and b")
+
+def scenario_streaming_early_stop(server, client):
+    # The model keeps talking after PAUSE, the agent should stop reading
+    server.script("streaming_early_stop", [
+        'Thought: need a\nAction: {"tool": "lookup", "key": "a"}\nPAUSE\n' + "Observation: made up. " * 200,
+        "Answer: a",
+    ])
+    agent = Agent(client=client, model="streaming_early_stop", tools=[lookup], confirmation_handler=allow)
+    for event in agent.stream("Get a"):
+        pass
+
+def scenario_transient_errors(server, client):
+    # A 429 and a 503 in the middle of a ReAct loop are retried by the shared client
+    server.script("transient_errors", [
+        'Action: {"tool": "lookup", "key": "a"}\nPAUSE',
+        {"error": 429, "retry_after": 0},
+        {"error": 503},
+        "Answer: a",
+    ])
+    agent = Agent(client=get_client(server.url, "mock"), model="transient_errors", tools=[lookup], confirmation_handler=allow)
+    agent("Get a")
+
+def long_history(client, history):
+    chat = Chat(client=client, model="long_history", history=history)
+    for i in range(30):
+        chat(f"Question number {i}. " + "Some context. " * 20)
+
+def scenario_long_history(server, client):
+    server.script("long_history", ["A long answer. " * 100])
+    long_history(client, None)
+
+def scenario_long_history_compacted(server, client):
+    server.script("long_history", ["A long answer. " * 100])
+    long_history(client, HistoryManager(max_tokens=3000, keep_last=4))
+
+def images(client, attachments, directory):
+    file = f"{directory}/image.png"
+    with open(file, "wb") as f:
+        f.write(PNG)
+    agent = Agent(client=client, model="images", attachments=attachments)
+    for i in range(6):
+        agent.image_file(file)
+        agent(f"What is on image {i}?")
+
+def scenario_images(server, client):
+    server.script("images", ["Answer: a picture"])
+    directory = tempfile.mkdtemp()
+    try:
+        images(client, None, directory)
+    finally:
+        shutil.rmtree(directory)
+
+def scenario_images_store(server, client):
+    server.script("images", ["Answer: a picture"])
+    directory = tempfile.mkdtemp()
+    try:
+        images(client, AttachmentStore(directory + "/store", keep_turns=1), directory)
+    finally:
+        shutil.rmtree(directory)
+
+TEXTS = [f"text number {i % 25}" for i in range(50)]
+
+def classify_batch(messages):
+    numbered = messages[-1]["content"].splitlines()
+    return json.dumps({line.split(".", 1)[0]: "even" if int(line.rsplit(" ", 1)[1].strip('"')) % 2 == 0 else "odd" for line in numbered})
+
+def classify_one(messages):
+    return "even" if int(messages[-1]["content"].rsplit(" ", 1)[1]) % 2 == 0 else "odd"
+
+def scenario_classifier_single(server, client):
+    server.script("classifier", [classify_one])
+    classifier = Classifier(client=client, model="classifier", categories=["even", "odd"])
+    for text in TEXTS:
+        classifier(text)
+
+def scenario_classifier_batch(server, client):
+    server.script("classifier", [classify_batch])
+    classifier = Classifier(client=client, model="classifier", categories=["even", "odd"])
+    classifier.classify_many(TEXTS)
+
+SCENARIOS = {
+    name[len("scenario_"):]: function
+    for name, function in globals().items()
+    if name.startswith("scenario_")
+}
+
+def run(server, name):
+    client = OpenAI(api_key="mock", base_url=server.url, max_retries=0)
+    server.reset_stats()
+    tracemalloc.start()
+    start = time.perf_counter()
+    SCENARIOS[name](server, client)
+    wall_time = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    client.close()
+    stats = server.stats()
+    return {
+        "wall_time": round(wall_time, 4),
+        "round_trips": stats["requests"],
+        # Client point of view: what it sent and what it received
+        "bytes_sent": stats["bytes_received"],
+        "bytes_received": stats["bytes_sent"],
+        "prompt_tokens": stats["prompt_tokens"],
+        "completion_tokens": stats["completion_tokens"],
+        "peak_memory": peak,
+    }
+
+def idle_agents(count: int, compact_messages: bool):
+    # Bytes held by count agents after one turn with a tool call
+    tracemalloc.start()
+    agents = []
+    for i in range(count):
+        agent = Agent(client=None, model="idle", tools=[lookup], system="You are a helpful assistant.", confirmation_handler=allow)
+        agent.messages += [
+            {"role": "user", "content": f"Get the value of a{i}"},
+            {"role": "assistant", "content": f'Thought: I need a{i}\nAction: {{"tool": "lookup", "key": "a{i}"}}\nPAUSE'},
+            {"role": "system", "content": f"Observation: value of a{i}"},
+            {"role": "assistant", "content": f"Answer: value of a{i}"},
+            {"role": "assistant", "content": f"value of a{i}"},
+        ]
+        if compact_messages:
+            compact(agent.messages)
+        else:
+            agent.messages = [{"role": "system", "content": GetReActPrompt(agent.tools)}] + [dict(m) for m in agent.messages[1:]]
+        agents.append(agent)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return held
+
+def idle_sessions(count: int):
+    before = idle_agents(count, False)
+    after = idle_agents(count, True)
+    return {
+        "sessions": count,
+        "before": before,
+        "after": after,
+        "per_session_before": before // count,
+        "per_session_after": after // count,
+        "saved": round((before - after) / before * 100, 1),
+    }
+
+HEAVY_MODULES = ["openai", "rich", "prompt_toolkit"]
+
+def best_time(code: str, runs: int):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, cwd=path.dirname(path.abspath(__file__)))
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def startup(runs: int=5):
+    imported = subprocess.run(
+        [sys.executable, "-c", f"import sys, json, main; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"],
+        capture_output=True, text=True, check=True, cwd=path.dirname(path.abspath(__file__))
+    )
+    return {
+        "import_main": round(best_time("import main", runs) - best_time("pass", runs), 4),
+        "eager_modules": json.loads(imported.stdout),
+    }
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def compare(old: dict, new: dict):
+    lines = []
+    for name, result in new["scenarios"].items():
+        before = old.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        lines.append(name)
+        for metric, value in result.items():
+            was = before.get(metric)
+            if not was:
+                continue
+            lines.append(f"  {metric:18} {was:>14} -> {value:<14} {(value - was) / was * 100:+.1f}%")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rovoam offline benchmarks")
+    parser.add_argument("--only", nargs="*", choices=sorted(SCENARIOS), help="scenarios to run")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock time to first token, seconds")
+    parser.add_argument("--tps", type=float, default=None, help="mock tokens per second")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="earlier JSON results to compare with")
+    parser.add_argument("--sessions", type=int, default=0, help="measure memory of this many idle sessions")
+    parser.add_argument("--startup-budget", type=float, default=None,
+        help="fail if import main takes longer than this many seconds or loads heavy modules")
+    args = parser.parse_args()
+
+    results = {"commit": commit(), "latency": args.latency, "tps": args.tps, "startup": startup(), "scenarios": {}}
+    with MockServer(latency=args.latency, tokens_per_second=args.tps) as server:
+        for name in SCENARIOS if args.only is None else args.only:
+            results["scenarios"][name] = run(server, name)
+    if args.sessions:
+        results["idle_sessions"] = idle_sessions(args.sessions)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results), file=sys.stderr)
+    if args.startup_budget is not None:
+        if results["startup"]["import_main"] > args.startup_budget or results["startup"]["eager_modules"]:
+            print(f"Startup over budget ({args.startup_budget}s): {results['startup']}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+
+# Budget of the agent run that is calling a tool right now; nested agents take what is left of it
+current_budget = ContextVar("rovoam_current_budget", default=None)
+
+class Budget():
+    """
+    Limits of one Agent run: a wall-clock deadline and tokens of all its requests
+    (as reported by the endpoint, estimated when it doesn't report them).
+    The Agent keeps the Budget as a template and starts a fresh copy for every call.
+    Agent tools started during the run count against it too and stop when it runs out.
+    When less than reserve of any limit is left, the agent stops calling tools and asks
+    the model to answer with what it has.
+    :param seconds: deadline of the run.
+    :param prompt_tokens: limit on prompt tokens of all requests of the run.
+    :param completion_tokens: limit on completion tokens.
+    :param total_tokens: limit on both together.
+    :param reserve: share of each limit kept for the final answer.
+    """
+    def __init__(
+        self,
+        seconds: float=None,
+        prompt_tokens: int=None,
+        completion_tokens: int=None,
+        total_tokens: int=None,
+        reserve: float=0.1
+        ):
+        self.seconds = seconds
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.total_tokens = total_tokens
+        self.reserve = reserve
+        self.parent = None
+        self.started = None
+        self.used_prompt = 0
+        self.used_completion = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def start(self, parent=None):
+        """A running copy of this budget; usage is also counted in parent."""
+        running = Budget(self.seconds, self.prompt_tokens, self.completion_tokens, self.total_tokens, self.reserve)
+        running.parent = parent
+        running.started = time.monotonic()
+        return running
+
+    def chain(self):
+        budget = self
+        while budget is not None:
+            yield budget
+            budget = budget.parent
+
+    def add(self, prompt_tokens: int, completion_tokens: int):
+        for budget in self.chain():
+            with budget.lock:
+                budget.used_prompt += prompt_tokens
+                budget.used_completion += completion_tokens
+                budget.requests += 1
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        """Seconds left before the nearest deadline, None without one."""
+        left = [budget.seconds - budget.elapsed() for budget in self.chain() if budget.seconds is not None]
+        return max(0.0, min(left)) if left else None
+
+    def expired(self):
+        return self.remaining() == 0.0
+
+    def low(self):
+        """True when less than reserve of some limit is left."""
+        for budget in self.chain():
+            keep = 1 - budget.reserve
+            if budget.seconds is not None and budget.elapsed() >= budget.seconds * keep:
+                return True
+            for limit, used in (
+                (budget.prompt_tokens, budget.used_prompt),
+                (budget.completion_tokens, budget.used_completion),
+                (budget.total_tokens, budget.used_prompt + budget.used_completion)
+            ):
+                if limit is not None and used >= limit * keep:
+                    return True
+        return False
+
+    def report(self):
+        # What the run used, next to its own limits
+        return {
+            "seconds": round(self.elapsed(), 3),
+            "prompt_tokens": self.used_prompt,
+            "completion_tokens": self.used_completion,
+            "requests": self.requests,
+            "limits": {
+                name: value for name, value in (
+                    ("seconds", self.seconds),
+                    ("prompt_tokens", self.prompt_tokens),
+                    ("completion_tokens", self.completion_tokens),
+                    ("total_tokens", self.total_tokens)
+                ) if value is not None
+            },
+        }
+
+@contextmanager
+def activate(budget: Budget):
+    # For the tools called inside; None means the run has no budget
+    token = current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        current_budget.reset(token)
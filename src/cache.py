@@ -0,0 +1,111 @@
+import hashlib
+import json
+import threading
+import time
+from os import path
+
+class ResponseCache():
+    """
+    Persistent cache of chat completions in SQLite.
+    The key is a hash of the model, the messages and the sampling parameters.
+    Entries older than ttl seconds are ignored, the least recently used ones are evicted
+    above max_entries. Only deterministic requests are cached: temperature=0 or a seed
+    (without temperature the API samples at 1.0). Streams and n > 1 are never cached.
+    """
+    def __init__(
+        self,
+        file: str="~/Rovoam/cache.sqlite",
+        max_entries: int=10000,
+        ttl: float=None
+        ):
+        self.file = path.expanduser(file)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.lock = threading.Lock()
+        import sqlite3
+        self.db = sqlite3.connect(self.file, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.commit()
+
+    def key(self, kwargs: dict):
+        # The timeout of a request doesn't change its answer
+        kwargs = {name: value for name, value in kwargs.items() if name != "timeout"}
+        data = json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def cacheable(self, kwargs: dict):
+        if kwargs.get("stream") or (kwargs.get("n") or 1) > 1:
+            return False
+        return kwargs.get("temperature") == 0 or kwargs.get("seed") is not None
+
+    def get(self, kwargs: dict):
+        key = self.key(kwargs)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self.hits += 1
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.model_validate_json(row[0])
+
+    def put(self, kwargs: dict, response):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+                (self.key(kwargs), response.model_dump_json(), now, now)
+            )
+            if self.ttl is not None:
+                self.db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self.db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM responses")
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "bypassed": self.bypassed, "entries": entries}
+
+def cached_create(cache, create: callable, **kwargs):
+    # create is client.chat.completions.create; cache=False or None bypasses the cache
+    if not cache:
+        return create(**kwargs)
+    if not cache.cacheable(kwargs):
+        cache.bypassed += 1
+        return create(**kwargs)
+    response = cache.get(kwargs)
+    if response is None:
+        response = create(**kwargs)
+        cache.put(kwargs, response)
+    return response
+
+async def async_cached_create(cache, create: callable, **kwargs):
+    if not cache:
+        return await create(**kwargs)
+    if not cache.cacheable(kwargs):
+        cache.bypassed += 1
+        return await create(**kwargs)
+    response = cache.get(kwargs)
+    if response is None:
+        response = await create(**kwargs)
+        cache.put(kwargs, response)
+    return response
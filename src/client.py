@@ -1,4 +1,260 @@
-from openai import OpenAI
-from config import config
+"""
+Shared OpenAI clients for Agent, Chat and Classifier.
 
-client = OpenAI(api_key=config["api_key"], base_url=config["api_endpoint"])
+get_client() returns one client per endpoint and API key for the whole process, so every
+agent reuses the same HTTP connection pool. Calls are retried on connection errors,
+408/409/429 and 5xx with jittered exponential backoff, waiting at least as long as the
+server asks in Retry-After. A timeout passed to create() covers all attempts: no retry
+starts after it. With rpm and/or tpm set, a token bucket limits requests and tokens per
+minute across all agents using the endpoint: calls over the limit wait for their turn
+instead of failing.
+
+    client = get_client("https://api.example.com/v1", api_key="...", rpm=60, tpm=100000)
+    agent = Agent(client=client, model="...")
+"""
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from types import SimpleNamespace
+from config import get_config
+from history import message_tokens
+
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+def retryable(error):
+    import openai
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRY_STATUS
+
+def retry_after(error):
+    # Seconds the server asked to wait, None if it did not say
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if response.headers.get("retry-after-ms"):
+            return float(response.headers["retry-after-ms"]) / 1000
+        value = response.headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(kwargs: dict):
+    # Prompt plus the completion limit, corrected by the real usage afterwards
+    messages = kwargs.get("messages") or []
+    return sum(message_tokens(m) for m in messages) + (kwargs.get("max_tokens") or 0)
+
+class TokenBucket():
+    """per_minute units that refill continuously. The level may go below zero: that is the queue."""
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float):
+        # Takes amount and returns how long to wait before using it
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+class RateLimiter():
+    """Requests per minute and tokens per minute of one endpoint. None means no limit."""
+    def __init__(self, rpm: float=None, tpm: float=None):
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.limits = None
+        self.configure(rpm, tpm)
+
+    def configure(self, rpm: float=None, tpm: float=None):
+        # Same limits again keep the buckets: refilling them would let a burst through
+        with self.lock:
+            if self.limits == (rpm, tpm):
+                return
+            self.limits = (rpm, tpm)
+            self.requests = TokenBucket(rpm) if rpm else None
+            self.tokens = TokenBucket(tpm) if tpm else None
+
+    def reserve(self, tokens: int):
+        # Callers are served in the order they reserved
+        with self.lock:
+            delay = 0.0
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(tokens))
+            self.waited += delay
+            return delay
+
+    def correct(self, difference: int):
+        # difference = used - reserved
+        with self.lock:
+            if self.tokens is not None:
+                self.tokens.refund(-difference)
+
+class Completions():
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, **kwargs):
+        return self.client.create(**kwargs)
+
+class Client():
+    """
+    Wraps an OpenAI client: client.chat.completions.create() is limited and retried,
+    everything else (models, embeddings, ...) goes to the wrapped client as is.
+    """
+    def __init__(
+        self,
+        client: object,
+        limiter: RateLimiter=None,
+        max_retries: int=5,
+        backoff: float=0.5,
+        max_backoff: float=30.0
+        ):
+        self.client = client
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = 0
+        self.chat = SimpleNamespace(completions=Completions(self))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def delay(self, attempt: int, error):
+        # Full jitter, but never sooner than Retry-After
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        return max(delay, retry_after(error) or 0.0)
+
+    def reserve(self, kwargs):
+        if self.limiter is None:
+            return 0, 0.0
+        tokens = estimate_tokens(kwargs)
+        return tokens, self.limiter.reserve(tokens)
+
+    def settle(self, response, reserved: int):
+        usage = getattr(response, "usage", None)
+        if self.limiter is not None and usage is not None and usage.total_tokens is not None:
+            self.limiter.correct(usage.total_tokens - reserved)
+
+    def failed(self, attempt: int, error, reserved: int):
+        # Returns the delay before the next attempt, raises if there is none
+        if self.limiter is not None:
+            # A rejected request used no tokens
+            self.limiter.correct(-reserved)
+        if attempt >= self.max_retries or not retryable(error):
+            raise error
+        self.retries += 1
+        return self.delay(attempt, error)
+
+    def retry_timeout(self, deadline: float, delay: float, error):
+        # A timeout covers all attempts of a call: the next one gets what is left of it
+        left = deadline - time.monotonic() - delay
+        if left <= 0:
+            raise error
+        return left
+
+    def create(self, **kwargs):
+        deadline = time.monotonic() + kwargs["timeout"] if kwargs.get("timeout") else None
+        for attempt in range(self.max_retries + 1):
+            reserved, wait = self.reserve(kwargs)
+            if wait:
+                time.sleep(wait)
+            try:
+                response = self.client.chat.completions.create(**kwargs)
+            except Exception as e:
+                delay = self.failed(attempt, e, reserved)
+                if deadline is not None:
+                    kwargs["timeout"] = self.retry_timeout(deadline, delay, e)
+                time.sleep(delay)
+                continue
+            self.settle(response, reserved)
+            return response
+
+class AsyncClient(Client):
+    """Client for AsyncOpenAI, create() is a coroutine."""
+    async def create(self, **kwargs):
+        import asyncio
+        deadline = time.monotonic() + kwargs["timeout"] if kwargs.get("timeout") else None
+        for attempt in range(self.max_retries + 1):
+            reserved, wait = self.reserve(kwargs)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                response = await self.client.chat.completions.create(**kwargs)
+            except Exception as e:
+                delay = self.failed(attempt, e, reserved)
+                if deadline is not None:
+                    kwargs["timeout"] = self.retry_timeout(deadline, delay, e)
+                await asyncio.sleep(delay)
+                continue
+            self.settle(response, reserved)
+            return response
+
+_lock = threading.Lock()
+_openai = {}
+_clients = {}
+_limiters = {}
+
+def get_limiter(base_url: str, api_key: str=None):
+    with _lock:
+        return _limiters.setdefault((base_url, api_key), RateLimiter())
+
+def get_client(
+    base_url: str=None,
+    api_key: str=None,
+    rpm: float=None,
+    tpm: float=None,
+    max_retries: int=5,
+    timeout: float=120.0,
+    asynchronous: bool=False
+    ):
+    """
+    Shared client for base_url and api_key (taken from the config if not given).
+    rpm and tpm set the limits of the endpoint for everyone who uses it.
+    max_retries=0 leaves retries to the caller, as Router does.
+    asynchronous=True gives a client for AsyncAgent, AsyncChat and AsyncClassifier.
+    """
+    if base_url is None or api_key is None:
+        config = get_config()
+        base_url = base_url or config["api_endpoint"]
+        api_key = api_key or config["api_key"]
+    limiter = get_limiter(base_url, api_key)
+    if rpm or tpm:
+        limiter.configure(rpm, tpm)
+    key = (base_url, api_key, asynchronous)
+    with _lock:
+        if key not in _openai:
+            import openai
+            # The SDK's own retries are off, Client retries with the limiter in the loop.
+            # One HTTP client per endpoint keeps its connections alive between agents
+            if asynchronous:
+                http = openai.DefaultAsyncHttpxClient(timeout=timeout)
+                _openai[key] = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http)
+            else:
+                http = openai.DefaultHttpxClient(timeout=timeout)
+                _openai[key] = openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http)
+        # Clients with other retries (a Router retries on the next endpoint) share the connections
+        if key + (max_retries,) not in _clients:
+            _clients[key + (max_retries,)] = (AsyncClient if asynchronous else Client)(_openai[key], limiter, max_retries)
+        return _clients[key + (max_retries,)]
+
+def __getattr__(name):
+    # from client import client: the shared client of the configured endpoint
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module 'client' has no attribute '{name}'")
@@ -1,17 +1,30 @@
 from json import load, dump
 from os import path
 
-try:
-    with open(path.expanduser("~/Rovoam/conf.json"), "r") as f:
-        config = load(f)
-except FileNotFoundError:
-    config = {
-        "first_run": "yes",
-        "api_key": None,
-        "api_endpoint": None,
-        "auto_confirm": []
-    }
-    with open(path.expanduser("~/Rovoam/conf.json"), "w") as f:
-        dump(config, f)
-    print("Default config created. Edit it (add API key) and try again.")
-    exit(0)
+_config = None
+
+def get_config():
+    # Read on first use, so importing this module has no side effects
+    global _config
+    if _config is None:
+        try:
+            with open(path.expanduser("~/Rovoam/conf.json"), "r") as f:
+                _config = load(f)
+        except FileNotFoundError:
+            _config = {
+                "first_run": "yes",
+                "api_key": None,
+                "api_endpoint": None,
+                "auto_confirm": []
+            }
+            with open(path.expanduser("~/Rovoam/conf.json"), "w") as f:
+                dump(_config, f)
+            print("Default config created. Edit it (add API key) and try again.")
+            exit(0)
+    return _config
+
+def __getattr__(name):
+    # from config import config
+    if name == "config":
+        return get_config()
+    raise AttributeError(f"module 'config' has no attribute '{name}'")
@@ -1,17 +1,228 @@
-from rich.console import Console
-from rich.panel import Panel
-from rich.prompt import Prompt
-from config import config
-
-console = Console()
+from collections import deque
+from fnmatch import fnmatchcase
+from os import path
+import json
+import re
+import threading
+import time
+from config import get_config
 
 def confirmation_handler(toolname, description):
     table = {
         "y": True,
         "n": False
     }
-    if toolname in config["auto_confirm"]:
+    if toolname in get_config()["auto_confirm"]:
         return True
+    from rich.console import Console
+    from rich.panel import Panel
+    from rich.prompt import Prompt
+    console = Console()
     console.print(Panel(f"Tool: {toolname}\nFull call: {description}", border_style="blue", title="Confirmation"))
     inp = Prompt.ask("Confirmation", default="Y", choices=["Y", "n"], case_sensitive=False).lower()
     return table[inp]
+
+def static_policy(allow: list=None, allow_all: bool=False, log: callable=None):
+    """
+    Non-interactive confirmation for batch runs and the server: tools in allow
+    (or every tool with allow_all) are confirmed, the rest are refused.
+    log(toolname, description, allowed) is called for every decision.
+    """
+    allow = set(allow or [])
+    def handler(toolname, description):
+        allowed = allow_all or toolname in allow
+        if log is not None:
+            log(toolname, description, allowed)
+        return allowed
+    return handler
+
+class Rule():
+    """
+    action ("allow", "deny" or "ask") for calls of tools matching the glob tool
+    whose arguments match every regular expression in args: {"path": r"^/tmp/"}.
+    """
+    def __init__(self, action: str, tool: str="*", args: dict=None):
+        if action not in ("allow", "deny", "ask"):
+            raise ValueError(f"Unknown action {action!r}, use allow, deny or ask")
+        self.action = action
+        self.tool = tool
+        self.args = {name: re.compile(pattern) for name, pattern in (args or {}).items()}
+
+    def matches(self, toolname: str, kwargs: dict):
+        if not fnmatchcase(toolname, self.tool):
+            return False
+        return all(name in kwargs and pattern.search(str(kwargs[name])) for name, pattern in self.args.items())
+
+    def __repr__(self):
+        args = "".join(f" {name}~{pattern.pattern}" for name, pattern in self.args.items())
+        return f"{self.action} {self.tool}{args}"
+
+def parse_args(description: str):
+    # Agent passes the arguments of the call as JSON
+    try:
+        kwargs = json.loads(description)
+    except (TypeError, ValueError):
+        return {}
+    return kwargs if isinstance(kwargs, dict) else {}
+
+class Policy():
+    """
+    Confirmation handler with rules, timed grants, batched questions and an audit log.
+    The first matching rule decides. A deny rule always wins; "ask" is answered by a grant
+    that has not expired yet, otherwise by ask().
+    One Policy serves the whole agent tree: calls waiting for an answer at the same time
+    (several Actions of a turn, parallel sub-agents) are asked together.
+    :param rules: Rule objects or dicts {"action": ..., "tool": ..., "args": {...}}.
+    :param default: action for calls no rule matches.
+    :param ask: ask([(toolname, kwargs), ...]) -> answers, each True, False or the number of minutes
+        to allow that tool for. Without it everything that would be asked is refused.
+    :param audit: JSONL file that gets every decision; the last ones are also kept in decisions.
+    :param batch_window: seconds to wait for more calls to ask about before asking.
+    """
+    def __init__(
+        self,
+        rules: list=None,
+        default: str="ask",
+        ask: callable=None,
+        audit: str=None,
+        batch_window: float=0.2
+        ):
+        self.rules = [rule if isinstance(rule, Rule) else Rule(**rule) for rule in rules or []]
+        self.default = default
+        self.ask = ask
+        self.audit = path.expanduser(audit) if audit else None
+        self.batch_window = batch_window
+        self.grants = []
+        self.decisions = deque(maxlen=1000)
+        self.lock = threading.Lock()
+        # Only one question on the screen at a time
+        self.asking = threading.Lock()
+        self.pending = []
+
+    def grant(self, tool: str="*", minutes: float=10, args: dict=None):
+        """Allows calls that would be asked about for the next minutes."""
+        with self.lock:
+            self.grants.append((Rule("allow", tool, args), time.monotonic() + minutes * 60))
+
+    def granted(self, toolname: str, kwargs: dict):
+        now = time.monotonic()
+        with self.lock:
+            self.grants = [(rule, until) for rule, until in self.grants if until > now]
+            return next((rule for rule, until in self.grants if rule.matches(toolname, kwargs)), None)
+
+    def decide(self, toolname: str, kwargs: dict):
+        # Returns (action, reason)
+        rule = next((rule for rule in self.rules if rule.matches(toolname, kwargs)), None)
+        action = rule.action if rule is not None else self.default
+        reason = f"rule: {rule}" if rule is not None else "default"
+        if action == "ask":
+            grant = self.granted(toolname, kwargs)
+            if grant is not None:
+                return "allow", f"grant: {grant}"
+        return action, reason
+
+    def record(self, toolname: str, kwargs: dict, allowed: bool, reason: str):
+        decision = {"time": time.time(), "tool": toolname, "args": kwargs, "allowed": allowed, "reason": reason}
+        with self.lock:
+            self.decisions.append(decision)
+            if self.audit is not None:
+                with open(self.audit, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(decision, ensure_ascii=False, default=str) + "\n")
+        return allowed
+
+    def __call__(self, toolname: str, description: str):
+        return self.confirm_many([(toolname, description)])[0]
+
+    def confirm_many(self, requests: list):
+        """[(toolname, description), ...] -> [allowed, ...], asking at most once."""
+        calls = [(toolname, parse_args(description)) for toolname, description in requests]
+        results = [None] * len(calls)
+        questions = []
+        for i, (toolname, kwargs) in enumerate(calls):
+            action, reason = self.decide(toolname, kwargs)
+            if action == "ask":
+                questions.append(i)
+            else:
+                results[i] = self.record(toolname, kwargs, action == "allow", reason)
+        if questions:
+            for i, answer in zip(questions, self.question([calls[i] for i in questions])):
+                results[i] = answer
+        return results
+
+    def question(self, calls: list):
+        if self.ask is None:
+            return [self.record(toolname, kwargs, False, "nobody to ask") for toolname, kwargs in calls]
+        entry = {"calls": calls, "answers": None}
+        with self.lock:
+            self.pending.append(entry)
+        with self.asking:
+            if entry["answers"] is None:
+                # Let parallel agents add their calls to the same question
+                time.sleep(self.batch_window)
+                with self.lock:
+                    batch, self.pending = self.pending, []
+                self.ask_batch(batch)
+        return entry["answers"]
+
+    def ask_batch(self, batch: list):
+        calls = [call for entry in batch for call in entry["calls"]]
+        answers = [None] * len(calls)
+        open_calls = []
+        for i, (toolname, kwargs) in enumerate(calls):
+            # Granted while this batch was waiting
+            grant = self.granted(toolname, kwargs)
+            if grant is not None:
+                answers[i] = self.record(toolname, kwargs, True, f"grant: {grant}")
+            else:
+                open_calls.append(i)
+        if open_calls:
+            try:
+                replies = list(self.ask([calls[i] for i in open_calls]))
+            except Exception as e:
+                replies = [e] * len(open_calls)
+            for i, reply in zip(open_calls, replies):
+                toolname, kwargs = calls[i]
+                if isinstance(reply, Exception):
+                    answers[i] = self.record(toolname, kwargs, False, f"error: {reply}")
+                elif reply is True or reply is False:
+                    answers[i] = self.record(toolname, kwargs, reply, "user")
+                else:
+                    self.grant(toolname, reply)
+                    answers[i] = self.record(toolname, kwargs, True, f"user, for {reply} minutes")
+        for entry in batch:
+            entry["answers"], answers = answers[:len(entry["calls"])], answers[len(entry["calls"]):]
+
+def terminal_ask(calls: list, minutes: float=10):
+    """Asks about all calls at once in the terminal."""
+    from rich.console import Console
+    from rich.panel import Panel
+    from rich.prompt import Prompt
+    console = Console()
+    lines = [f"{i}. {toolname} {json.dumps(kwargs, ensure_ascii=False)}" for i, (toolname, kwargs) in enumerate(calls, 1)]
+    console.print(Panel("\n".join(lines), border_style="blue", title="Confirmation"))
+    hint = f"y — разрешить, n — запретить, a — разрешить эти инструменты на {minutes:g} мин., или номера: 1,3"
+    while True:
+        inp = Prompt.ask(f"Confirmation ({hint})" if len(calls) > 1 else f"Confirmation (y/n/a — на {minutes:g} мин.)", default="y").strip().lower()
+        if inp in ("y", "n", "a"):
+            return [{"y": True, "n": False, "a": minutes}[inp]] * len(calls)
+        try:
+            allowed = set(int(number) for number in inp.split(","))
+        except ValueError:
+            continue
+        return [i in allowed for i in range(1, len(calls) + 1)]
+
+def policy_from_config(config: dict=None):
+    """
+    Policy of the CLI from config["policy"] = {"rules": [...], "default": "ask", "grant_minutes": 10,
+    "audit": "~/Rovoam/confirmations.jsonl"}. Tools in config["auto_confirm"] are allowed.
+    """
+    config = config or get_config()
+    settings = config.get("policy", {})
+    rules = settings.get("rules", []) + [Rule("allow", tool) for tool in config.get("auto_confirm", [])]
+    minutes = settings.get("grant_minutes", 10)
+    return Policy(
+        rules,
+        default=settings.get("default", "ask"),
+        ask=lambda calls: terminal_ask(calls, minutes),
+        audit=settings.get("audit", "~/Rovoam/confirmations.jsonl")
+    )
@@ -0,0 +1,194 @@
+from os import path
+import json
+import threading
+import time
+from rovoam import Chat, Classifier
+from history import content_text
+
+ROUTES = {
+    "chat": "greetings, small talk, thanks, questions about the conversation itself, general knowledge that needs no tools and no current data",
+    "agent": "anything that needs tools, current data (date, news, prices, weather), files, the calendar, other agents or several steps",
+}
+
+FAST_PATH_PROMPT = """You are Rovoam, a helpful assistant. Answer briefly in the user's language, Markdown is allowed.
+If the answer needs tools, current data (date, time, news, prices, weather), files, the calendar or several steps, reply with the single word ESCALATE and nothing else."""
+
+ESCALATE = "ESCALATE"
+
+class FastPath():
+    """
+    Front door of an Agent. A Classifier decides if a message needs the agent; simple ones
+    (greetings, general questions) are answered by a Chat with a short prompt and the last
+    context_turns turns of the conversation, without the ReAct prompt and loop.
+    The Chat may still hand a message over by answering ESCALATE.
+    Both routes add the turn to agent.messages, so the agent always has the whole conversation.
+    Everything else (messages, reset(), session, image_file() ...) is the agent's.
+    Every decision is a "route" span of agent.tracer with the route, the reason and the
+    seconds saved against the mean time of the agent; stats() sums them up.
+    The tracer has no sinks by default, so the decisions also go to the log file.
+    :param classifier: Classifier with the ROUTES categories; by default one on the agent's
+        client and model with a local cache of text_cache answers.
+    :param chat: Chat for the simple messages; by default one with FAST_PATH_PROMPT.
+    :param max_length: longer messages go to the agent without asking the classifier.
+    :param log: JSONL file that gets every decision (the event of the route span).
+    """
+    def __init__(
+        self,
+        agent: object,
+        classifier: object=None,
+        chat: object=None,
+        context_turns: int=4,
+        max_length: int=1000,
+        text_cache: int=1024,
+        log: str=None
+        ):
+        self.agent = agent
+        self.classifier = classifier or Classifier(agent.client, agent.model, ROUTES, text_cache=text_cache, tracer=agent.tracer)
+        self.chat = chat or Chat(agent.client, agent.model, system=FAST_PATH_PROMPT, tracer=agent.tracer)
+        self.context_turns = context_turns
+        self.max_length = max_length
+        self.log = path.expanduser(log) if log else None
+        self.last_budget = None
+        self.counts = {"chat": 0, "agent": 0}
+        self.seconds = {"chat": 0.0, "agent": 0.0}
+        self.saved = 0.0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == "agent":
+            raise AttributeError(name)
+        return getattr(self.agent, name)
+
+    @property
+    def budget(self):
+        return self.agent.budget
+
+    @budget.setter
+    def budget(self, value):
+        self.agent.budget = value
+
+    def route(self, message: str):
+        """Returns (route, reason): route is "chat" or "agent"."""
+        if self._pending_attachments():
+            return "agent", "attachments"
+        if len(message) > self.max_length:
+            return "agent", "long"
+        try:
+            category = self.classifier(message)
+        except Exception as e:
+            return "agent", f"classifier error: {type(e).__name__}"
+        if category == "chat":
+            return "chat", "classifier"
+        return "agent", "classifier"
+
+    def _pending_attachments(self):
+        # Images or audio added since the last answer are for the agent
+        for m in reversed(self.agent.messages):
+            if m["role"] == "assistant":
+                return False
+            if isinstance(m.get("content"), list):
+                return True
+        return False
+
+    def _context(self):
+        # Questions and final answers of the last turns, without ReAct steps and Observations
+        turns = []
+        for m in self.agent.messages:
+            if m["role"] == "user":
+                turns.append([content_text(m["content"]), None])
+            elif m["role"] == "assistant" and turns and isinstance(m.get("content"), str):
+                turns[-1][1] = m["content"]
+        context = []
+        for question, answer in turns[-self.context_turns:] if self.context_turns else []:
+            context.append({"role": "user", "content": question})
+            if answer is not None:
+                context.append({"role": "assistant", "content": answer})
+        return context
+
+    def _answer(self, message: str):
+        # Returns the Chat answer, None when the message goes to the agent after all
+        self.chat.reset()
+        self.chat.messages.extend(self._context())
+        answer = self.chat(message)
+        if answer is None or answer.strip().strip(".").upper() == ESCALATE:
+            return None
+        return answer
+
+    def _front(self, message: str):
+        # Returns (route, reason, answer, span, seconds of routing); answer is set for the chat route
+        start = time.perf_counter()
+        span = self.agent.tracer.start("route", "fast_path")
+        with self.agent.tracer.activate(span):
+            route, reason = self.route(message)
+            answer = None
+            if route == "chat":
+                try:
+                    answer = self._answer(message)
+                except Exception as e:
+                    reason = f"chat error: {type(e).__name__}"
+                if answer is None:
+                    route, reason = "agent", "escalated" if reason == "classifier" else reason
+        return route, reason, answer, span, time.perf_counter() - start
+
+    def _finish(self, route: str, reason: str, span, routing: float, seconds: float):
+        with self.lock:
+            mean_agent = self.seconds["agent"] / self.counts["agent"] if self.counts["agent"] else None
+            self.counts[route] += 1
+            self.seconds[route] += seconds
+            # The chat route saves the usual time of the agent, the agent route pays for the routing
+            if route == "agent":
+                saved = -routing
+            else:
+                saved = None if mean_agent is None else mean_agent - seconds
+            if saved is not None:
+                self.saved += saved
+        event = span.end(route=route, reason=reason, seconds=round(seconds, 4), saved=None if saved is None else round(saved, 4))
+        if self.log is not None:
+            with self.lock:
+                with open(self.log, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+
+    def _add_turn(self, message: str, role: str, answer: str):
+        self.agent(message, role=role, call=False)
+        self.agent(answer, role="assistant", call=False)
+        self.last_budget = None
+
+    def __call__(self, message: str=None, role: str="user", call: bool=True, return_trace: bool=None, budget: object=None):
+        if message is None or not call:
+            return self.agent(message, role=role, call=call, return_trace=return_trace, budget=budget)
+        start = time.perf_counter()
+        route, reason, answer, span, routing = self._front(message)
+        if route == "chat":
+            self._add_turn(message, role, answer)
+        else:
+            answer = self.agent(message, role=role, return_trace=return_trace, budget=budget)
+            self.last_budget = self.agent.last_budget
+        self._finish(route, reason, span, routing, time.perf_counter() - start)
+        return answer
+
+    def stream(self, message: str=None, role: str="user", return_trace: bool=None, budget: object=None):
+        """Agent.stream() events; a chat answer comes as one answer event and the result."""
+        if message is None:
+            yield from self.agent.stream(message, role=role, return_trace=return_trace, budget=budget)
+            return
+        start = time.perf_counter()
+        route, reason, answer, span, routing = self._front(message)
+        if route == "chat":
+            self._add_turn(message, role, answer)
+            self._finish(route, reason, span, routing, time.perf_counter() - start)
+            yield {"type": "answer", "delta": answer}
+            yield {"type": "result", "content": answer, "budget": None}
+            return
+        yield from self.agent.stream(message, role=role, return_trace=return_trace, budget=budget)
+        self.last_budget = self.agent.last_budget
+        self._finish(route, reason, span, routing, time.perf_counter() - start)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "chat": self.counts["chat"],
+                "agent": self.counts["agent"],
+                "chat_mean": self.seconds["chat"] / self.counts["chat"] if self.counts["chat"] else None,
+                "agent_mean": self.seconds["agent"] / self.counts["agent"] if self.counts["agent"] else None,
+                "saved": round(self.saved, 4),
+            }
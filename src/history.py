@@ -0,0 +1,161 @@
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+IMAGE_TOKENS = 85
+MESSAGE_TOKENS = 4
+
+SUMMARY_PROMPT = """
+Update the summary of a conversation between a user and an AI agent.
+Keep facts, decisions, tool results and open questions that may be needed later. Drop greetings and repetition.
+Reply with the new summary only.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+"""
+
+_encoding = None
+
+def count_tokens(text: str):
+    # tiktoken if it is installed, otherwise about 4 characters per token
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def content_text(content):
+    # Text of a message content, images are replaced by a placeholder
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    parts = []
+    for block in content:
+        if block.get("type") == "text":
+            parts.append(block.get("text", ""))
+        else:
+            parts.append(f"[{block.get('type', 'attachment')}]")
+    return "\n".join(parts)
+
+def message_tokens(message: dict):
+    tokens = MESSAGE_TOKENS
+    content = message.get("content")
+    if isinstance(content, list):
+        for block in content:
+            if block.get("type") == "text":
+                tokens += count_tokens(block.get("text", ""))
+            else:
+                tokens += IMAGE_TOKENS
+    elif content:
+        tokens += count_tokens(content)
+    for call in message.get("tool_calls") or []:
+        tokens += count_tokens(call["function"]["name"] + call["function"]["arguments"])
+    return tokens
+
+def is_observation(message: dict):
+    content = message.get("content")
+    return message["role"] == "tool" or (
+        message["role"] == "system" and isinstance(content, str) and content.startswith("Observation")
+    )
+
+class HistoryManager():
+    """
+    Keeps a message history under a token budget.
+    Leading system messages, the last keep_last messages and everything from the last user
+    message on stay as they are. Older messages get long Observations truncated and images
+    replaced by a placeholder; if that is not enough they are folded into a rolling summary
+    written by summarizer (e.g. a cheap Chat), or dropped when there is no summarizer.
+    If the history is still too long, the long Observations of the current turn are truncated too.
+    last_saved / total_saved tell how many tokens compaction removed.
+    """
+    def __init__(
+        self,
+        max_tokens: int=8000,
+        keep_last: int=6,
+        observation_limit: int=1000,
+        summarizer: callable=None
+        ):
+        self.max_tokens = max_tokens
+        self.keep_last = keep_last
+        self.observation_limit = observation_limit
+        self.summarizer = summarizer
+        self.last_tokens = 0
+        self.last_saved = 0
+        self.total_saved = 0
+
+    def tokens(self, messages: list):
+        return sum(message_tokens(m) for m in messages)
+
+    def compact(self, messages: list):
+        before = self.tokens(messages)
+        self.last_saved = 0
+        self.last_tokens = before
+        if before <= self.max_tokens:
+            return messages
+
+        # System prompts at the start, then the previous summary if there is one
+        start = 0
+        while start < len(messages) and messages[start]["role"] == "system" and not is_observation(messages[start]):
+            start += 1
+        head = [m for m in messages[:start] if not str(m.get("content", "")).startswith(SUMMARY_PREFIX)]
+        summary = "".join(
+            m["content"][len(SUMMARY_PREFIX):] for m in messages[:start]
+            if str(m.get("content", "")).startswith(SUMMARY_PREFIX)
+        )
+
+        # The current question stays, however many tool calls came after it
+        last_user = max((i for i in range(start, len(messages)) if messages[i]["role"] == "user"), default=len(messages))
+        # Don't separate tool results from the assistant message that requested them
+        split = min(max(start, len(messages) - self.keep_last), last_user)
+        while start < split < len(messages) and messages[split]["role"] == "tool":
+            split -= 1
+        old = [self.shrink(m) for m in messages[start:split]]
+        recent = messages[split:]
+
+        summary_msg = [{"role": "system", "content": SUMMARY_PREFIX + summary}] if summary else []
+        result = head + summary_msg + old + recent
+        if self.tokens(result) > self.max_tokens and old:
+            if self.summarizer is not None:
+                summary = self.summarize(summary, old)
+                result = head + [{"role": "system", "content": SUMMARY_PREFIX + summary}] + recent
+            else:
+                while old and self.tokens(head + summary_msg + old + recent) > self.max_tokens:
+                    old.pop(0)
+                    # A tool result without its request is rejected by the API
+                    while old and old[0]["role"] == "tool":
+                        old.pop(0)
+                result = head + summary_msg + old + recent
+        if self.tokens(result) > self.max_tokens:
+            result = result[:len(result) - len(recent)] + [self.shrink(m) if is_observation(m) else m for m in recent]
+
+        self.last_tokens = self.tokens(result)
+        self.last_saved = before - self.last_tokens
+        self.total_saved += self.last_saved
+        return result
+
+    def shrink(self, message: dict):
+        content = message.get("content")
+        if isinstance(content, list):
+            return {**message, "content": content_text(content)}
+        if is_observation(message) and content and len(content) > self.observation_limit:
+            cut = len(content) - self.observation_limit
+            return {**message, "content": content[:self.observation_limit] + f"... [truncated {cut} characters]"}
+        return message
+
+    def summarize(self, summary: str, messages: list):
+        lines = []
+        for m in messages:
+            text = content_text(m.get("content"))
+            for call in m.get("tool_calls") or []:
+                text += f"\nCall: {call['function']['name']}({call['function']['arguments']})"
+            lines.append(f"{m['role']}: {text}")
+        if hasattr(self.summarizer, "reset"):
+            self.summarizer.reset()
+        return self.summarizer(SUMMARY_PROMPT.format(summary=summary or "(empty)", messages="\n".join(lines)))
@@ -1,22 +1,53 @@
-from rich.console import Console
-from rich.markdown import Markdown
-from rich.panel import Panel
-from rich.prompt import Prompt
-import base64
 from json import load, dump
-from network import supervisor as main_agent
-from prompt_toolkit import PromptSession
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.patch_stdout import patch_stdout
+from network import get_supervisor as main_agent, get_front_door as front_door
+from sessions import SessionStore
+import queue
 import sys
-from config import config
+import threading
+from config import get_config
 
-console = Console()
+# rich, prompt_toolkit and openai are imported where they are first needed:
+# `main.py "question"` sends the request before the UI libraries are loaded
+
+class LazyConsole():
+    # Replaces itself with rich Console on first use
+    def __getattr__(self, attr):
+        global console
+        from rich.console import Console
+        console = Console()
+        return getattr(console, attr)
+
+console = LazyConsole()
 markdown_enabled = False
+_sessions = None
+_prompt_session = None
+
+def sessions():
+    global _sessions
+    if _sessions is None:
+        _sessions = SessionStore(attachments=main_agent().attachments)
+    return _sessions
+
+def prompt_session():
+    # One session for the whole run, it also keeps the input history
+    global _prompt_session
+    if _prompt_session is None:
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.key_binding import KeyBindings
+
+        bindings = KeyBindings()
+        @bindings.add('s-tab')
+        def _(event):
+            buffer = event.app.current_buffer
+            event.app.exit(result=buffer.text)
 
-def encode_image(path):
-    with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        @bindings.add('enter')
+        def _(event):
+            buffer = event.app.current_buffer
+            buffer.insert_text("\n")
+
+        _prompt_session = PromptSession(key_bindings=bindings, multiline=True)
+    return _prompt_session
 
 name = "Rovoam"
 
@@ -32,14 +63,23 @@ def printhelp():
 - exit — выход из программы
 - image [type] [path or URL] — send image. Example: `/image file ./img.jpg` or `/image url http://...`
 - messages — показать все сообщения
-- clear — clear history
+- clear — clear history and start a new session
+- sessions — list saved sessions
+- resume [id] — continue a saved session (the beginning of the id is enough)
+- fork — continue the current conversation in a new session, the old one stays as it is
 - trace — show last agent's trace
+- endpoints — latency and errors of the endpoints (when several are configured)
+- routes — how many messages were answered without the agent and the time saved
+- allow [tool] [minutes] — allow a tool (or every tool: `*`) without asking for some minutes. By default: 10.
 - markdown [on/off] — turns Markdown hilighting (`/markdown on`, `/markdown off`). By default: off.
 """
+    from rich.markdown import Markdown
+    from rich.panel import Panel
     console.print(Panel(Markdown(help), title="Help", border_style="blue"))
 
 def load_image(*args):
     # args: [type, [value]]
+    from rich.prompt import Prompt
     type = None
     value = None
     # Parse args, fallback to prompt if missing
@@ -58,17 +98,137 @@ def load_image(*args):
             if value is None:
                 value = Prompt.ask("[green]path")
             try:
-                base64_str = encode_image(value)
-                main_agent.image(f"data:image/jpeg;base64,{base64_str}")
+                main_agent().image_file(value)
             except Exception as e:
                 console.print(f"[red]Error loading file: {e}")
         case "url":
             if value is None:
                 value = Prompt.ask("[green]URL")
-            main_agent.image(value)
+            main_agent().image(value)
+
+def list_sessions():
+    from rich.panel import Panel
+    lines = []
+    for info in sessions().list():
+        current = " (current)" if main_agent().session is not None and main_agent().session.id == info["id"] else ""
+        fork = f" ← {info['forked_from']}" if info.get("forked_from") else ""
+        lines.append(f"[blue]{info['id']}[/blue] {info['updated']}{current}{fork}\n  {info['title']}")
+    console.print(Panel("\n".join(lines) or "No sessions yet", title="Sessions", border_style="blue"))
+
+def resume_session(*args):
+    if len(args) != 1:
+        console.print("[red]Использование: /resume id")
+        return
+    try:
+        session, messages = sessions().open(args[0])
+    except KeyError as e:
+        console.print(f"[red]{e.args[0]}")
+        return
+    main_agent().messages = messages
+    main_agent().session = session
+    console.print(f"[blue]Session {session.id} resumed, {len(messages)} messages")
+
+def fork_session():
+    parent = main_agent().session.id if main_agent().session is not None else None
+    main_agent().session = sessions().fork(parent, main_agent().messages)
+    console.print(f"[blue]Forked into session {main_agent().session.id}")
+
+def show_endpoints():
+    from rich.table import Table
+    client = main_agent().client
+    if not hasattr(client, "stats"):
+        console.print("[blue]One endpoint, add more under \"roles\" in the config")
+        return
+    stats = client.stats()
+    table = Table(*stats[0].keys(), title="Endpoints")
+    for row in stats:
+        table.add_row(*[str(round(value, 3) if isinstance(value, float) else value) for value in row.values()])
+    console.print(table)
+
+def show_routes():
+    door = front_door()
+    if not hasattr(door, "stats"):
+        console.print("[blue]The fast path is off (\"fast_path\": false in the config)")
+        return
+    stats = door.stats()
+    mean = lambda seconds: "-" if seconds is None else f"{seconds:.2f}s"
+    console.print(
+        f"[blue]Chat: {stats['chat']} (mean {mean(stats['chat_mean'])}), "
+        f"agent: {stats['agent']} (mean {mean(stats['agent_mean'])}), saved {stats['saved']:.1f}s"
+    )
+
+def allow_tool(*args):
+    policy = main_agent().confirmation_handler
+    if not args or len(args) > 2 or not hasattr(policy, "grant"):
+        console.print("[red]Использование: /allow tool [minutes]")
+        return
+    try:
+        minutes = float(args[1]) if len(args) == 2 else 10
+    except ValueError:
+        console.print("[red]minutes must be a number")
+        return
+    policy.grant(args[0], minutes)
+    console.print(f"[blue]{args[0]} allowed for {minutes:g} minutes")
+
+def render(text):
+    if not markdown_enabled:
+        return text
+    from rich.markdown import Markdown
+    return Markdown(text)
+
+def in_background(events):
+    # Runs the agent in a thread: the request is on its way while rich is loading
+    items = queue.Queue()
+    def run():
+        try:
+            for event in events:
+                items.put((event, None))
+        except BaseException as e:
+            items.put((None, e))
+            return
+        items.put((None, None))
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        event, error = items.get()
+        if error is not None:
+            raise error
+        if event is None:
+            return
+        yield event
+
+def respond(message):
+    # The session file appears with the first message
+    if main_agent().session is None:
+        main_agent().session = sessions().create()
+    # Simple messages skip the supervisor's ReAct loop
+    events = in_background(front_door().stream(message))
+    # Print the answer while it is being generated
+    console.print(f"[red] {name}")
+    from rich.live import Live
+    answer = ""
+    live = None
+    try:
+        for event in events:
+            if event["type"] == "answer":
+                answer += event["delta"]
+                if live is None:
+                    live = Live(render(answer), console=console, auto_refresh=False)
+                    live.start()
+                live.update(render(answer), refresh=True)
+            elif event["type"] == "result" and live is None:
+                # No Answer was streamed (trace mode or iterations ran out)
+                console.print(render(str(event["content"])))
+    finally:
+        if live is not None:
+            live.stop()
 
 def run_interactive():
     global markdown_enabled
+    from rich.markdown import Markdown
+    from rich.panel import Panel
+    from rich.prompt import Prompt
+    from prompt_toolkit.patch_stdout import patch_stdout
+    config = get_config()
     while True:
         if config["first_run"] == "yes":
             inp = Prompt.ask(f"[green]This is your first run of the program. Do you need [blue]totorial?", choices=["Y", "n"], default="Y").lower()
@@ -83,20 +243,8 @@ Commands start with / and a full list of commands can be found using /help"""),
 
         console.print(f"[green]Send message to [red]{name}:")
 
-        bindings = KeyBindings()
-        @bindings.add('s-tab')
-        def _(event):
-            buffer = event.app.current_buffer
-            event.app.exit(result=buffer.text)
-
-        @bindings.add('enter')
-        def _(event):
-            buffer = event.app.current_buffer
-            buffer.insert_text("\n")
-
-        session = PromptSession(key_bindings=bindings, multiline=True)
         with patch_stdout():
-            message = session.prompt("")
+            message = prompt_session().prompt("")
         if message.startswith("/"):
             parts = message[1:].split()
             if not parts:
@@ -112,11 +260,24 @@ Commands start with / and a full list of commands can be found using /help"""),
                     case "image":
                         load_image(*args)
                     case "messages":
-                        console.print(Panel(str(main_agent.messages)))
+                        console.print(Panel(str(main_agent().messages)))
                     case "clear":
-                        main_agent.reset()
+                        main_agent().reset()
+                        main_agent().session = None
+                    case "sessions":
+                        list_sessions()
+                    case "resume":
+                        resume_session(*args)
+                    case "fork":
+                        fork_session()
                     case "trace":
-                        console.print(Panel(main_agent.last_trace))
+                        console.print(Panel(main_agent().last_trace))
+                    case "endpoints":
+                        show_endpoints()
+                    case "routes":
+                        show_routes()
+                    case "allow":
+                        allow_tool(*args)
                     case "markdown":
                         if len(args) != 1 or args[0] not in ("on", "off"):
                             console.print("[red]Использование: /markdown on|off")
@@ -127,12 +288,7 @@ Commands start with / and a full list of commands can be found using /help"""),
                     case _:
                         console.print("[green]/help [blue]to get list of commands.")
         else:
-            console.print(f"[red] {name}")
-            response = main_agent(message)
-            if markdown_enabled:
-                console.print(Markdown(str(response)))
-            else:
-                console.print(response)    
+            respond(message)
 
 def run_cli(args):
     global markdown_enabled
@@ -140,13 +296,10 @@ def run_cli(args):
 
     while True:
         if message.strip() == "":
+            from rich.prompt import Prompt
             message = Prompt.ask(f"[green]Введите запрос для [red]{name}[/red]")
-        console.print(f"[red] {name}")
-        response = main_agent(message)
-        if markdown_enabled:
-            console.print(Markdown(str(response)))
-        else:
-            console.print(response)
+        respond(message)
+        from rich.prompt import Prompt
         proceed = Prompt.ask("[green]Завершить чат? [y/n]", choices=["y", "n"], default="y").lower()
         if proceed == "y":
             break
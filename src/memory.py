@@ -0,0 +1,197 @@
+import hashlib
+import math
+import threading
+import time
+from array import array
+from os import path
+from toolindex import words
+
+class Memory():
+    """
+    Long-term memory of agents in SQLite.
+    Finished turns (question and answer) and Observations are indexed with FTS5 (BM25) as they
+    happen; before every user turn the Agent gets the top_k entries that match the message,
+    at most max_tokens of them, as a system message in the request. One Memory may be shared
+    by all agents of a supervisor tree.
+    The least recently recalled entries are evicted above max_entries, compact() rebuilds the index.
+    :param embed: embed(texts) -> list of vectors. When set, entries are also ranked by cosine
+        similarity (among the vector_scan most recently used ones) and both rankings are fused.
+    :param observation_limit: longer Observations are cut to this many characters.
+    """
+    def __init__(
+        self,
+        file: str="~/Rovoam/memory.sqlite",
+        top_k: int=5,
+        max_tokens: int=800,
+        max_entries: int=20000,
+        observation_limit: int=2000,
+        embed: callable=None,
+        vector_scan: int=2000
+        ):
+        self.file = path.expanduser(file)
+        self.top_k = top_k
+        self.max_tokens = max_tokens
+        self.max_entries = max_entries
+        self.observation_limit = observation_limit
+        self.embed = embed
+        self.vector_scan = vector_scan
+        self.recalls = 0
+        self.recalled_tokens = 0
+        self.lock = threading.Lock()
+        import sqlite3
+        self.db = sqlite3.connect(self.file, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS memories (
+                id INTEGER PRIMARY KEY, hash TEXT UNIQUE NOT NULL, kind TEXT NOT NULL, agent TEXT,
+                text TEXT NOT NULL, vector BLOB, created REAL NOT NULL, accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS memories_accessed ON memories (accessed);
+            CREATE VIRTUAL TABLE IF NOT EXISTS memory_index USING fts5(
+                text, content='memories', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            );
+            -- The index follows the table, eviction is a plain DELETE
+            CREATE TRIGGER IF NOT EXISTS memories_insert AFTER INSERT ON memories BEGIN
+                INSERT INTO memory_index (rowid, text) VALUES (new.id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS memories_delete AFTER DELETE ON memories BEGIN
+                INSERT INTO memory_index (memory_index, rowid, text) VALUES ('delete', old.id, old.text);
+            END;
+        """)
+        self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+
+    def add(self, text: str, kind: str="turn", agent: str=None):
+        """Returns the id of the new entry, None if the same text is already there."""
+        text = text.strip()
+        if not text:
+            return None
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        vector = None
+        if self.embed is not None:
+            vector = array("f", self.embed([text])[0]).tobytes()
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO memories (hash, kind, agent, text, vector, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, agent, text, vector, now, now)
+            )
+            self.db.execute(
+                "DELETE FROM memories WHERE id IN "
+                "(SELECT id FROM memories ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self.db.commit()
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def remember_turn(self, question: str, answer: str, observations: list=(), agent: str=None):
+        # Returns the ids of the new entries
+        ids = []
+        for name, content in observations:
+            content = str(content)
+            if len(content) > self.observation_limit:
+                content = content[:self.observation_limit] + "..."
+            ids.append(self.add(f"{name}: {content}", "observation", agent))
+        ids.append(self.add(f"Q: {question}\nA: {answer}", "turn", agent))
+        return [id for id in ids if id is not None]
+
+    def lexical(self, query: str, limit: int):
+        terms = set(words(query))
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT rowid FROM memory_index WHERE memory_index MATCH ? ORDER BY bm25(memory_index) LIMIT ?",
+                (match, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def semantic(self, query: str, limit: int):
+        target = self.embed([query])[0]
+        norm = math.sqrt(sum(x * x for x in target)) or 1.0
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, vector FROM memories WHERE vector IS NOT NULL ORDER BY accessed DESC LIMIT ?",
+                (self.vector_scan,)
+            ).fetchall()
+        scored = []
+        for id, blob in rows:
+            vector = array("f")
+            vector.frombytes(blob)
+            length = math.sqrt(sum(x * x for x in vector)) or 1.0
+            scored.append((sum(a * b for a, b in zip(target, vector)) / (norm * length), id))
+        scored.sort(reverse=True)
+        return [id for score, id in scored[:limit]]
+
+    def search(self, query: str, k: int=None, exclude=()):
+        """Best entries for query: [{"id", "kind", "agent", "text", "created"}]."""
+        k = k or self.top_k
+        rankings = [self.lexical(query, k * 4 + len(exclude))]
+        if self.embed is not None:
+            rankings.append(self.semantic(query, k * 4 + len(exclude)))
+        # Reciprocal rank fusion
+        scores = {}
+        for ranking in rankings:
+            for rank, id in enumerate(ranking):
+                if id not in exclude:
+                    scores[id] = scores.get(id, 0.0) + 1 / (60 + rank)
+        best = sorted(scores, key=lambda id: -scores[id])[:k]
+        if not best:
+            return []
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT id, kind, agent, text, created FROM memories WHERE id IN ({','.join('?' * len(best))})", best
+            ).fetchall()
+        entries = {row[0]: {"id": row[0], "kind": row[1], "agent": row[2], "text": row[3], "created": row[4]} for row in rows}
+        return [entries[id] for id in best if id in entries]
+
+    def recall(self, query: str, exclude=()):
+        """Text of the entries for the prompt, under max_tokens. Empty if nothing matches."""
+        from history import count_tokens
+        lines = []
+        used = 0
+        ids = []
+        for entry in self.search(query, exclude=exclude):
+            date = time.strftime("%Y-%m-%d", time.localtime(entry["created"]))
+            line = f"- [{date}] {entry['text']}"
+            tokens = count_tokens(line)
+            if used + tokens > self.max_tokens:
+                break
+            lines.append(line)
+            used += tokens
+            ids.append(entry["id"])
+        if not lines:
+            return ""
+        with self.lock:
+            self.db.execute(
+                f"UPDATE memories SET accessed = ? WHERE id IN ({','.join('?' * len(ids))})", [time.time(), *ids]
+            )
+            self.db.commit()
+            self.recalls += 1
+            self.recalled_tokens += used
+        return "Relevant memory from earlier conversations:\n" + "\n".join(lines)
+
+    def forget(self, id: int):
+        with self.lock:
+            self.db.execute("DELETE FROM memories WHERE id = ?", (id,))
+            self.db.commit()
+
+    def compact(self):
+        """Merges the index segments and gives the space of evicted entries back to the disk."""
+        with self.lock:
+            self.db.execute("INSERT INTO memory_index (memory_index) VALUES ('optimize')")
+            self.db.commit()
+            self.db.execute("VACUUM")
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM memories")
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+        return {"entries": entries, "recalls": self.recalls, "recalled_tokens": self.recalled_tokens}
@@ -0,0 +1,65 @@
+import sys
+import weakref
+from collections.abc import Mapping
+
+class Message(Mapping):
+    """
+    Compact, read-only message of Agent.messages: role and content in slots,
+    other keys (tool_calls, tool_call_id, name) in extra. Reads like the dict it
+    replaces (m["role"], m.get("content"), {**m}); dict(m) gives the API format.
+    """
+    __slots__ = ("role", "content", "extra", "__weakref__")
+
+    def __init__(self, role: str, content=None, extra: dict=None):
+        self.role = role
+        self.content = content
+        self.extra = extra or None
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        if self.extra is not None:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield "role"
+        yield "content"
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return 2 + len(self.extra or ())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        return Message, (self.role, self.content, self.extra)
+
+_shared = weakref.WeakValueDictionary()
+
+def shared_message(role: str, content: str):
+    """
+    One record for equal prompts: agents with the same tools and system text
+    hold the same Message instead of their own copy of the string.
+    """
+    key = (role, content)
+    message = _shared.get(key)
+    if message is None:
+        message = Message(role, sys.intern(content) if type(content) is str else content)
+        message = _shared.setdefault(key, message)
+    return message
+
+def compact(messages: list):
+    """Replaces the dicts in messages by Message records, in place."""
+    for i, m in enumerate(messages):
+        if type(m) is dict:
+            extra = {key: value for key, value in m.items() if key != "role" and key != "content"}
+            messages[i] = Message(m["role"], m.get("content"), extra)
+
+def materialize(messages: list):
+    """Messages in the API format: a list of plain dicts."""
+    return [m if type(m) is dict else dict(m) for m in messages]
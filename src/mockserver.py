@@ -0,0 +1,281 @@
+"""
+Local OpenAI-compatible chat completions server that replays scripted replies.
+Used by benchmark.py and for testing without a real endpoint.
+
+Every model name has its own script: a list of replies returned one after another
+(the list starts over when it ends). A reply is
+- a string: assistant text,
+- {"tool_calls": [{"name": ..., "arguments": {...}}]}: native tool calls,
+- {"error": 429, "retry_after": 1, "message": "..."}: an HTTP error (the request does not
+  count as served),
+- a callable(messages) returning one of the above (only when used in-process).
+
+Run standalone: python mockserver.py script.json --port 8000 --latency 0.2 --tps 50
+where script.json is {"model name": [replies]}.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import threading
+import time
+import uuid
+
+def estimate_tokens(text: str):
+    return len(text) // 4 + 1
+
+def split_tokens(text: str):
+    # Pieces of about one token, the way a streaming endpoint sends them
+    return [text[i:i+4] for i in range(0, len(text), 4)] or [""]
+
+class MockServer():
+    def __init__(
+        self,
+        scripts: dict=None,
+        latency: float=0.0,
+        tokens_per_second: float=None,
+        host: str="127.0.0.1",
+        port: int=0
+        ):
+        """
+        :param latency: seconds before the first token.
+        :param tokens_per_second: generation speed, None sends everything at once.
+        """
+        self.scripts = scripts or {}
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.positions = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.httpd = ThreadingHTTPServer((host, port), self.handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.errors = 0
+            self.log = []
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "errors": self.errors,
+        }
+
+    def script(self, model: str, replies: list):
+        with self.lock:
+            self.scripts[model] = replies
+            self.positions[model] = 0
+
+    def next_reply(self, model: str, messages: list):
+        with self.lock:
+            replies = self.scripts.get(model) or self.scripts.get("*") or ["Answer: (no script)"]
+            position = self.positions.get(model, 0)
+            self.positions[model] = position + 1
+        reply = replies[position % len(replies)]
+        if callable(reply):
+            reply = reply(messages)
+        return reply
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def generate_delay(self, text: str):
+        if not self.tokens_per_second:
+            return 0.0
+        return estimate_tokens(text) / self.tokens_per_second
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status: int, body: bytes, content_type: str="application/json", headers: dict=None):
+                self.send_response(status)
+                for header, value in (headers or {}).items():
+                    self.send_header(header, value)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up on the request (e.g. a cancelled hedge)
+                    self.close_connection = True
+                    return
+                with server.lock:
+                    server.bytes_sent += len(body)
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/models"):
+                    data = [{"id": model, "object": "model", "owned_by": "mock"} for model in server.scripts]
+                    self.send(200, json.dumps({"object": "list", "data": data}).encode())
+                else:
+                    self.send(404, b'{"error": {"message": "not found"}}')
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length)
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send(404, b'{"error": {"message": "not found"}}')
+                    return
+                request = json.loads(raw)
+                messages = request.get("messages", [])
+                reply = server.next_reply(request.get("model", ""), messages)
+                if isinstance(reply, dict) and "error" in reply:
+                    self.error(reply)
+                    return
+                prompt_tokens = estimate_tokens(json.dumps(messages, ensure_ascii=False))
+                with server.lock:
+                    server.requests += 1
+                    server.bytes_received += len(raw)
+                    server.prompt_tokens += prompt_tokens
+                    server.log.append(request)
+                time.sleep(server.latency)
+                if request.get("stream"):
+                    self.stream(request, reply, prompt_tokens)
+                else:
+                    self.complete(request, reply, prompt_tokens)
+
+            def error(self, reply):
+                body = json.dumps({"error": {"message": reply.get("message", f"mock error {reply['error']}"), "type": "mock"}}).encode()
+                headers = {"Retry-After": str(reply["retry_after"])} if reply.get("retry_after") is not None else None
+                with server.lock:
+                    server.errors += 1
+                self.send(reply["error"], body, headers=headers)
+
+            def message(self, reply):
+                if isinstance(reply, dict) and "tool_calls" in reply:
+                    calls = [
+                        {
+                            "id": f"call_{uuid.uuid4().hex[:12]}",
+                            "type": "function",
+                            "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}))}
+                        }
+                        for call in reply["tool_calls"]
+                    ]
+                    return {"role": "assistant", "content": reply.get("content"), "tool_calls": calls}, "tool_calls"
+                return {"role": "assistant", "content": str(reply)}, "stop"
+
+            def complete(self, request, reply, prompt_tokens):
+                message, finish_reason = self.message(reply)
+                text = json.dumps(message, ensure_ascii=False)
+                completion_tokens = estimate_tokens(text)
+                time.sleep(server.generate_delay(text))
+                with server.lock:
+                    server.completion_tokens += completion_tokens
+                body = {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", ""),
+                    "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens
+                    }
+                }
+                self.send(200, json.dumps(body, ensure_ascii=False).encode())
+
+            def chunk(self, request, delta, finish_reason=None, usage=None):
+                body = {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": request.get("model", ""),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+                }
+                if usage is not None:
+                    # stream_options.include_usage: a last chunk without choices
+                    body["choices"], body["usage"] = [], usage
+                data = f"data: {json.dumps(body, ensure_ascii=False)}\n\n".encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+                with server.lock:
+                    server.bytes_sent += len(data)
+
+            def stream(self, request, reply, prompt_tokens):
+                message, finish_reason = self.message(reply)
+                completion_tokens = 0
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    if message.get("tool_calls"):
+                        for index, call in enumerate(message["tool_calls"]):
+                            self.chunk(request, {"tool_calls": [{"index": index, **call}]})
+                            tokens = estimate_tokens(json.dumps(call))
+                            completion_tokens += tokens
+                            with server.lock:
+                                server.completion_tokens += tokens
+                    else:
+                        pieces = split_tokens(message["content"])
+                        for piece in pieces:
+                            time.sleep(server.generate_delay(piece))
+                            self.chunk(request, {"content": piece})
+                            completion_tokens += 1
+                            with server.lock:
+                                server.completion_tokens += 1
+                    self.chunk(request, {}, finish_reason)
+                    if (request.get("stream_options") or {}).get("include_usage"):
+                        self.chunk(request, None, usage={
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens,
+                            "total_tokens": prompt_tokens + completion_tokens
+                        })
+                    done = b"data: [DONE]\n\n"
+                    self.wfile.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading early (e.g. after PAUSE)
+                    self.close_connection = True
+
+        return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server")
+    parser.add_argument("script", help='JSON file {"model": [replies]}')
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--tps", type=float, default=None, help="tokens per second")
+    args = parser.parse_args()
+    with open(args.script) as f:
+        scripts = json.load(f)
+    server = MockServer(scripts, latency=args.latency, tokens_per_second=args.tps, host=args.host, port=args.port)
+    print(f"Serving on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
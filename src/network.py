@@ -1,22 +1,89 @@
-from openai import OpenAI
 from rovoam import Agent
 from datetime import datetime
-from confirmation import confirmation_handler
-from calcurse_agent import scheduler
+from confirmation import policy_from_config
+from attachments import AttachmentStore
+from config import get_config
 
-client = OpenAI(api_key="no", base_url="https://text.pollinations.ai/openai")
+# The client and the agents are built on first use: importing openai takes
+# most of the startup time and one-shot runs should not wait for it twice
 
-# Tools
+_supervisor = None
+_front_door = None
 
-# Agents
+def get_supervisor():
+    # The one supervisor of the CLI
+    global _supervisor
+    if _supervisor is None:
+        _supervisor = build_supervisor()
+    return _supervisor
 
-# Superviser Agent
+def get_front_door():
+    # What the CLI sends messages to: the supervisor behind the fast path
+    global _front_door
+    if _front_door is None:
+        _front_door = build_front_door(get_supervisor())
+    return _front_door
 
-supervisor = Agent(
-    client=client, 
-    model="openai", 
-    system=f"You are Rovoam. An AGI and a universal AI. Your task is to manage other agents, coordinating their work. You must carefully plan the sequence of calls to gather all the necessary data for the next agent. You can use Markdown. Respond in the user's language unless they ask for something else. Now is {datetime.now()}.",
-    tools=[],
-    maxIterations=20,
-    confirmation_handler=confirmation_handler
-)
+def build_front_door(supervisor: Agent=None):
+    """
+    Simple messages are answered by a Chat, the rest by the supervisor (fastpath.FastPath).
+    "fast_path": false in the config sends everything to the supervisor,
+    a dict there is passed to FastPath. The decisions go to ~/Rovoam/routes.jsonl
+    unless the dict sets another "log" (null turns it off).
+    """
+    supervisor = supervisor or build_supervisor()
+    settings = get_config().get("fast_path", True)
+    if not settings:
+        return supervisor
+    from fastpath import FastPath
+    settings = settings if isinstance(settings, dict) else {}
+    return FastPath(supervisor, **{"log": "~/Rovoam/routes.jsonl", **settings})
+
+def build_supervisor():
+    # A new supervisor with its own messages, for batch runs and the server
+    from client import get_client
+    from router import get_router
+    from calcurse_agent import scheduler
+
+    # Long-term memory is opt-in: "memory": true or the arguments of Memory
+    memory = None
+    if get_config().get("memory"):
+        from memory import Memory
+        settings = get_config()["memory"]
+        memory = Memory(**settings) if isinstance(settings, dict) else Memory()
+
+    # Deadline and token limits of every request: "budget": {"seconds": 60, "total_tokens": 50000}
+    budget = None
+    if get_config().get("budget"):
+        from budget import Budget
+        budget = Budget(**get_config()["budget"])
+
+    # Endpoints listed for the role in the config, the public endpoint otherwise
+    if get_config().get("roles", {}).get("supervisor"):
+        client = get_router("supervisor", hedge=True)
+    else:
+        client = get_client(base_url="https://text.pollinations.ai/openai", api_key="no")
+
+    # Tools
+
+    # Agents
+
+    # Superviser Agent
+
+    return Agent(
+        client=client, 
+        model="openai", 
+        system=f"You are Rovoam. An AGI and a universal AI. Your task is to manage other agents, coordinating their work. You must carefully plan the sequence of calls to gather all the necessary data for the next agent. You can use Markdown. Respond in the user's language unless they ask for something else. Now is {datetime.now()}.",
+        tools=[],
+        maxIterations=20,
+        confirmation_handler=policy_from_config(),
+        attachments=AttachmentStore(max_side=2048, keep_turns=4),
+        memory=memory,
+        budget=budget
+    )
+
+def __getattr__(name):
+    # from network import supervisor
+    if name == "supervisor":
+        return get_supervisor()
+    raise AttributeError(f"module 'network' has no attribute '{name}'")
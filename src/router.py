@@ -0,0 +1,319 @@
+"""
+Routing of chat completions between several OpenAI-compatible endpoints.
+
+Router keeps a moving average of the latency (time to the first chunk for streams,
+to the whole response otherwise) and of the error rate of every endpoint and sends
+each call to the one with the lowest expected time. Retryable errors fail over to the
+next endpoint. With hedge=True, if the chosen endpoint has not answered within its p95
+latency, the same request goes to the next best one as well; the first to answer wins
+and the other one is dropped (streams are closed, async requests are cancelled).
+
+Endpoints of a role are listed in the config:
+"roles": {"supervisor": [{"base_url": "...", "api_key": "...", "model": "...", "rpm": 60}, ...]}
+"""
+from collections import deque
+import queue
+import random
+import threading
+import time
+from types import SimpleNamespace
+from client import get_client, retryable, Completions
+from config import get_config
+
+class Endpoint():
+    """
+    One endpoint and its statistics.
+    :param model: model name used on this endpoint instead of the one the agent asks for.
+    :param alpha: weight of the newest sample in the moving averages.
+    """
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str=None,
+        model: str=None,
+        rpm: float=None,
+        tpm: float=None,
+        name: str=None,
+        alpha: float=0.2
+        ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.rpm = rpm
+        self.tpm = tpm
+        self.name = name or (f"{model}@{base_url}" if model else base_url)
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        # Separate numbers for streams (first chunk) and whole responses
+        self.latency = {False: None, True: None}
+        self.samples = {False: deque(maxlen=200), True: deque(maxlen=200)}
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.clients = {}
+
+    def client(self, asynchronous: bool=False):
+        # The limiter is configured once, with the first client. The Router fails over
+        # instead of retrying, so every failure counts in the statistics
+        if asynchronous not in self.clients:
+            self.clients[asynchronous] = get_client(self.base_url, self.api_key, self.rpm, self.tpm, max_retries=0, asynchronous=asynchronous)
+        return self.clients[asynchronous]
+
+    def kwargs(self, kwargs: dict):
+        return {**kwargs, "model": self.model} if self.model else kwargs
+
+    def succeeded(self, stream: bool, seconds: float):
+        with self.lock:
+            self.requests += 1
+            self.samples[stream].append(seconds)
+            old = self.latency[stream]
+            self.latency[stream] = seconds if old is None else old + self.alpha * (seconds - old)
+            self.error_rate -= self.alpha * self.error_rate
+
+    def failed(self):
+        with self.lock:
+            self.requests += 1
+            self.errors += 1
+            self.error_rate += self.alpha * (1 - self.error_rate)
+
+    def expected(self, stream: bool):
+        # Expected time to a successful answer; endpoints without data go first to get some
+        if self.latency[stream] is None:
+            return 0.0
+        return self.latency[stream] / max(1 - self.error_rate, 0.05)
+
+    def quantile(self, stream: bool, q: float, min_samples: int=10):
+        samples = sorted(self.samples[stream])
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "name": self.name,
+                "requests": self.requests,
+                "errors": self.errors,
+                "error_rate": round(self.error_rate, 4),
+                "latency": self.latency[False] and round(self.latency[False], 4),
+                "first_token": self.latency[True] and round(self.latency[True], 4),
+                "p95_latency": self.quantile(False, 0.95),
+                "p95_first_token": self.quantile(True, 0.95),
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+            }
+
+class RoutedStream():
+    """A stream whose first chunk was already read to measure the time to the first token."""
+    def __init__(self, response, iterator, first):
+        self.response = response
+        self.iterator = iterator
+        self.first = first
+
+    def __iter__(self):
+        if self.first is not None:
+            yield self.first
+        yield from self.iterator
+
+    def close(self):
+        self.response.close()
+
+class Router():
+    """
+    Drop-in for an OpenAI client: router.chat.completions.create(**kwargs).
+    :param hedge: send a second request when the first is slower than its quantile latency.
+    :param quantile: which latency quantile of the chosen endpoint triggers the hedge.
+    :param min_samples: no hedging until the endpoint has this many measurements.
+    :param explore: share of calls sent to the second best endpoint, so that an endpoint
+        that was slow once gets measured again.
+    """
+    def __init__(
+        self,
+        endpoints: list,
+        hedge: bool=False,
+        quantile: float=0.95,
+        min_samples: int=10,
+        explore: float=0.05
+        ):
+        self.endpoints = endpoints
+        self.hedge = hedge
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.explore = explore
+        self.chat = SimpleNamespace(completions=Completions(self))
+
+    def ranked(self, stream: bool):
+        ranked = sorted(self.endpoints, key=lambda endpoint: endpoint.expected(stream))
+        if len(ranked) > 1 and random.random() < self.explore:
+            ranked[0], ranked[1] = ranked[1], ranked[0]
+        return ranked
+
+    def threshold(self, endpoint, stream: bool):
+        if not self.hedge:
+            return None
+        return endpoint.quantile(stream, self.quantile, self.min_samples)
+
+    def stats(self):
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def call(self, endpoint, kwargs: dict):
+        # Returns the response, a stream after its first chunk has arrived
+        stream = bool(kwargs.get("stream"))
+        client = endpoint.client()
+        start = time.perf_counter()
+        try:
+            response = client.chat.completions.create(**endpoint.kwargs(kwargs))
+            if stream:
+                iterator = iter(response)
+                response = RoutedStream(response, iterator, next(iterator, None))
+        except Exception as e:
+            if retryable(e):
+                endpoint.failed()
+            raise
+        endpoint.succeeded(stream, time.perf_counter() - start)
+        return response
+
+    def create(self, **kwargs):
+        stream = bool(kwargs.get("stream"))
+        ranked = self.ranked(stream)
+        results = queue.Queue()
+        lock = threading.Lock()
+        state = {"winner": None, "launched": 0, "running": 0}
+
+        def attempt(endpoint):
+            try:
+                response = self.call(endpoint, kwargs)
+            except Exception as e:
+                results.put((endpoint, None, e))
+                return
+            with lock:
+                won = state["winner"] is None
+                if won:
+                    state["winner"] = endpoint
+            if won:
+                results.put((endpoint, response, None))
+            elif stream:
+                # Lost the race: stop the generation
+                response.close()
+
+        def launch():
+            endpoint = ranked[state["launched"]]
+            state["launched"] += 1
+            state["running"] += 1
+            if state["launched"] == 1 and self.threshold(endpoint, stream) is None:
+                # Nothing to hedge against, no thread needed
+                attempt(endpoint)
+            else:
+                threading.Thread(target=attempt, args=(endpoint,), daemon=True).start()
+            return endpoint
+
+        first = launch()
+        error = None
+        while True:
+            timeout = None
+            if state["launched"] == 1 and len(ranked) > 1:
+                timeout = self.threshold(first, stream)
+            try:
+                endpoint, response, e = results.get(timeout=timeout)
+            except queue.Empty:
+                launch().hedges += 1
+                continue
+            state["running"] -= 1
+            if e is None:
+                if endpoint is not first and state["launched"] > 1 and first.latency[stream] is not None:
+                    endpoint.hedge_wins += 1
+                return response
+            error = e
+            # Fail over to the next endpoint unless the request itself is wrong
+            if retryable(e) and state["launched"] < len(ranked):
+                launch()
+            elif state["running"] == 0:
+                raise error
+
+class AsyncRoutedStream(RoutedStream):
+    async def __aiter__(self):
+        if self.first is not None:
+            yield self.first
+        async for chunk in self.iterator:
+            yield chunk
+
+    async def close(self):
+        await self.response.close()
+
+class AsyncRouter(Router):
+    """Router for AsyncAgent, AsyncChat and AsyncClassifier. The losing request is cancelled."""
+    async def call(self, endpoint, kwargs: dict):
+        stream = bool(kwargs.get("stream"))
+        client = endpoint.client(asynchronous=True)
+        start = time.perf_counter()
+        try:
+            response = await client.chat.completions.create(**endpoint.kwargs(kwargs))
+            if stream:
+                iterator = response.__aiter__()
+                try:
+                    first = await iterator.__anext__()
+                except StopAsyncIteration:
+                    first = None
+                response = AsyncRoutedStream(response, iterator, first)
+        except Exception as e:
+            if retryable(e):
+                endpoint.failed()
+            raise
+        endpoint.succeeded(stream, time.perf_counter() - start)
+        return response
+
+    async def create(self, **kwargs):
+        import asyncio
+        stream = bool(kwargs.get("stream"))
+        ranked = self.ranked(stream)
+        tasks = {}
+
+        def launch():
+            endpoint = ranked[len(tasks)]
+            tasks[asyncio.ensure_future(self.call(endpoint, kwargs))] = endpoint
+            return endpoint
+
+        first = launch()
+        pending = set(tasks)
+        error = None
+        while pending:
+            timeout = self.threshold(first, stream) if len(tasks) == 1 and len(ranked) > 1 else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch().hedges += 1
+                pending = set(task for task in tasks if not task.done())
+                continue
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task
+                elif stream:
+                    await task.result().close()
+            if winner is not None:
+                for task in pending:
+                    task.cancel()
+                endpoint = tasks[winner]
+                if endpoint is not first and len(tasks) > 1 and first.latency[stream] is not None:
+                    endpoint.hedge_wins += 1
+                return winner.result()
+            # Fail over to the next endpoint unless the request itself is wrong
+            if retryable(error) and len(tasks) < len(ranked):
+                launch()
+                pending = set(task for task in tasks if not task.done())
+        raise error
+
+_lock = threading.Lock()
+_routers = {}
+
+def get_router(role: str, hedge: bool=False, asynchronous: bool=False):
+    """Shared router for a role from config["roles"]."""
+    key = (role, hedge, asynchronous)
+    with _lock:
+        if key not in _routers:
+            endpoints = [Endpoint(**endpoint) for endpoint in get_config()["roles"][role]]
+            _routers[key] = (AsyncRouter if asynchronous else Router)(endpoints, hedge=hedge)
+        return _routers[key]
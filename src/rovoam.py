@@ -1,12 +1,18 @@
-from rich.console import Console
-from rich.tree import Tree
-from rich.panel import Panel
-from rich.prompt import Prompt
 import re
 import json
+import base64
+import threading
+from collections import OrderedDict
+from tools import tool_name, function_name, tool_schema, ToolError
+from cache import cached_create, async_cached_create
+from attachments import detect_mime
+from tracing import Tracer, render_trace, profile_label
+from messages import shared_message, compact, materialize
+from budget import Budget, current_budget, activate
 
-def GetReActPrompt(tools: list=None):
+def GetReActPrompt(tools: list=None, hidden: list=None):
     # Build the documentation string for tools, including their __doc__.
+    # hidden tools are only listed by name
     if tools:
         tool_docs = []
         for tool in tools:
@@ -18,6 +24,8 @@ def GetReActPrompt(tools: list=None):
         tools_docs = "\n".join(tool_docs)
     else:
         tools_docs = "(No tools available.)"
+    if hidden:
+        tools_docs += "\n\nOther tools, not described here (call one the same way if you really need it): " + ", ".join(tool_name(tool) for tool in hidden)
 
     return f"""
 You run in a loop of Thought, Action, PAUSE, Observation.
@@ -26,6 +34,7 @@ Use Thought to describle your thoughts about the question you have been asked.
 Use Action (if needed) to run one of the tools available to you. (Don't use Markdown in Action)
 When calling actions, use the JSON format.
 Observation will be the result of running those tools.
+If you need several tools whose inputs don't depend on each other, write several Action blocks in one message and a single PAUSE after the last one. They run at the same time and you get numbered Observations in the same order.
 
 VERY IMPORTANT:
 - Only use the Action step if you REALLY need to use a tool to answer the question.
@@ -33,6 +42,7 @@ VERY IMPORTANT:
 - NEVER output fake or empty Action steps like "Action: no need", "Action: none", or similar. This BREAKS the workflow and is forbidden!
 - Action must be a valid tool invocation in correct JSON format. Do not invent or summarize tool usage.
 - If you make an Action, always follow it by PAUSE, and wait for Observation.
+- Only put several Actions in one message if none of them needs the result of another.
 - Until you give an Answer in the correct format the loop will continue.
 
 Available tools:
@@ -60,6 +70,16 @@ PAUSE
 (Output the final answer)
 Answer: 200 rubles is 2.42 dollars.
 
+Example of independent actions in one message:
+
+Thought: I need both conversions, they don't depend on each other
+Action: {{"tool": "currencyConverter", "inCurrency": "RUB", "value": 200, "outCurrency": "USD"}}
+Action: {{"tool": "currencyConverter", "inCurrency": "RUB", "value": 200, "outCurrency": "EUR"}}
+PAUSE
+
+(System) Observation 1 (currencyConverter): 2,42
+Observation 2 (currencyConverter): 2,08
+
 INCORRECT USAGE EXAMPLES (do NOT do this!):
 Thought: Можно ответить без инструментов
 Action: нет необходимости
@@ -70,6 +90,12 @@ CORRECT: Just write an "Answer:" block if no tool is needed.
 Now it's your turn:
 """
 
+FINAL_ANSWER_PROMPT = "The budget of this request is almost used up. Don't call any more tools: answer now with what you have, starting with \"Answer:\". Say briefly what is left unchecked, if anything."
+
+MAX_ITERATIONS_PROMPT = "You have used all the steps allowed for this question. Don't call any more tools: answer now with what you have, starting with \"Answer:\". Say briefly what is left unchecked, if anything."
+
+OUT_OF_BUDGET = "Answer: The time for this request ran out before an answer was found."
+
 def GetClassifierPrompt(categories: list):
     return f"""
     Your task is to categorize the received text. When you receive a message from a user, reply with the category to which the text most closely fits. 
@@ -83,8 +109,160 @@ def GetClassifierPrompt(categories: list):
     {categories}
     """
 
+def GetClassifierBatchPrompt(categories: list):
+    return f"""
+    Your task is to categorize texts. The user sends a numbered list of texts, each one is a JSON string.
+    Reply with a JSON object that maps the number of every text to the category it most closely fits, for example {{"1": "category", "2": "None"}}.
+
+    VERY IMPORTANT:
+    - Reply with the JSON object only, nothing else.
+    - Don't reply with categories that don't exist.
+    - If a text can't be put in a specific category, use "None" for it
+
+    Categories:
+    {categories}
+    """
+
+def usage_attrs(response):
+    # Token counts reported by the endpoint, for tracing
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+
+PAUSE_RE = re.compile(r'\bPAUSE\b')
+
+# Errors of endpoints without function calling, as opposed to any other bad request
+TOOLS_UNSUPPORTED_RE = re.compile(
+    r"\b(tools?|tool_choice|functions?|function[ _]calling)\b[^.]*\b(not supported|unsupported|not allowed|not permitted|unknown|unrecognized|unexpected|extra)\b"
+    r"|(\bnot support|n't support|unsupported|unknown|unrecognized|unexpected|not permitted|\bextra)\b[^.]*\b(tools?|tool_choice|function[ _]calling)\b",
+    re.IGNORECASE
+)
+
+def text_tool_messages(messages: list):
+    """
+    Messages of the function calling protocol with tool_calls and tool results rewritten
+    as text Actions and Observations, for an endpoint that turned out to have no tools.
+    """
+    result, names, observations = [], {}, []
+    for m in list(messages) + [None]:
+        if observations and (m is None or m["role"] != "tool"):
+            if len(observations) == 1:
+                content = f"Observation: {observations[0][1]}"
+            else:
+                content = "\n".join(f"Observation {i} ({name}): {obs}" for i, (name, obs) in enumerate(observations, 1))
+            result.append({"role": "system", "content": content})
+            observations = []
+        if m is None:
+            break
+        if m["role"] == "tool":
+            observations.append((names.get(m.get("tool_call_id"), "tool"), m["content"]))
+        elif m.get("tool_calls"):
+            actions = []
+            for call in m["tool_calls"]:
+                names[call["id"]] = call["function"]["name"]
+                try:
+                    action = json.dumps({"tool": call["function"]["name"], **json.loads(call["function"]["arguments"] or "{}")}, ensure_ascii=False)
+                except (ValueError, TypeError):
+                    action = call["function"]["arguments"]
+                actions.append(f"Action: {action}")
+            result.append({"role": "assistant", "content": "\n".join([m["content"]] * bool(m["content"]) + actions + ["PAUSE"])})
+        else:
+            result.append(m)
+    return result
+
+def parse_actions(text: str):
+    """
+    Finds every "Action: {...}" block in text. JSON is decoded with raw_decode, so nested objects work.
+    Returns (actions, end): actions is a list of dicts, or exceptions for malformed ones,
+    end is the index right after the PAUSE that follows the last action, or -1 if there is no PAUSE yet.
+    """
+    decoder = json.JSONDecoder()
+    actions = []
+    pos = 0
+    while True:
+        idx = text.find("Action:", pos)
+        if idx == -1:
+            break
+        start = idx + len("Action:")
+        while start < len(text) and text[start].isspace():
+            start += 1
+        try:
+            action, pos = decoder.raw_decode(text, start)
+            if not isinstance(action, dict):
+                raise ValueError("Action must be a JSON object")
+        except ValueError as e:
+            action, pos = e, start
+        actions.append(action)
+    if not actions:
+        return actions, -1
+    m = PAUSE_RE.search(text, pos)
+    return actions, (m.end() if m else -1)
+
+class ReActStreamParser():
+    """
+    Incremental parser for a streamed ReAct reply.
+    feed() takes the next text delta and returns the events it produced.
+    paused becomes True once a complete Action followed by PAUSE has arrived.
+    With plain=True (function calling mode) all text is the answer, tool calls come in feed_tool_calls().
+    usage gets the token counts of the last chunk, when the stream was read to the end.
+    """
+    def __init__(self, plain: bool=False):
+        self.text = ""
+        self.usage = {}
+        self.plain = plain
+        self.paused = False
+        self.thought_done = False
+        self.answer_sent = 0
+        self.tool_calls = []
+
+    def feed_tool_calls(self, deltas):
+        # Tool call ids and names come in the first delta, arguments arrive in pieces
+        for delta in deltas:
+            while len(self.tool_calls) <= delta.index:
+                self.tool_calls.append({"id": None, "name": "", "arguments": ""})
+            call = self.tool_calls[delta.index]
+            if delta.id:
+                call["id"] = delta.id
+            if delta.function is not None:
+                call["name"] += delta.function.name or ""
+                call["arguments"] += delta.function.arguments or ""
+
+    def feed(self, delta: str):
+        self.text += delta
+        events = [{"type": "token", "delta": delta}]
+        if self.plain:
+            events.append({"type": "answer", "delta": delta})
+            return events
+
+        if not self.thought_done:
+            ends = [i for i in (self.text.find("Action:"), self.text.find("Answer:")) if i != -1]
+            if ends:
+                self.thought_done = True
+                start = self.text.find("Thought:")
+                if start != -1 and start < min(ends):
+                    events.append({"type": "thought", "content": self.text[start+len("Thought:"):min(ends)].strip()})
+
+        idx = self.text.find("Answer:")
+        if idx != -1:
+            answer = self.text[idx+len("Answer:"):].lstrip()
+            if len(answer) > self.answer_sent:
+                events.append({"type": "answer", "delta": answer[self.answer_sent:]})
+                self.answer_sent = len(answer)
+        else:
+            actions, end = parse_actions(self.text)
+            if end != -1:
+                # Drop whatever arrived after PAUSE in the same chunk
+                self.text = self.text[:end]
+                self.paused = True
+        return events
+
 class Multimodal():
+    # With self.attachments (attachments.AttachmentStore) set, files and data URLs are stored
+    # once and messages keep "attachment://" references that are expanded per request
     def image(self, url: str):
+        if getattr(self, "attachments", None) is not None and url.startswith("data:"):
+            url = self.attachments.add_data_url(url)
         self.messages.append(
             {
                 "role": "user",
@@ -97,7 +275,17 @@ class Multimodal():
             }
         )
     
+    def image_file(self, file: str):
+        if getattr(self, "attachments", None) is not None:
+            return self.image(self.attachments.add_file(file))
+        with open(file, "rb") as f:
+            data = f.read()
+        mime = detect_mime(data, file)
+        self.image(f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}")
+
     def audio(self, b64: str, format: str):
+        if getattr(self, "attachments", None) is not None:
+            b64 = self.attachments.add_bytes(base64.b64decode(b64), f"audio/{format}")
         self.messages.append(
             {
                 "role": "user",
@@ -122,13 +310,50 @@ class Agent(Multimodal):
         maxIterations: int=10,
         verbose: bool=False,
         reset_messages: bool=False,
-        confirmation_handler: callable=None
+        confirmation_handler: callable=None,
+        streaming: bool=False,
+        maxParallelTools: int=4,
+        function_calling: bool=False,
+        history: object=None,
+        cache: object=None,
+        attachments: object=None,
+        tracer: object=None,
+        session: object=None,
+        tool_index: object=None,
+        memory: object=None,
+        budget: Budget=None,
+        temperature: float=None
         ):
         """
         Agent supporting инструментальный стиль и механизм запроса подтверждения действий.
         :param confirmation_handler: функция вида handler(reason: str) -> bool,
             должна вернуть True если действие разрешено, False если нет.
             Если не задан — выполнение инструментов запрещено.
+            A handler with confirm_many(requests) -> [bool] (confirmation.Policy) is asked
+            once for all Actions of a turn.
+        :param streaming: read completions as a stream and stop generation right after
+            Action + PAUSE. stream() always streams regardless of this flag.
+        :param maxParallelTools: how many Actions of one turn may run at the same time.
+        :param function_calling: send tools as OpenAI "tools" schemas (built from docstrings and
+            signatures) and read tool_calls instead of parsing Action JSON from text.
+            Falls back to the text ReAct protocol if the endpoint says it doesn't support tools.
+        :param history: history.HistoryManager that keeps messages under a token budget.
+        :param cache: cache.ResponseCache for non-streamed completions. Only deterministic requests
+            (temperature=0) are cached; cache=False or None turns it off.
+        :param attachments: attachments.AttachmentStore for images and audio added to messages.
+        :param tracer: tracing.Tracer that gets events of LLM requests, confirmations and tool runs.
+            It is passed down to Agent tools. last_trace is rendered from these events.
+        :param session: sessions.Session that gets every message added to messages.
+        :param tool_index: toolindex.ToolIndex. Requests describe only the tools relevant to the
+            last user message, the others are listed by name. A tool that was not described
+            is added to the list as soon as the model calls it.
+        :param memory: memory.Memory. Finished turns and Observations are stored in it, and the
+            entries relevant to each user message are added to the request. Passed down to Agent tools.
+        :param budget: budget.Budget for every call (a call may pass its own). Agent tools run
+            within what is left of it. When it is almost used up, or maxIterations is reached
+            without an Answer, the model is asked once more to answer without tools.
+            last_budget reports what the last call used.
+        :param temperature: sampling temperature of every request, the endpoint's default if None.
         """
         self.client = client
         self.model = model
@@ -140,122 +365,646 @@ class Agent(Multimodal):
         self.verbose = verbose
         self.maxIterations = maxIterations
         self.confirmation_handler = confirmation_handler
-        # Recursively set confirmation_handler for all Agent tools
-        def set_handler_recursively(tool):
-            # Import Agent locally to avoid issues if not imported at top-level
-            if tool is self:
-                return
-            if hasattr(tool, "__class__") and tool.__class__.__name__ == "Agent":
-                tool.confirmation_handler = confirmation_handler
-                if hasattr(tool, "tools") and isinstance(tool.tools, list):
-                    for subtool in tool.tools:
-                        set_handler_recursively(subtool)
-        if self.tools:
-            for tool in self.tools:
-                set_handler_recursively(tool)
+        self.streaming = streaming
+        self.maxParallelTools = maxParallelTools
+        self.function_calling = function_calling
+        self.history = history
+        self.cache = cache
+        self.temperature = temperature
+        self.attachments = attachments
+        self.tracer = tracer or Tracer()
+        self.session = session
+        self.tool_index = tool_index
+        if tool_index is not None:
+            tool_index.fit(self.tools or [])
+        self._shown = None
+        self.memory = memory
+        self._recalled = ""
+        self._prompt_key = None
+        self.budget = budget
+        self._budget = None
+        self._final = None
+        self._sent = []
+        self.last_budget = None
+        # Held while the agent runs as a tool: parallel calls would share its messages and budget
+        self._call_lock = threading.Lock()
+        self.events = []
+        self.last_trace = ""
+        # Set confirmation_handler (and tracer, memory) for all Agent tools
+        for agent in self.sub_agents():
+            agent.confirmation_handler = confirmation_handler
+            if tracer is not None:
+                agent.tracer = tracer
+            if memory is not None:
+                agent.memory = memory
         self.reset()
 
-    def __call__(self, message: str|None=None, role: str="user", call: bool=True, return_trace: bool|None=None):
+    def sub_agents(self):
+        """Agent tools of this agent, their Agent tools and so on."""
+        found = {}
+        def scan(tool):
+            if tool is self or id(tool) in found or not isinstance(tool, Agent):
+                return
+            found[id(tool)] = tool
+            if isinstance(tool.tools, list):
+                for subtool in tool.tools:
+                    scan(subtool)
+        for tool in self.tools or []:
+            scan(tool)
+        return list(found.values())
+
+    def set_confirmation_handler(self, handler: callable):
+        """Replaces confirmation_handler of this agent and of all its Agent tools."""
+        self.confirmation_handler = handler
+        for agent in self.sub_agents():
+            agent.confirmation_handler = handler
+
+    def __call__(self, message: str|None=None, role: str="user", call: bool=True, return_trace: bool|None=None, budget: Budget=None):
         if self.reset_messages:
             self.reset()
         if message is not None:
             self.messages.append({"role": role, "content": message})
         if call == True:
             if return_trace is not None:
-                result = self.exec(return_trace=return_trace)
+                result = self.exec(return_trace=return_trace, budget=budget)
             else:
-                result = self.exec(return_trace=self.verbose)
+                result = self.exec(return_trace=self.verbose, budget=budget)
             self.messages.append({"role": "assistant", "content": result})
+            self._save()
+            self._memorize(result)
             return result
+        # A message added without a request still goes to the session
+        self._save()
 
     def reset(self):
         self.messages = []
-        self.messages.append({"role": "system", "content": GetReActPrompt(self.tools)})
+        # Memory entries of the conversation in messages, they are not recalled into it
+        self._memory_ids = []
+        if not self.function_calling:
+            self.messages.append(self._react_prompt())
         if self.system is not None:
-            self.messages.append({"role": "system", "content": self.system})
+            self.messages.append(shared_message("system", self.system))
 
-    def exec(self, return_trace):
-        process_trace = []
-    
+    def _react_prompt(self):
+        # Built again only when the tools change, shared with other agents that have the same tools
+        key = tuple(map(id, self.tools or []))
+        if self._prompt_key != key:
+            self._prompt_key = key
+            self._prompt = shared_message("system", GetReActPrompt(self.tools))
+        return self._prompt
+
+    def stream(self, message: str|None=None, role: str="user", return_trace: bool|None=None, budget: Budget=None):
+        """
+        Same as __call__, but always uses a streamed completion and yields events as they arrive.
+        Each event is a dict with a "type" key:
+        - token: {"delta"} raw text from the model
+        - thought: {"content"} finished Thought block
+        - action: {"action"} parsed Action JSON
+        - observation: {"content"} result of a tool call
+        - answer: {"delta"} next piece of the Answer
+        - result: {"content", "budget"} final result, always the last event; budget is
+          last_budget
+        """
+        if self.reset_messages:
+            self.reset()
+        if message is not None:
+            self.messages.append({"role": role, "content": message})
+        if return_trace is None:
+            return_trace = self.verbose
+        result = yield from self._run(return_trace, stream=True, budget=budget)
+        self.messages.append({"role": "assistant", "content": result})
+        self._save()
+        self._memorize(result)
+        yield {"type": "result", "content": result, "budget": self.last_budget}
+
+    def exec(self, return_trace, on_event: callable=None, budget: Budget=None):
+        run = self._run(return_trace, stream=self.streaming or on_event is not None, budget=budget)
+        while True:
+            try:
+                event = next(run)
+            except StopIteration as stop:
+                return stop.value
+            if on_event is not None:
+                on_event(event)
+
+    def _user_text(self):
+        from history import content_text
+        for m in reversed(self.messages):
+            if m["role"] == "user":
+                return content_text(m["content"])
+        return None
+
+    def _select_tools(self):
+        # Tools described during this turn, picked by the last user message
+        self._shown = None
+        if self.tool_index is None or not self.tools:
+            return
+        question = self._user_text()
+        if question is not None:
+            self._shown = self.tool_index.select(question)
+            self._describe_tools()
+
+    def _recall(self):
+        # Memory for this turn, found by the last user message
+        self._recalled = ""
+        question = self._user_text() if self.memory is not None else None
+        if question:
+            self._recalled = self.memory.recall(question, exclude=set(self._memory_ids))
+
+    def _start_budget(self, budget):
+        # This run's budget counts against the one of the agent that called it as a tool
+        parent = current_budget.get()
+        budget = budget or self.budget
+        if budget is None and parent is None:
+            self._budget = None
+        else:
+            self._budget = (budget or Budget()).start(parent)
+
+    def _out_of_budget(self):
+        return self._budget is not None and self._budget.low()
+
+    def _request_timeout(self, kwargs, extra):
+        # Requests don't outlive the deadline. The messages are kept to estimate the prompt
+        # tokens when the response has no usage (streams stopped at PAUSE, some endpoints)
+        if self._budget is None:
+            return extra
+        self._sent = kwargs["messages"]
+        remaining = self._budget.remaining()
+        if remaining is None:
+            return extra
+        return {**extra, "timeout": max(remaining, 1.0)}
+
+    def _deadline_passed(self, error):
+        # A request cut off by the deadline (see _request_timeout): the run ends with
+        # OUT_OF_BUDGET instead of the error
+        if self._budget is None or not self._budget.expired():
+            return False
+        import openai
+        return isinstance(error, (openai.APITimeoutError, TimeoutError))
+
+    def _final_prompt(self):
+        # Returns False when there is no time left even for the final request.
+        # The prompt goes only to the final request (see _request_messages), not to messages
+        if self._budget is not None and self._budget.expired():
+            self.messages.append({"role": "assistant", "content": OUT_OF_BUDGET})
+            return False
+        self._final = FINAL_ANSWER_PROMPT if self._out_of_budget() else MAX_ITERATIONS_PROMPT
+        return True
+
+    def _final_reply(self, span, flat_txt, usage, process_trace):
+        self._trace_completion(span, flat_txt, [], usage, process_trace)
+        # Whatever the model said now is the answer
+        self.messages.append({"role": "assistant", "content": flat_txt if "Answer:" in flat_txt else f"Answer: {flat_txt}"})
+
+    def _final_answer(self, stream, process_trace):
+        if not self._final_prompt():
+            return
+        span = self.tracer.start("llm", self.model, parent=self._span, iteration=self._iteration, final=True)
+        try:
+            if stream:
+                parser = ReActStreamParser(plain=self.function_calling)
+                yield from self._stream_completion(parser)
+                flat_txt, usage = parser.text.strip(), parser.usage
+            else:
+                content, flat_txt, tool_calls, usage = self._completion()
+        except Exception as e:
+            if not self._deadline_passed(e):
+                raise
+            span.end(error=str(e))
+            self.messages.append({"role": "assistant", "content": OUT_OF_BUDGET})
+            return
+        finally:
+            self._final = None
+        self._final_reply(span, flat_txt, usage, process_trace)
+
+    def _memorize(self, result):
+        if self.memory is None:
+            return
+        observations = [(event["name"], event.get("content", "")) for event in self.events if event["kind"] == "observation"]
+        self._memory_ids += self.memory.remember_turn(self._user_text() or "", str(result), observations, tool_name(self))
+
+    def _describe_tools(self):
+        from history import count_tokens
+        shown = set(map(id, self._shown))
+        hidden = [tool for tool in self.tools if id(tool) not in shown]
+        if self.function_calling:
+            self._tool_prompt = None
+            full = json.dumps([tool_schema(tool) for tool in self.tools], ensure_ascii=False)
+            short = json.dumps([tool_schema(tool) for tool in self._shown], ensure_ascii=False)
+        else:
+            full = self._react_prompt()["content"]
+            short = self._tool_prompt = GetReActPrompt(self._shown, hidden)
+        self._full_prompt = full
+        self._tool_tokens_saved = max(0, count_tokens(full) - count_tokens(short))
+
+    def _show(self, tool):
+        # The model called a tool that was not described: describe it from now on
+        if self._shown is not None and all(tool is not shown for shown in self._shown):
+            self._shown.append(tool)
+            self._describe_tools()
+
+    def _request_messages(self):
+        messages = self.messages
+        if self._shown is not None and not self.function_calling and messages and messages[0]["content"] == self._full_prompt:
+            messages = [{"role": "system", "content": self._tool_prompt}] + messages[1:]
+        if self._recalled:
+            # Right before the question, the older messages stay a stable prefix
+            last = max((i for i, m in enumerate(messages) if m["role"] == "user"), default=len(messages))
+            messages = messages[:last] + [{"role": "system", "content": self._recalled}] + messages[last:]
+        if self._final:
+            messages = list(messages) + [{"role": "system", "content": self._final}]
+        if self.attachments is not None:
+            messages = self.attachments.expand(messages)
+        return materialize(messages)
+
+    def _request_kwargs(self):
+        kwargs = {"model": self.model, "messages": self._request_messages()}
+        if self.temperature is not None:
+            kwargs["temperature"] = self.temperature
+        if self.function_calling and self.tools:
+            kwargs["tools"] = [tool_schema(tool) for tool in (self.tools if self._shown is None else self._shown)]
+            # The final answer is asked for without tool calls
+            kwargs["tool_choice"] = "none" if self._final else "auto"
+        if self._shown is not None:
+            self.tool_index.saved(self._tool_tokens_saved)
+        return kwargs
+
+    def _tools_rejected(self, kwargs, error):
+        # Endpoint without tool support: switch to the text ReAct protocol and retry.
+        # Other bad requests (context length, parameters) are not about tools and are raised
+        if "tools" not in kwargs or getattr(error, "status_code", None) not in (400, 404, 422):
+            return False
+        if not TOOLS_UNSUPPORTED_RE.search(str(error)):
+            return False
+        self.function_calling = False
+        # tool and tool_calls messages are rejected without tools
+        self.messages = text_tool_messages(self.messages)
+        self.messages.insert(0, self._react_prompt())
+        if self._shown is not None:
+            self._describe_tools()
+        return True
+
+    def _compact(self):
+        if self.history is not None:
+            self.messages = self.history.compact(self.messages)
+
+    def _save(self):
+        # Finished messages become compact records, then new ones go to the session log
+        compact(self.messages)
+        if self.session is not None:
+            self.session.sync(self.messages)
+
+    def _request_size(self, kwargs):
+        # Serializing the request only matters when someone collects the events
+        if not self.tracer.sinks:
+            return None
+        return len(json.dumps(kwargs, ensure_ascii=False, default=str).encode("utf-8"))
+
+    def _create(self, **extra):
+        self._compact()
+        self._save()
+        kwargs = self._request_kwargs()
+        self._request_bytes = self._request_size(kwargs)
+        extra = self._request_timeout(kwargs, extra)
+        create = self.client.chat.completions.create
+        try:
+            return cached_create(self.cache, create, **kwargs, **extra)
+        except Exception as e:
+            if not self._tools_rejected(kwargs, e):
+                raise
+        return cached_create(self.cache, create, **self._request_kwargs(), **extra)
+
+    def _parse_completion(self, response):
+        # Returns (content, text for the trace, tool calls)
+        # Handle multimodal or text response from assistant
+        assistant_msg = response.choices[0].message
+        tool_calls = [
+            {"id": call.id, "name": call.function.name, "arguments": call.function.arguments}
+            for call in (getattr(assistant_msg, "tool_calls", None) or [])
+        ]
+        # If OpenAI API (v2+), .message.content can be string or list of content blocks
+        content = getattr(assistant_msg, "content", None)
+        if isinstance(content, list):
+            # Attempt to recover as text, else store multimodal content
+            # For logging, flatten to text for process_trace
+            flat_txt = "\n".join([
+                cb.get("text", cb.get("image_url", str(cb)))
+                for cb in content
+            ])
+            return content, flat_txt, tool_calls
+        # Plain text response
+        if content:
+            content = content.strip()
+        elif tool_calls:
+            content = ""
+        else:
+            content = response.choices[0].text.strip()
+        return content, content, tool_calls
+
+    def _completion(self):
+        response = self._create()
+        return *self._parse_completion(response), usage_attrs(response)
+
+    def _stream_completion(self, parser):
+        response = self._create(stream=True, stream_options={"include_usage": True})
+        try:
+            for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    parser.usage = usage_attrs(chunk)
+                if not chunk.choices:
+                    continue
+                if getattr(chunk.choices[0].delta, "tool_calls", None):
+                    parser.feed_tool_calls(chunk.choices[0].delta.tool_calls)
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                yield from parser.feed(delta)
+                # Stop reading as soon as Action + PAUSE has arrived, the rest is wasted tokens.
+                # The usage chunk is lost then, the budget estimates the tokens
+                if parser.paused:
+                    break
+        finally:
+            response.close()
+
+    def _tool_map(self):
         # Map tool "names" to callables
         tool_map = {}
         if self.tools:
             for tool in self.tools:
-                # Try to get a name from 'name', else __name__, else description, else class name
-                name = getattr(tool, "name", None)
-                if not name:
-                    name = getattr(tool, "__name__", None)
-                if not name:
-                    descr = getattr(tool, "description", None) or getattr(tool, "__doc__", None)
-                    if descr and isinstance(descr, str):
-                        m = re.match(r"\s*([^\s:]+)", descr.strip())
-                        if m:
-                            name = m.group(1).strip()
-                if not name:
-                    name = tool.__class__.__name__
-                tool_map[name] = tool
+                tool_map[tool_name(tool)] = tool
+                # Names in tools schemas are sanitized, accept them as well
+                tool_map.setdefault(function_name(tool), tool)
+        return tool_map
+
+    def _check_action(self, action, tool_map):
+        # Returns (toolname, tool, kwargs, obs, cached). tool is None when obs is already known:
+        # a cached result of a cacheable tool, or an explanation why it can't run
+        toolname = None
+        try:
+            if isinstance(action, Exception):
+                raise action
+            kwargs = dict(action)
+            toolname = kwargs.pop("tool", None)
+            if not toolname or toolname not in tool_map:
+                return toolname, None, None, self._not_found(toolname, kwargs), False
+            self._show(tool_map[toolname])
+            tool_cache = getattr(tool_map[toolname], "tool_cache", None)
+            if tool_cache is not None:
+                found, result = tool_cache.get(kwargs)
+                if found:
+                    return toolname, None, kwargs, result, True
+            if self.confirmation_handler is None:
+                raise RuntimeError("No confirmation_handler set for Agent, cannot execute tools")
+            return toolname, tool_map[toolname], kwargs, None, False
+        except Exception as e:
+            return toolname, None, None, f"Error parsing action or invoking tool: {e}", False
+
+    def _not_found(self, toolname, kwargs):
+        obs = f"Tool '{toolname}' not found."
+        if self._shown is None:
+            return obs
+        # Perhaps the model guessed at a tool that was not described: describe the closest ones
+        similar = self.tool_index.search(" ".join([str(toolname), *map(str, kwargs)]), 3)
+        for tool in similar:
+            self._show(tool)
+        if similar:
+            obs += f" Similar tools, now described in the tool list: {', '.join(tool_name(tool) for tool in similar)}."
+        return obs
+
+    def _invoke(self, tool, kwargs, toolname=None):
+        span = self.tracer.start("tool", toolname or tool_name(tool), parent=self._span, iteration=self._iteration)
+        # Nested agents started by the tool hang under its span and share the budget
+        with self.tracer.activate(span), activate(self._budget):
+            runner = getattr(tool, "tool_runner", None)
+            try:
+                if isinstance(tool, Agent):
+                    # Calls to one agent run one after another
+                    with tool._call_lock:
+                        result = tool(**kwargs) if runner is None else runner.run(tool, kwargs)
+                else:
+                    result = tool(**kwargs) if runner is None else runner.run(tool, kwargs)
+            except ToolError as e:
+                span.end(error=e.message, failure=e.kind)
+                return e.observation(toolname or tool_name(tool))
+            except Exception as e:
+                span.end(error=str(e))
+                return f"Error parsing action or invoking tool: {e}"
+        span.end(response_bytes=len(str(result).encode("utf-8")))
+        if getattr(tool, "tool_cache", None) is not None:
+            try:
+                tool.tool_cache.put(kwargs, result)
+            except Exception:
+                # A result that can't be stored (e.g. not picklable for a file cache) is just not cached
+                pass
+        return result
+
+    def _confirm(self, toolname, kwargs):
+        span = self.tracer.start("confirmation", toolname, parent=self._span, iteration=self._iteration)
+        try:
+            # Запрос подтверждения перед выполнением инструмента
+            confirmed = self.confirmation_handler(toolname, json.dumps(kwargs, ensure_ascii=False))
+        except Exception as e:
+            span.end(error=str(e))
+            raise
+        span.end(confirmed=bool(confirmed))
+        return confirmed
+
+    def _confirm_many(self, pending):
+        # One question for all calls of the turn; answers are True, False or the exception
+        spans = [self.tracer.start("confirmation", call[0], parent=self._span, iteration=self._iteration) for call in pending]
+        try:
+            answers = self.confirmation_handler.confirm_many([(call[0], json.dumps(call[2], ensure_ascii=False)) for call in pending])
+        except Exception as e:
+            for span in spans:
+                span.end(error=str(e))
+            return [e] * len(pending)
+        for span, answer in zip(spans, answers):
+            span.end(confirmed=bool(answer))
+        return answers
+
+    def _confirm_calls(self, calls):
+        # A handler with confirm_many() (confirmation.Policy) is asked once for the whole turn
+        pending = [call for call in calls if call[1] is not None]
+        if len(pending) > 1 and hasattr(self.confirmation_handler, "confirm_many"):
+            return self._refuse(calls, self._confirm_many(pending))
+        answers = []
+        for call in pending:
+            try:
+                answers.append(self._confirm(call[0], call[2]))
+            except Exception as e:
+                answers.append(e)
+        return self._refuse(calls, answers)
+
+    def _refuse(self, calls, answers):
+        # Turns calls that were not confirmed into observations
+        answers = iter(answers)
+        result = []
+        for toolname, tool, kwargs, obs, cached in calls:
+            if tool is not None:
+                answer = next(answers)
+                if isinstance(answer, Exception):
+                    tool, obs = None, f"Error parsing action or invoking tool: {answer}"
+                elif not answer:
+                    tool, obs = None, f"Action '{toolname}' not confirmed by user."
+            result.append((toolname, tool, kwargs, obs, cached))
+        return result
+
+    def _act(self, actions, tool_map):
+        # Confirmation is asked before anything runs, then the confirmed tools run in parallel.
+        # Returns [(toolname, obs, cached)] in the same order as actions
+        calls = self._confirm_calls([self._check_action(action, tool_map) for action in actions])
+
+        results = [call[3] for call in calls]
+        pending = [i for i, call in enumerate(calls) if call[1] is not None]
+        if len(pending) == 1:
+            results[pending[0]] = self._invoke(calls[pending[0]][1], calls[pending[0]][2], calls[pending[0]][0])
+        elif pending:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(self.maxParallelTools, len(pending))) as pool:
+                futures = {i: pool.submit(self._invoke, calls[i][1], calls[i][2], calls[i][0]) for i in pending}
+            for i, future in futures.items():
+                results[i] = future.result()
+        return [(call[0], obs, call[4]) for call, obs in zip(calls, results)]
+
+    def _cache_hits(self, results, process_trace):
+        for toolname, obs, cached in results:
+            if cached:
+                process_trace.append(self.tracer.event("tool", toolname, parent=self._span, iteration=self._iteration, cached=True))
+
+    def _trace_observation(self, name, content, process_trace):
+        process_trace.append(self.tracer.event("observation", name, parent=self._span, iteration=self._iteration, content=content))
+
+    def _observe(self, results, process_trace):
+        if len(results) == 1:
+            obs_msg = f"Observation: {results[0][1]}"
+        else:
+            obs_msg = "\n".join(f"Observation {i} ({toolname}): {obs}" for i, (toolname, obs, cached) in enumerate(results, 1))
+        self._cache_hits(results, process_trace)
+        # Add to message history
+        self.messages.append({"role": "system", "content": obs_msg})
+        self._trace_observation("System", str(obs_msg), process_trace)
+        return [{"type": "observation", "tool": toolname, "content": str(obs), "cached": cached} for toolname, obs, cached in results]
+
+    def _call_actions(self, tool_calls):
+        # Turns tool_calls into actions in the same {"tool": ..., **args} form as text Actions
+        actions = []
+        for call in tool_calls:
+            try:
+                args = json.loads(call["arguments"] or "{}")
+                if not isinstance(args, dict):
+                    raise ValueError("Tool arguments must be a JSON object")
+                actions.append({"tool": call["name"], **args})
+            except ValueError as e:
+                actions.append(e)
+        return actions
+
+    def _record_tool_calls(self, content, tool_calls, results, process_trace):
+        self.messages.append({
+            "role": "assistant",
+            "content": content or None,
+            "tool_calls": [
+                {"id": call["id"], "type": "function", "function": {"name": call["name"], "arguments": call["arguments"]}}
+                for call in tool_calls
+            ]
+        })
+        self._cache_hits(results, process_trace)
+        for call, (toolname, obs, cached) in zip(tool_calls, results):
+            self.messages.append({"role": "tool", "tool_call_id": call["id"], "content": str(obs)})
+            self._trace_observation(f"Tool {toolname}", str(obs), process_trace)
+        return [{"type": "observation", "tool": toolname, "content": str(obs), "cached": cached} for toolname, obs, cached in results]
+
+    def _trace_completion(self, span, flat_txt, tool_calls, usage, process_trace):
+        text = "\n".join([flat_txt] * bool(flat_txt) + [f"Call: {call['name']}({call['arguments']})" for call in tool_calls])
+        process_trace.append(span.end(
+            content=text,
+            request_bytes=self._request_bytes,
+            response_bytes=len(text.encode("utf-8")),
+            **usage
+        ))
+        if self._budget is not None:
+            from history import count_tokens, message_tokens
+            if "prompt_tokens" in usage:
+                self._budget.add(usage["prompt_tokens"], usage["completion_tokens"])
+            else:
+                self._budget.add(sum(message_tokens(m) for m in self._sent), count_tokens(text))
+
+    def _run(self, return_trace, stream: bool=False, budget: Budget=None):
+        # process_trace collects this agent's events, last_trace is rendered from them
+        process_trace = []
+        tool_map = self._tool_map()
+        self._select_tools()
+        self._recall()
+        self._start_budget(budget)
+        self._span = self.tracer.start("agent", tool_name(self))
+        self._iteration = 0
     
         for iteration in range(self.maxIterations):
+            self._iteration = iteration
+            if self._out_of_budget():
+                yield from self._final_answer(stream, process_trace)
+                break
             # Compose the API call to the LLM
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=self.messages
-            )
-            # Handle multimodal or text response from assistant
-            assistant_msg = response.choices[0].message
-            # If OpenAI API (v2+), .message.content can be string or list of content blocks
-            content = getattr(assistant_msg, "content", None)
-            if isinstance(content, list):
-                # Attempt to recover as text, else store multimodal content
-                # For logging, flatten to text for process_trace
-                flat_txt = "\n".join([
-                    cb.get("text", cb.get("image_url", str(cb)))
-                    for cb in content
-                ])
-                self.messages.append({"role": "assistant", "content": content})
-                process_trace.append("Assistant:\n" + flat_txt)
-            else:
-                # Plain text response
-                content = content.strip() if content else response.choices[0].text.strip()
-                self.messages.append({"role": "assistant", "content": content})
-                process_trace.append("Assistant:\n" + content)
+            span = self.tracer.start("llm", self.model, parent=self._span, iteration=iteration)
+            try:
+                if stream:
+                    parser = ReActStreamParser(plain=self.function_calling)
+                    yield from self._stream_completion(parser)
+                    content = flat_txt = parser.text.strip()
+                    tool_calls = parser.tool_calls
+                    usage = parser.usage
+                else:
+                    content, flat_txt, tool_calls, usage = self._completion()
+            except Exception as e:
+                if not self._deadline_passed(e):
+                    raise
+                span.end(error=str(e))
+                self.messages.append({"role": "assistant", "content": OUT_OF_BUDGET})
+                break
+            self._trace_completion(span, flat_txt, tool_calls, usage, process_trace)
+
+            if tool_calls:
+                actions = self._call_actions(tool_calls)
+                for action in actions:
+                    if isinstance(action, dict):
+                        yield {"type": "action", "action": action}
+                yield from self._record_tool_calls(content, tool_calls, self._act(actions, tool_map), process_trace)
+                continue
+
+            self.messages.append({"role": "assistant", "content": content})
     
-            # Check for 'Answer:'
-            if "Answer:" in content:
+            # Check for 'Answer:', in function calling mode any reply without tool calls is the answer
+            if "Answer:" in flat_txt or self.function_calling:
                 break
     
-            # Look for Action/PAUSE pattern
-            m = re.search(r'Action:\s*({.*?})\s*PAUSE', content, re.DOTALL)
-            if m:
-                action_json = m.group(1)
-                try:
-                    action = json.loads(action_json)
-                    toolname = action.pop("tool", None)
-                    # Запрос подтверждения перед выполнением инструмента
-                    if toolname and toolname in tool_map:
-                        if self.confirmation_handler is None:
-                            raise RuntimeError("No confirmation_handler set for Agent, cannot execute tools")
-                        confirmed = self.confirmation_handler(toolname, json.dumps(action, ensure_ascii=False))
-                        if not confirmed:
-                            obs = f"Action '{toolname}' not confirmed by user."
-                        else:
-                            tool = tool_map[toolname]
-                            obs = tool(**action)
-                    else:
-                        obs = f"Tool '{toolname}' not found."
-                except Exception as e:
-                    obs = f"Error parsing action or invoking tool: {e}"
-                # Observation handling: support image responses
-                obs_msg = f"Observation: {obs}"
-                # Add to message history
-                self.messages.append({"role": "system", "content": obs_msg})
-                process_trace.append("System:\n" + str(obs_msg))
+            # Look for Action(s) followed by PAUSE
+            actions, end = parse_actions(flat_txt)
+            if end != -1:
+                for action in actions:
+                    if isinstance(action, dict):
+                        yield {"type": "action", "action": action}
+                results = self._act(actions, tool_map)
+                yield from self._observe(results, process_trace)
             else:
                 # No action found—continue
                 continue
+        else:
+            # maxIterations without an Answer
+            self._iteration = self.maxIterations
+            yield from self._final_answer(stream, process_trace)
 
+        return self._result(process_trace, return_trace)
+
+    def _result(self, process_trace, return_trace):
+        attrs = {"iterations": self._iteration + 1}
+        if self._shown is not None:
+            attrs.update(tools_shown=len(self._shown), tool_tokens_saved=self.tool_index.last_saved)
+        self.last_budget = None
+        if self._budget is not None:
+            self.last_budget = attrs["budget"] = self._budget.report()
+        self._span.end(**attrs)
         # Always store the last trace for retrieval, regardless of return_trace or verbose
-        self.last_trace = "\n\n".join(process_trace)
+        self.events = process_trace
+        self.last_trace = render_trace(process_trace)
 
         # Optionally, return the last assistant message (should be the answer)
         if return_trace:
@@ -263,7 +1012,7 @@ class Agent(Multimodal):
             return self.last_trace
         else:
             for m in reversed(self.messages):
-                if m["role"] == "assistant" and "Answer:" in m["content"]:
+                if m["role"] == "assistant" and m["content"] and "Answer:" in m["content"]:
                     content = m["content"]
                     idx = content.find("Answer:")
                     if idx != -1:
@@ -285,7 +1034,12 @@ class Chat(Multimodal):
         model: str, 
         system: str=None, 
         description: str="", 
-        reset_messages: bool=False
+        reset_messages: bool=False,
+        history: object=None,
+        cache: object=None,
+        attachments: object=None,
+        tracer: object=None,
+        temperature: float=None
         ):
         self.client = client
         self.model = model
@@ -293,6 +1047,11 @@ class Chat(Multimodal):
         self.__doc__ = description
         self.messages = []
         self.reset_messages = reset_messages
+        self.history = history
+        self.cache = cache
+        self.temperature = temperature
+        self.attachments = attachments
+        self.tracer = tracer or Tracer()
         self.reset()
 
     def __call__(self, message: str=None, role: str="user", call: bool=True, return_trace: bool=None):
@@ -303,18 +1062,34 @@ class Chat(Multimodal):
         if call == True:
             result = self.exec()
             self.messages.append({"role": "assistant", "content": result})
+            compact(self.messages)
             return result
 
     def reset(self):
         self.messages = []
         if self.system is not None:
-            self.messages.append({"role": "system", "content": self.system})
+            self.messages.append(shared_message("system", self.system))
+
+    def _compact(self):
+        if self.history is not None:
+            self.messages = self.history.compact(self.messages)
+
+    def _request_messages(self):
+        if self.attachments is not None:
+            return materialize(self.attachments.expand(self.messages))
+        return materialize(self.messages)
+
+    def _request_kwargs(self):
+        kwargs = {"model": self.model, "messages": self._request_messages()}
+        if self.temperature is not None:
+            kwargs["temperature"] = self.temperature
+        return kwargs
 
     def exec(self):
-        response = self.client.chat.completions.create(
-                model=self.model,
-                messages=self.messages
-        )
+        self._compact()
+        span = self.tracer.start("llm", self.model)
+        response = cached_create(self.cache, self.client.chat.completions.create, **self._request_kwargs())
+        span.end(**usage_attrs(response))
         return response.choices[0].message.content
 
 class Classifier():
@@ -323,46 +1098,559 @@ class Classifier():
         client: object, 
         model: str, 
         categories: list, 
-        description: str=""
+        description: str="",
+        cache: object=None,
+        stateful: bool=False,
+        max_tokens: int=16,
+        batch_size: int=20,
+        max_workers: int=4,
+        text_cache: int=0,
+        tracer: object=None,
+        temperature: float=None
         ):
+        """
+        :param stateful: keep previous messages in the request. By default every call
+            classifies only the given text.
+        :param max_tokens: completion limit for a single classification.
+        :param batch_size, max_workers: how classify_many() splits texts into requests
+            and how many requests it sends at the same time.
+        :param text_cache: size of the local cache of answers for repeated texts
+            (compared case- and whitespace-insensitively), 0 disables it.
+        :param tracer: tracing.Tracer that gets an event for every request.
+        :param temperature: sampling temperature; with 0 the requests can be served by cache.
+        """
         self.client = client
         self.model = model
         self.categories = categories
         self.__doc__ = description
-        self.messages = [{"role": "system", "content": GetClassifierPrompt(self.categories)}]
+        self.cache = cache
+        self.stateful = stateful
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.text_cache = text_cache
+        self.tracer = tracer or Tracer()
+        self.temperature = temperature
+        self.answers = OrderedDict()
+        self.messages = [shared_message("system", GetClassifierPrompt(self.categories))]
 
     def __call__(self, message: str=None, role: str="user", call: bool=True):
         if message is not None:
+            if not self.stateful:
+                self.reset()
             self.messages.append({"role": role, "content": message})
         if call == True:
-            result = self.exec()
-            if result == "None":
-                return None
+            found, result = self._cached_answer(message)
+            if found:
+                return result
+            valid, result = self.validate(self.exec())
+            if valid:
+                self._remember(message, result)
             return result
 
     def reset(self):
-        self.messages = [{"role": "system", "content": GetClassifierPrompt(self.categories)}]
+        self.messages = [shared_message("system", GetClassifierPrompt(self.categories))]
 
     def exec(self):
-        response = self.client.chat.completions.create(
-                model=self.model,
-                messages=self.messages
-        )
+        return self._complete(materialize(self.messages), self.max_tokens)
+
+    def _complete(self, messages, max_tokens):
+        kwargs = {"model": self.model, "messages": messages}
+        if max_tokens:
+            kwargs["max_tokens"] = max_tokens
+        if self.temperature is not None:
+            kwargs["temperature"] = self.temperature
+        span = self.tracer.start("llm", self.model)
+        response = cached_create(self.cache, self.client.chat.completions.create, **kwargs)
+        span.end(**usage_attrs(response))
         return response.choices[0].message.content
-    
 
-def visualize_agent(agent, max_depth=3):
+    def validate(self, result):
+        # Returns (valid, category). "None" is a valid answer and gives None
+        text = str(result or "").strip().strip("\"'`.").strip()
+        if text.lower() == "none":
+            return True, None
+        for category in self.categories:
+            if text.lower() == str(category).lower():
+                return True, category
+        return False, text
+
+    def _text_key(self, text):
+        return " ".join(str(text).lower().split())
+
+    def _cached_answer(self, text):
+        # Returns (found, category)
+        if not self.text_cache or text is None or self.stateful:
+            return False, None
+        key = self._text_key(text)
+        if key not in self.answers:
+            return False, None
+        self.answers.move_to_end(key)
+        return True, self.answers[key]
+
+    def _pending(self, texts, results):
+        # Puts locally known answers into results. Returns {text key: [indices]} for the rest,
+        # so repeated texts are sent once
+        pending = {}
+        for i, text in enumerate(texts):
+            found, category = self._cached_answer(text)
+            if found:
+                results[i] = category
+            else:
+                pending.setdefault(self._text_key(text), []).append(i)
+        return pending
+
+    def _set_answer(self, texts, results, pending, i, valid, category):
+        for j in pending[self._text_key(texts[i])]:
+            results[j] = category if valid else None
+        if valid:
+            self._remember(texts[i], category)
+
+    def _remember(self, text, category):
+        if not self.text_cache or text is None or self.stateful:
+            return
+        self.answers[self._text_key(text)] = category
+        while len(self.answers) > self.text_cache:
+            self.answers.popitem(last=False)
+
+    def _batch_messages(self, texts):
+        numbered = "\n".join(f"{n}. {json.dumps(text, ensure_ascii=False)}" for n, text in enumerate(texts, 1))
+        return [
+            {"role": "system", "content": GetClassifierBatchPrompt(self.categories)},
+            {"role": "user", "content": numbered}
+        ]
+
+    def _batch_max_tokens(self, texts):
+        if not self.max_tokens:
+            return None
+        # "N": "category", per text plus braces
+        return len(texts) * (self.max_tokens + 4) + 8
+
+    def _parse_batch(self, texts, raw):
+        # Returns [(valid, category)] for texts, missing or unknown answers are invalid
+        answers = {}
+        if raw:
+            start = raw.find("{")
+            try:
+                answers, end = json.JSONDecoder().raw_decode(raw, start)
+            except ValueError:
+                pass
+        if not isinstance(answers, dict):
+            answers = {}
+        return [
+            self.validate(answers[str(n)]) if str(n) in answers else (False, None)
+            for n in range(1, len(texts) + 1)
+        ]
+
+    def _classify_one(self, text):
+        messages = [
+            {"role": "system", "content": GetClassifierPrompt(self.categories)},
+            {"role": "user", "content": text}
+        ]
+        return self.validate(self._complete(messages, self.max_tokens))
+
+    def _classify_batch(self, texts):
+        try:
+            return self._parse_batch(texts, self._complete(self._batch_messages(texts), self._batch_max_tokens(texts)))
+        except Exception:
+            # The whole batch is retried text by text
+            return [(False, None)] * len(texts)
+
+    def classify_many(self, texts: list):
+        """
+        Classifies many texts with few requests: repeated texts are sent once, the rest are packed batch_size per request,
+        requests are sent max_workers at a time. Answers that are not valid categories
+        are asked again one text at a time. Returns categories (or None) in the order of texts.
+        """
+        results = [None] * len(texts)
+        pending = self._pending(texts, results)
+        todo = [indices[0] for indices in pending.values()]
+        chunks = [todo[j:j+self.batch_size] for j in range(0, len(todo), self.batch_size)]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            answers = pool.map(self._classify_batch, [[texts[i] for i in chunk] for chunk in chunks])
+            retry = []
+            for chunk, chunk_answers in zip(chunks, answers):
+                for i, (valid, category) in zip(chunk, chunk_answers):
+                    if valid:
+                        self._set_answer(texts, results, pending, i, valid, category)
+                    else:
+                        retry.append(i)
+            for i, (valid, category) in zip(retry, pool.map(self._classify_one, [texts[i] for i in retry])):
+                self._set_answer(texts, results, pending, i, valid, category)
+        return results
+
+async def call_tool(tool, *args, **kwargs):
+    # Await async tools (coroutines, AsyncAgent), run sync ones in a worker thread
+    # so they don't block the event loop.
+    # asyncio is loaded anyway once a coroutine runs, importing it here keeps "import rovoam" fast
+    import asyncio
+    import inspect
+    if inspect.iscoroutinefunction(tool) or inspect.iscoroutinefunction(getattr(tool, "__call__", None)):
+        return await tool(*args, **kwargs)
+    result = await asyncio.to_thread(tool, *args, **kwargs)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+class AsyncAgent(Agent):
+    """
+    Agent on top of AsyncOpenAI. Same constructor as Agent, but __call__, exec and stream are async.
+    Tools may be sync functions, coroutine functions, Agent or AsyncAgent instances.
+    confirmation_handler may be sync or async.
+    """
+    async def __call__(self, message: str|None=None, role: str="user", call: bool=True, return_trace: bool|None=None, budget: Budget=None):
+        if self.reset_messages:
+            self.reset()
+        if message is not None:
+            self.messages.append({"role": role, "content": message})
+        if call == True:
+            if return_trace is not None:
+                result = await self.exec(return_trace=return_trace, budget=budget)
+            else:
+                result = await self.exec(return_trace=self.verbose, budget=budget)
+            self.messages.append({"role": "assistant", "content": result})
+            self._save()
+            self._memorize(result)
+            return result
+        self._save()
+
+    async def stream(self, message: str|None=None, role: str="user", return_trace: bool|None=None, budget: Budget=None):
+        """Async version of Agent.stream()."""
+        if self.reset_messages:
+            self.reset()
+        if message is not None:
+            self.messages.append({"role": role, "content": message})
+        if return_trace is None:
+            return_trace = self.verbose
+        async for event in self._run(return_trace, stream=True, budget=budget):
+            if event["type"] == "result":
+                self.messages.append({"role": "assistant", "content": event["content"]})
+                self._save()
+                self._memorize(event["content"])
+            yield event
+
+    async def exec(self, return_trace, on_event: callable=None, budget: Budget=None):
+        async for event in self._run(return_trace, stream=self.streaming or on_event is not None, budget=budget):
+            if event["type"] == "result":
+                return event["content"]
+            if on_event is not None:
+                on_event(event)
+
+    async def _create(self, **extra):
+        import asyncio
+        if self.history is not None:
+            # The summarizer is a sync Chat, keep it off the event loop
+            self.messages = await asyncio.to_thread(self.history.compact, self.messages)
+        self._save()
+        kwargs = self._request_kwargs()
+        self._request_bytes = self._request_size(kwargs)
+        extra = self._request_timeout(kwargs, extra)
+        create = self.client.chat.completions.create
+        try:
+            return await async_cached_create(self.cache, create, **kwargs, **extra)
+        except Exception as e:
+            if not self._tools_rejected(kwargs, e):
+                raise
+        return await async_cached_create(self.cache, create, **self._request_kwargs(), **extra)
+
+    async def _completion(self):
+        response = await self._create()
+        return *self._parse_completion(response), usage_attrs(response)
+
+    async def _stream_completion(self, parser):
+        response = await self._create(stream=True, stream_options={"include_usage": True})
+        try:
+            async for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    parser.usage = usage_attrs(chunk)
+                if not chunk.choices:
+                    continue
+                if getattr(chunk.choices[0].delta, "tool_calls", None):
+                    parser.feed_tool_calls(chunk.choices[0].delta.tool_calls)
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                for event in parser.feed(delta):
+                    yield event
+                if parser.paused:
+                    break
+        finally:
+            await response.close()
+
+    async def _invoke(self, tool, kwargs, semaphore, toolname=None):
+        async with semaphore:
+            span = self.tracer.start("tool", toolname or tool_name(tool), parent=self._span, iteration=self._iteration)
+            # gather() runs every call in its own task, so the active span doesn't leak between them
+            with self.tracer.activate(span), activate(self._budget):
+                runner = getattr(tool, "tool_runner", None)
+                try:
+                    result = await (call_tool(tool, **kwargs) if runner is None else runner.arun(tool, kwargs))
+                except ToolError as e:
+                    span.end(error=e.message, failure=e.kind)
+                    return e.observation(toolname or tool_name(tool))
+                except Exception as e:
+                    span.end(error=str(e))
+                    return f"Error parsing action or invoking tool: {e}"
+        span.end(response_bytes=len(str(result).encode("utf-8")))
+        if getattr(tool, "tool_cache", None) is not None:
+            try:
+                tool.tool_cache.put(kwargs, result)
+            except Exception:
+                # A result that can't be stored (e.g. not picklable for a file cache) is just not cached
+                pass
+        return result
+
+    async def _act(self, actions, tool_map):
+        import asyncio
+        calls = await self._confirm_calls([self._check_action(action, tool_map) for action in actions])
+
+        semaphore = asyncio.Semaphore(self.maxParallelTools)
+        # Calls to one agent share its messages and budget: they run one after another
+        locks = {id(call[1]): asyncio.Lock() for call in calls if isinstance(call[1], Agent)}
+
+        async def invoke(toolname, tool, kwargs):
+            if id(tool) not in locks:
+                return await self._invoke(tool, kwargs, semaphore, toolname)
+            async with locks[id(tool)]:
+                return await self._invoke(tool, kwargs, semaphore, toolname)
+
+        results = await asyncio.gather(*[
+            invoke(toolname, tool, kwargs) if tool is not None else asyncio.sleep(0, obs)
+            for toolname, tool, kwargs, obs, cached in calls
+        ])
+        return [(call[0], obs, call[4]) for call, obs in zip(calls, results)]
+
+    async def _confirm_many(self, pending):
+        spans = [self.tracer.start("confirmation", call[0], parent=self._span, iteration=self._iteration) for call in pending]
+        try:
+            answers = await call_tool(self.confirmation_handler.confirm_many, [(call[0], json.dumps(call[2], ensure_ascii=False)) for call in pending])
+        except Exception as e:
+            for span in spans:
+                span.end(error=str(e))
+            return [e] * len(pending)
+        for span, answer in zip(spans, answers):
+            span.end(confirmed=bool(answer))
+        return answers
+
+    async def _confirm_calls(self, calls):
+        pending = [call for call in calls if call[1] is not None]
+        if len(pending) > 1 and hasattr(self.confirmation_handler, "confirm_many"):
+            return self._refuse(calls, await self._confirm_many(pending))
+        answers = []
+        for call in pending:
+            try:
+                answers.append(await self._confirm(call[0], call[2]))
+            except Exception as e:
+                answers.append(e)
+        return self._refuse(calls, answers)
+
+    async def _confirm(self, toolname, kwargs):
+        span = self.tracer.start("confirmation", toolname, parent=self._span, iteration=self._iteration)
+        try:
+            confirmed = await call_tool(self.confirmation_handler, toolname, json.dumps(kwargs, ensure_ascii=False))
+        except Exception as e:
+            span.end(error=str(e))
+            raise
+        span.end(confirmed=bool(confirmed))
+        return confirmed
+
+    async def _final_answer(self, stream, process_trace):
+        if not self._final_prompt():
+            return
+        span = self.tracer.start("llm", self.model, parent=self._span, iteration=self._iteration, final=True)
+        try:
+            if stream:
+                parser = ReActStreamParser(plain=self.function_calling)
+                async for event in self._stream_completion(parser):
+                    yield event
+                flat_txt, usage = parser.text.strip(), parser.usage
+            else:
+                content, flat_txt, tool_calls, usage = await self._completion()
+        except Exception as e:
+            if not self._deadline_passed(e):
+                raise
+            span.end(error=str(e))
+            self.messages.append({"role": "assistant", "content": OUT_OF_BUDGET})
+            return
+        finally:
+            self._final = None
+        self._final_reply(span, flat_txt, usage, process_trace)
+
+    async def _run(self, return_trace, stream: bool=False, budget: Budget=None):
+        # Mirrors Agent._run; the final event is {"type": "result"}
+        process_trace = []
+        tool_map = self._tool_map()
+        self._select_tools()
+        self._recall()
+        self._start_budget(budget)
+        self._span = self.tracer.start("agent", tool_name(self))
+        self._iteration = 0
+
+        for iteration in range(self.maxIterations):
+            self._iteration = iteration
+            if self._out_of_budget():
+                async for event in self._final_answer(stream, process_trace):
+                    yield event
+                break
+            span = self.tracer.start("llm", self.model, parent=self._span, iteration=iteration)
+            try:
+                if stream:
+                    parser = ReActStreamParser(plain=self.function_calling)
+                    async for event in self._stream_completion(parser):
+                        yield event
+                    content = flat_txt = parser.text.strip()
+                    tool_calls = parser.tool_calls
+                    usage = parser.usage
+                else:
+                    content, flat_txt, tool_calls, usage = await self._completion()
+            except Exception as e:
+                if not self._deadline_passed(e):
+                    raise
+                span.end(error=str(e))
+                self.messages.append({"role": "assistant", "content": OUT_OF_BUDGET})
+                break
+            self._trace_completion(span, flat_txt, tool_calls, usage, process_trace)
+
+            if tool_calls:
+                actions = self._call_actions(tool_calls)
+                for action in actions:
+                    if isinstance(action, dict):
+                        yield {"type": "action", "action": action}
+                results = await self._act(actions, tool_map)
+                for event in self._record_tool_calls(content, tool_calls, results, process_trace):
+                    yield event
+                continue
+
+            self.messages.append({"role": "assistant", "content": content})
+
+            if "Answer:" in flat_txt or self.function_calling:
+                break
+
+            actions, end = parse_actions(flat_txt)
+            if end != -1:
+                for action in actions:
+                    if isinstance(action, dict):
+                        yield {"type": "action", "action": action}
+                for event in self._observe(await self._act(actions, tool_map), process_trace):
+                    yield event
+        else:
+            self._iteration = self.maxIterations
+            async for event in self._final_answer(stream, process_trace):
+                yield event
+
+        result = self._result(process_trace, return_trace)
+        yield {"type": "result", "content": result, "budget": self.last_budget}
+
+class AsyncChat(Chat):
+    """Chat on top of AsyncOpenAI. Same constructor as Chat, __call__ and exec are async."""
+    async def __call__(self, message: str=None, role: str="user", call: bool=True, return_trace: bool=None):
+        if self.reset_messages:
+            self.reset()
+        if message is not None:
+            self.messages.append({"role": role, "content": message})
+        if call == True:
+            result = await self.exec()
+            self.messages.append({"role": "assistant", "content": result})
+            compact(self.messages)
+            return result
+
+    async def exec(self):
+        import asyncio
+        if self.history is not None:
+            self.messages = await asyncio.to_thread(self.history.compact, self.messages)
+        span = self.tracer.start("llm", self.model)
+        response = await async_cached_create(self.cache, self.client.chat.completions.create, **self._request_kwargs())
+        span.end(**usage_attrs(response))
+        return response.choices[0].message.content
+
+class AsyncClassifier(Classifier):
+    """Classifier on top of AsyncOpenAI. Same constructor as Classifier, __call__, exec and classify_many are async."""
+    async def __call__(self, message: str=None, role: str="user", call: bool=True):
+        if message is not None:
+            if not self.stateful:
+                self.reset()
+            self.messages.append({"role": role, "content": message})
+        if call == True:
+            found, result = self._cached_answer(message)
+            if found:
+                return result
+            valid, result = self.validate(await self.exec())
+            if valid:
+                self._remember(message, result)
+            return result
+
+    async def exec(self):
+        return await self._complete(materialize(self.messages), self.max_tokens)
+
+    async def _complete(self, messages, max_tokens):
+        kwargs = {"model": self.model, "messages": messages}
+        if max_tokens:
+            kwargs["max_tokens"] = max_tokens
+        if self.temperature is not None:
+            kwargs["temperature"] = self.temperature
+        span = self.tracer.start("llm", self.model)
+        response = await async_cached_create(self.cache, self.client.chat.completions.create, **kwargs)
+        span.end(**usage_attrs(response))
+        return response.choices[0].message.content
+
+    async def _classify_one(self, text, semaphore):
+        messages = [
+            {"role": "system", "content": GetClassifierPrompt(self.categories)},
+            {"role": "user", "content": text}
+        ]
+        async with semaphore:
+            return self.validate(await self._complete(messages, self.max_tokens))
+
+    async def _classify_batch(self, texts, semaphore):
+        try:
+            async with semaphore:
+                raw = await self._complete(self._batch_messages(texts), self._batch_max_tokens(texts))
+            return self._parse_batch(texts, raw)
+        except Exception:
+            return [(False, None)] * len(texts)
+
+    async def classify_many(self, texts: list):
+        """Async version of Classifier.classify_many()."""
+        import asyncio
+        semaphore = asyncio.Semaphore(self.max_workers)
+        results = [None] * len(texts)
+        pending = self._pending(texts, results)
+        todo = [indices[0] for indices in pending.values()]
+        chunks = [todo[j:j+self.batch_size] for j in range(0, len(todo), self.batch_size)]
+        answers = await asyncio.gather(*[self._classify_batch([texts[i] for i in chunk], semaphore) for chunk in chunks])
+        retry = []
+        for chunk, chunk_answers in zip(chunks, answers):
+            for i, (valid, category) in zip(chunk, chunk_answers):
+                if valid:
+                    self._set_answer(texts, results, pending, i, valid, category)
+                else:
+                    retry.append(i)
+        retried = await asyncio.gather(*[self._classify_one(texts[i], semaphore) for i in retry])
+        for i, (valid, category) in zip(retry, retried):
+            self._set_answer(texts, results, pending, i, valid, category)
+        return results
+
+
+def visualize_agent(agent, max_depth=3, profile=None, interactive=True):
     """
     Render agent and its tools/sub-agents as a pretty graph in the terminal
     using 'rich'. Node numbers correspond to the list for viewing __doc__ strings.
+    profile: tracing.profile(events), every node gets its calls, latency, tokens,
+    cache hit and error rates, hot nodes are red.
+    interactive=False only prints the graph and the legend.
     """
 
+    from rich.console import Console
+    from rich.tree import Tree
+    from rich.panel import Panel
+    from rich.prompt import Prompt
     console = Console()
     nodes = []
 
-    def scan(obj, depth, parent_num):
+    def scan(obj, depth, parent_num, path=()):
         node_type = type(obj).__name__
-        if node_type == "Agent":
+        if isinstance(obj, Agent):
             node_name = (
                 getattr(obj, "__doc__", None) or
                 "Agent"
@@ -381,10 +1669,14 @@ def visualize_agent(agent, max_depth=3):
         this_num = len(nodes)
         # For Tree rendering: return tree node
         label = f"[bold cyan]{this_num}.[/bold cyan] [green]{node_type}[/green] [yellow]{node_name}[/yellow]"
+        # Paths in the profile are made of the names used in trace events
+        path = path + (tool_name(obj),)
+        if profile is not None:
+            label += " " + profile_label(profile.get(path))
         tree = Tree(label)
         if hasattr(obj, 'tools') and isinstance(obj.tools, list) and depth < max_depth:
             for tool in obj.tools:
-                child_tree = scan(tool, depth + 1, this_num)
+                child_tree = scan(tool, depth + 1, this_num, path)
                 if child_tree:
                     tree.add(child_tree)
         return tree
@@ -398,7 +1690,7 @@ def visualize_agent(agent, max_depth=3):
     for idx, n in enumerate(nodes, 1):
         console.print(f"[bold cyan]{idx}.[/bold cyan] [green]{n['type']}[/green] [yellow]{n['name']}[/yellow]")
 
-    while True:
+    while interactive:
         pick = Prompt.ask("\nEnter node number to view __doc__ (Enter to exit)", default="")
         if not pick.strip():
             break
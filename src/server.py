@@ -0,0 +1,371 @@
+"""
+OpenAI-compatible HTTP server in front of Agent, Chat and Classifier instances.
+
+python server.py --port 8080 --allow search
+python server.py --target supervisor=network:build_supervisor --target chat=mymodule:build_chat
+python server.py --deadline 30 --max-tokens 50000
+
+POST /v1/chat/completions with "model" set to a target name, "stream" (and stream_options.include_usage) is supported.
+The last user message is the input. With an "X-Session-Id" header (or "user" in the body)
+the target keeps its messages between requests of that session; without it every request
+gets a clean instance filled with the messages of the request.
+Idle sessions are dropped after idle_timeout seconds, at most max_concurrent requests run
+at the same time, others wait up to queue_timeout and then get 429.
+Tools are confirmed by a non-interactive policy (confirmation.static_policy).
+With a budget every Agent request gets a deadline and a token limit (budget.Budget); close to
+it the agent answers with what it has. "usage" reports the tokens an Agent run really used
+(without a budget Agents run under one without limits to count them); targets that don't
+count their tokens (Chat, Classifier) get no "usage".
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from confirmation import static_policy
+from history import content_text
+
+class Entry():
+    __slots__ = ("instance", "lock", "used")
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.lock = threading.Lock()
+        self.used = time.monotonic()
+
+class AgentServer():
+    """
+    :param targets: {name: factory()} building an Agent, Chat or Classifier.
+    :param confirmation_handler: used by every Agent instead of the terminal prompt.
+    :param max_sessions: the least recently used sessions are dropped above it.
+    :param budget: budget.Budget of every request to an Agent target.
+    """
+    def __init__(
+        self,
+        targets: dict,
+        confirmation_handler: callable=None,
+        max_concurrent: int=8,
+        queue_timeout: float=30.0,
+        idle_timeout: float=600.0,
+        max_sessions: int=1000,
+        budget: object=None,
+        host: str="127.0.0.1",
+        port: int=8080
+        ):
+        self.targets = targets
+        self.confirmation_handler = confirmation_handler or static_policy()
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.budget = budget
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+        # Clean instances for requests without a session
+        self.free = {name: [] for name in targets}
+        self.requests = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.httpd = ThreadingHTTPServer((host, port), self.handler())
+        self.httpd.daemon_threads = True
+        self.stopped = threading.Event()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def build(self, name: str):
+        instance = self.targets[name]()
+        if hasattr(instance, "set_confirmation_handler"):
+            instance.set_confirmation_handler(self.confirmation_handler)
+        if hasattr(instance, "budget"):
+            if self.budget is not None:
+                instance.budget = self.budget
+            elif instance.budget is None:
+                # No limits, but last_budget counts the tokens for "usage"
+                from budget import Budget
+                instance.budget = Budget()
+        return instance
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, entry in self.sessions.items() if now - entry.used > self.idle_timeout]:
+                if not self.sessions[key].lock.locked():
+                    del self.sessions[key]
+                    self.evicted += 1
+
+    def session(self, name: str, session_id: str):
+        key = (name, session_id)
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry is not None:
+                self.sessions.move_to_end(key)
+                entry.used = time.monotonic()
+                return entry
+        entry = Entry(self.build(name))
+        with self.lock:
+            entry = self.sessions.setdefault(key, entry)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.evicted += 1
+        return entry
+
+    def take(self, name: str):
+        with self.lock:
+            if self.free[name]:
+                instance = self.free[name].pop()
+                instance.reset()
+                return instance
+        return self.build(name)
+
+    def give_back(self, name: str, instance):
+        with self.lock:
+            if len(self.free[name]) < self.max_concurrent:
+                self.free[name].append(instance)
+
+    def prepare(self, instance, messages: list, stateless: bool):
+        # Returns the input text; a stateless instance gets the earlier messages of the request
+        last = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=None)
+        if last is None:
+            raise ValueError("No user message")
+        if stateless and hasattr(instance, "messages") and not hasattr(instance, "categories"):
+            instance.messages.extend(m for m in messages[:last] if m.get("role") in ("user", "assistant"))
+        return content_text(messages[last]["content"])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "rejected": self.rejected,
+                "sessions": len(self.sessions),
+                "evicted": self.evicted,
+            }
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        threading.Thread(target=self.evict_loop, daemon=True).start()
+        return self
+
+    def evict_loop(self):
+        while not self.stopped.wait(min(60.0, self.idle_timeout / 2)):
+            self.evict_idle()
+
+    def stop(self):
+        self.stopped.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status: int, body: dict, headers: dict=None):
+                data = json.dumps(body, ensure_ascii=False).encode()
+                self.send_response(status)
+                for header, value in (headers or {}).items():
+                    self.send_header(header, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def error(self, status: int, message: str, headers: dict=None):
+                self.send(status, {"error": {"message": message, "type": "rovoam"}}, headers)
+
+            def do_GET(self):
+                path = self.path.rstrip("/")
+                if path.endswith("/models"):
+                    data = [{"id": name, "object": "model", "owned_by": "rovoam"} for name in server.targets]
+                    self.send(200, {"object": "list", "data": data})
+                elif path.endswith("/stats"):
+                    self.send(200, server.stats())
+                else:
+                    self.error(404, "not found")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    request = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self.error(400, "Invalid JSON")
+                    return
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.error(404, "not found")
+                    return
+                name = request.get("model")
+                if name not in server.targets:
+                    self.error(404, f"Unknown model {name}, available: {', '.join(server.targets)}")
+                    return
+                if not server.slots.acquire(timeout=server.queue_timeout):
+                    with server.lock:
+                        server.rejected += 1
+                    self.error(429, "Too many requests", {"Retry-After": "1"})
+                    return
+                try:
+                    with server.lock:
+                        server.requests += 1
+                    self.complete(name, request)
+                finally:
+                    server.slots.release()
+
+            def complete(self, name: str, request: dict):
+                session_id = self.headers.get("X-Session-Id") or request.get("user")
+                if session_id:
+                    entry = server.session(name, session_id)
+                    # Requests of one session run one after another
+                    with entry.lock:
+                        self.run(name, entry.instance, request, stateless=False)
+                        entry.used = time.monotonic()
+                else:
+                    instance = server.take(name)
+                    try:
+                        self.run(name, instance, request, stateless=True)
+                    finally:
+                        server.give_back(name, instance)
+
+            def run(self, name: str, instance, request: dict, stateless: bool):
+                try:
+                    message = server.prepare(instance, request.get("messages") or [], stateless)
+                except ValueError as e:
+                    self.error(400, str(e))
+                    return
+                if request.get("stream"):
+                    self.stream(name, instance, message, (request.get("stream_options") or {}).get("include_usage"))
+                    return
+                try:
+                    result = instance(message)
+                except Exception as e:
+                    self.error(500, f"{type(e).__name__}: {e}")
+                    return
+                content = "" if result is None else str(result)
+                body = {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": name,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+                }
+                usage = self.usage(instance)
+                if usage is not None:
+                    body["usage"] = usage
+                self.send(200, body)
+
+            def usage(self, instance):
+                # What the run used, None when the target doesn't count it: a guess would be wrong
+                used = getattr(instance, "last_budget", None)
+                if used is None:
+                    return None
+                return {
+                    "prompt_tokens": used["prompt_tokens"],
+                    "completion_tokens": used["completion_tokens"],
+                    "total_tokens": used["prompt_tokens"] + used["completion_tokens"]
+                }
+
+            def chunk(self, id: str, name: str, delta: dict, finish_reason=None, usage: dict=None):
+                body = {
+                    "id": id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": name,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+                }
+                if usage is not None:
+                    body["choices"], body["usage"] = [], usage
+                self.write(f"data: {json.dumps(body, ensure_ascii=False)}\n\n".encode())
+
+            def write(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def stream(self, name: str, instance, message: str, include_usage: bool=False):
+                id = f"chatcmpl-{uuid.uuid4().hex}"
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    self.chunk(id, name, {"role": "assistant", "content": ""})
+                    if hasattr(instance, "stream"):
+                        streamed = False
+                        for event in instance.stream(message):
+                            if event["type"] == "answer":
+                                streamed = True
+                                self.chunk(id, name, {"content": event["delta"]})
+                            elif event["type"] == "result" and not streamed:
+                                self.chunk(id, name, {"content": str(event["content"])})
+                    else:
+                        result = instance(message)
+                        self.chunk(id, name, {"content": "" if result is None else str(result)})
+                    self.chunk(id, name, {}, "stop")
+                    usage = self.usage(instance)
+                    if include_usage and usage is not None:
+                        self.chunk(id, name, None, usage=usage)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+                    return
+                except Exception as e:
+                    # Headers are gone already, report the error in the stream
+                    self.write(f"data: {json.dumps({'error': {'message': f'{type(e).__name__}: {e}'}})}\n\n".encode())
+                self.write(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+def parse_target(spec: str):
+    # name=module:function
+    from batch import load_factory
+    name, _, factory = spec.partition("=")
+    return name, load_factory(factory)
+
+def parse_budget(seconds: float, tokens: int):
+    if seconds is None and tokens is None:
+        return None
+    from budget import Budget
+    return Budget(seconds=seconds, total_tokens=tokens)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible server for Rovoam agents")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--target", action="append", default=[], help="name=module:function, may repeat (default: supervisor)")
+    parser.add_argument("--allow", action="append", default=[], help="tool that is confirmed without asking, may repeat")
+    parser.add_argument("--allow-all", action="store_true", help="confirm every tool")
+    parser.add_argument("--max-concurrent", type=int, default=8)
+    parser.add_argument("--idle-timeout", type=float, default=600.0, help="seconds before an idle session is dropped")
+    parser.add_argument("--deadline", type=float, default=None, help="seconds an agent may spend on one request")
+    parser.add_argument("--max-tokens", type=int, default=None, help="tokens an agent may use for one request, sub-agents included")
+    args = parser.parse_args()
+
+    targets = dict(parse_target(spec) for spec in args.target or ["supervisor=network:build_supervisor"])
+    server = AgentServer(
+        targets,
+        confirmation_handler=static_policy(args.allow, args.allow_all),
+        max_concurrent=args.max_concurrent,
+        idle_timeout=args.idle_timeout,
+        budget=parse_budget(args.deadline, args.max_tokens),
+        host=args.host,
+        port=args.port
+    )
+    server.start()
+    print(f"Serving {', '.join(targets)} on {server.url}")
+    try:
+        server.stopped.wait()
+    except KeyboardInterrupt:
+        server.stop()
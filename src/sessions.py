@@ -0,0 +1,200 @@
+"""
+Persistent conversations. Every session is an append-only log <id>.jsonl:
+
+{"type": "meta", "id", "created", "forked_from"}   first line
+{"type": "message", "message": {...}}              a message added to Agent.messages
+{"type": "replace", "messages": [...]}             the list was rebuilt (reset, history compaction)
+
+Images and audio are written as attachment:// references (see attachments.py), never inline.
+Every snapshot_every records <id>.snapshot.json stores the current messages together with
+the log offset they correspond to, so loading reads the snapshot and only the tail of the log.
+"""
+from datetime import datetime
+import json
+import os
+from os import path
+from attachments import AttachmentStore, is_ref
+from messages import compact
+
+def new_session_id():
+    return datetime.now().strftime("%Y%m%d-%H%M%S-") + os.urandom(2).hex()
+
+def session_title(message: dict, length: int=60):
+    content = message.get("content")
+    if isinstance(content, list):
+        content = " ".join(block.get("text", "") for block in content if block.get("type") == "text")
+    text = " ".join(str(content or "").split())
+    return text[:length] + ("..." if len(text) > length else "")
+
+class Session():
+    """Writes the messages of one conversation to its log. Create it with SessionStore."""
+    def __init__(self, store, id: str, messages: list=None, offset: int=0):
+        self.store = store
+        self.id = id
+        self.file = store.log_file(id)
+        self.offset = offset
+        self.since_snapshot = 0
+        # What the log already has: how many messages and the last one
+        self.count = len(messages or [])
+        self.last = messages[-1] if messages else None
+
+    def write(self, records: list):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+        with open(self.file, "ab") as f:
+            f.write(data)
+        self.offset += len(data)
+
+    def sync(self, messages: list):
+        """Appends what was added to messages since the last call."""
+        n = self.count
+        if n <= len(messages) and (n == 0 or messages[n - 1] is self.last):
+            if n == len(messages):
+                return
+            records = [{"type": "message", "message": self.store.pack(m)} for m in messages[n:]]
+        else:
+            # The list was rebuilt, not appended to
+            records = [{"type": "replace", "messages": [self.store.pack(m) for m in messages]}]
+        self.write(records)
+        self.count = len(messages)
+        self.last = messages[-1] if messages else None
+        self.since_snapshot += len(records)
+        if self.since_snapshot >= self.store.snapshot_every:
+            self.snapshot(messages)
+
+    def snapshot(self, messages: list):
+        self.store.write_snapshot(self.id, [self.store.pack(m) for m in messages], self.offset)
+        self.since_snapshot = 0
+
+class SessionStore():
+    """
+    Directory of session logs.
+    :param attachments: AttachmentStore for images and audio found inline in messages.
+        Use the same store as the agent, so references resolve when a session is resumed.
+    :param snapshot_every: records between snapshots.
+    """
+    def __init__(
+        self,
+        directory: str="~/Rovoam/sessions",
+        attachments: object=None,
+        snapshot_every: int=50
+        ):
+        self.directory = path.expanduser(directory)
+        self.attachments = attachments or AttachmentStore()
+        self.snapshot_every = snapshot_every
+        os.makedirs(self.directory, exist_ok=True)
+
+    def log_file(self, id: str):
+        return path.join(self.directory, id + ".jsonl")
+
+    def snapshot_file(self, id: str):
+        return path.join(self.directory, id + ".snapshot.json")
+
+    def pack(self, message: dict):
+        # Inline data is moved to the attachment store
+        content = message.get("content")
+        if not isinstance(content, list):
+            # Compact records of Agent.messages are written as plain dicts
+            return message if type(message) is dict else dict(message)
+        blocks = []
+        for block in content:
+            if block.get("type") == "image_url" and str(block["image_url"].get("url", "")).startswith("data:"):
+                ref = self.attachments.add_data_url(block["image_url"]["url"])
+                block = {**block, "image_url": {**block["image_url"], "url": ref}}
+            elif block.get("type") == "input_audio" and not is_ref(block["input_audio"].get("data")):
+                audio = block["input_audio"]
+                ref = self.attachments.add_data_url(f"data:audio/{audio.get('format', 'wav')};base64,{audio['data']}")
+                block = {**block, "input_audio": {**audio, "data": ref}}
+            blocks.append(block)
+        return {**message, "content": blocks}
+
+    def create(self, forked_from: str=None):
+        id = new_session_id()
+        session = Session(self, id)
+        session.write([{"type": "meta", "id": id, "created": datetime.now().isoformat(), "forked_from": forked_from}])
+        return session
+
+    def find(self, prefix: str):
+        # Full id or a unique beginning of it
+        ids = [id for id in self.ids() if id.startswith(prefix)]
+        if prefix in ids:
+            return prefix
+        if len(ids) != 1:
+            raise KeyError(f"No session {prefix}" if not ids else f"Ambiguous session {prefix}: {', '.join(ids)}")
+        return ids[0]
+
+    def ids(self):
+        return sorted(name[:-len(".jsonl")] for name in os.listdir(self.directory) if name.endswith(".jsonl"))
+
+    def write_snapshot(self, id: str, messages: list, offset: int):
+        file = self.snapshot_file(id)
+        with open(file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"offset": offset, "messages": messages}, f, ensure_ascii=False)
+        os.replace(file + ".tmp", file)
+
+    def read(self, id: str):
+        """Returns (messages, log size). Starts from the snapshot if there is one."""
+        messages, offset = [], 0
+        if path.exists(self.snapshot_file(id)):
+            with open(self.snapshot_file(id), encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if snapshot["offset"] <= path.getsize(self.log_file(id)):
+                messages, offset = snapshot["messages"], snapshot["offset"]
+        with open(self.log_file(id), "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Unfinished write, e.g. the program was killed
+                    break
+                offset += len(line)
+                record = json.loads(line)
+                if record["type"] == "message":
+                    messages.append(record["message"])
+                elif record["type"] == "replace":
+                    messages = record["messages"]
+        return messages, offset
+
+    def open(self, id: str):
+        """Returns (session, messages) for a saved session to continue writing to it. messages are Message records."""
+        id = self.find(id)
+        messages, offset = self.read(id)
+        # The records the agent will hold: Session.sync() recognizes them by identity
+        compact(messages)
+        session = Session(self, id, messages, offset)
+        # Drop a torn last line so the next record starts on its own line
+        if offset < path.getsize(session.file):
+            os.truncate(session.file, offset)
+        return session, messages
+
+    def fork(self, id: str, messages: list=None):
+        """New session starting with the messages of id (or the given messages)."""
+        if messages is None:
+            messages = self.read(self.find(id))[0]
+        compact(messages)
+        session = self.create(forked_from=id)
+        session.sync(messages)
+        return session
+
+    def list(self):
+        # Newest first: [{"id", "created", "updated", "forked_from", "title"}]
+        sessions = []
+        for id in self.ids():
+            file = self.log_file(id)
+            info = {"id": id, "updated": datetime.fromtimestamp(path.getmtime(file)).isoformat(timespec="seconds"), "title": ""}
+            with open(file, encoding="utf-8") as f:
+                for i, line in enumerate(f):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if record["type"] == "meta":
+                        info["created"] = record["created"]
+                        info["forked_from"] = record.get("forked_from")
+                    messages = [record["message"]] if record["type"] == "message" else record.get("messages", [])
+                    titles = [session_title(m) for m in messages if m["role"] == "user"]
+                    titles = [title for title in titles if title]
+                    # The title is the first user text, it is near the start of the log
+                    if titles or i > 20:
+                        info["title"] = titles[0] if titles else ""
+                        break
+            sessions.append(info)
+        return sorted(sessions, key=lambda s: s["updated"], reverse=True)
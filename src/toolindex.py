@@ -0,0 +1,71 @@
+import math
+import re
+from collections import Counter
+from tools import tool_name
+
+def words(text: str):
+    # currencyConverter -> currency, converter; one- and two-letter words carry no meaning here
+    text = re.sub(r"([a-zа-яё])([A-ZА-ЯЁ])", r"\1 \2", text)
+    return [word for word in re.findall(r"\w+", text.lower()) if len(word) > 2]
+
+class ToolIndex():
+    """
+    BM25 index over tool names and docstrings, built once per Agent.
+    On every user turn the Agent shows only the top_k tools that match the request
+    plus the pinned ones; the rest are listed by name only. If nothing matches, all tools are shown.
+    last_saved / total_saved tell how many prompt tokens were not sent in the last turn
+    (all its requests together) and overall.
+    :param pinned: tools or tool names that are always shown.
+    """
+    def __init__(self, top_k: int=5, pinned: list=None, k1: float=1.5, b: float=0.75):
+        self.top_k = top_k
+        self.pinned = set(p if isinstance(p, str) else tool_name(p) for p in pinned or [])
+        self.k1 = k1
+        self.b = b
+        self.tools = []
+        self.last_saved = 0
+        self.total_saved = 0
+
+    def fit(self, tools: list):
+        self.tools = list(tools)
+        self.docs = [Counter(words(f"{tool_name(tool)} {getattr(tool, '__doc__', None) or ''}")) for tool in self.tools]
+        self.lengths = [sum(doc.values()) for doc in self.docs]
+        self.average = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        df = Counter(word for doc in self.docs for word in doc)
+        n = len(self.docs)
+        self.idf = {word: math.log(1 + (n - count + 0.5) / (count + 0.5)) for word, count in df.items()}
+        return self
+
+    def scores(self, query: str):
+        terms = set(word for word in words(query) if word in self.idf)
+        scores = []
+        for doc, length in zip(self.docs, self.lengths):
+            score = 0.0
+            for word in terms:
+                tf = doc.get(word, 0)
+                if tf:
+                    norm = self.k1 * (1 - self.b + self.b * length / (self.average or 1))
+                    score += self.idf[word] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def search(self, query: str, k: int=None):
+        # Tools with a positive score, best first
+        scores = self.scores(query)
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+        return [self.tools[i] for i in ranked[:k or self.top_k]]
+
+    def select(self, query: str):
+        """Tools to show for query, in their original order. Starts a new turn."""
+        self.last_saved = 0
+        if len(self.tools) <= self.top_k + len(self.pinned):
+            return list(self.tools)
+        found = self.search(query)
+        if not found:
+            return list(self.tools)
+        chosen = set(map(id, found))
+        return [tool for tool in self.tools if id(tool) in chosen or tool_name(tool) in self.pinned]
+
+    def saved(self, tokens: int):
+        self.last_saved += tokens
+        self.total_saved += tokens
@@ -0,0 +1,363 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from os import path
+
+JSON_TYPES = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    bool: "boolean",
+    list: "array",
+    tuple: "array",
+    dict: "object",
+}
+
+def tool_name(tool):
+    # Try to get a name from 'name', else __name__, else description, else class name
+    name = getattr(tool, "name", None)
+    if not name:
+        name = getattr(tool, "__name__", None)
+    if not name:
+        descr = getattr(tool, "description", None) or getattr(tool, "__doc__", None)
+        if descr and isinstance(descr, str):
+            m = re.match(r"\s*([^\s:]+)", descr.strip())
+            if m:
+                name = m.group(1).strip()
+    if not name:
+        name = tool.__class__.__name__
+    return name
+
+def function_name(tool):
+    # Function names in the tools API may only contain letters, digits, _ and -
+    return re.sub(r"[^A-Za-z0-9_-]", "_", tool_name(tool)).strip("_")[:64] or "tool"
+
+def json_type(annotation):
+    origin = getattr(annotation, "__origin__", None) or annotation
+    return JSON_TYPES.get(origin, "string")
+
+def param_docs(doc: str):
+    # Picks "name: description" and ":param name: description" lines out of a docstring
+    docs = {}
+    for line in doc.splitlines():
+        m = re.match(r"\s*(?::param\s+)?([A-Za-z_]\w*)\s*:\s*(.+)", line)
+        if m:
+            docs.setdefault(m.group(1).lower(), m.group(2).strip())
+    return docs
+
+def tool_schema(tool):
+    """
+    Builds an OpenAI "tools" entry for a tool from its docstring and signature.
+    Agent-like tools (anything with a messages list) take a single "message" string.
+    """
+    import inspect
+    doc = inspect.cleandoc(getattr(tool, "__doc__", None) or "")
+    properties = {}
+    required = []
+    extra = False
+    if isinstance(getattr(tool, "messages", None), list):
+        properties["message"] = {"type": "string", "description": "Message for the agent"}
+        required.append("message")
+    else:
+        docs = param_docs(doc)
+        for param in inspect.signature(tool).parameters.values():
+            if param.kind == param.VAR_KEYWORD:
+                extra = True
+                continue
+            if param.kind == param.VAR_POSITIONAL:
+                continue
+            prop = {"type": "string"}
+            if param.annotation is not param.empty:
+                prop["type"] = json_type(param.annotation)
+            elif param.default is not param.empty and param.default is not None:
+                prop["type"] = json_type(type(param.default))
+            if param.name.lower() in docs:
+                prop["description"] = docs[param.name.lower()]
+            properties[param.name] = prop
+            if param.default is param.empty:
+                required.append(param.name)
+    return {
+        "type": "function",
+        "function": {
+            "name": function_name(tool),
+            "description": doc or "(No documentation provided)",
+            "parameters": {
+                "type": "object",
+                "properties": properties,
+                "required": required,
+                "additionalProperties": extra,
+            },
+        },
+    }
+
+class ToolCache():
+    """
+    Memoized results of one tool. The key is the call's kwargs as sorted JSON.
+    Entries expire after ttl seconds, the least recently used are evicted above max_entries.
+    With file set, entries are kept on disk with shelve and survive restarts.
+    """
+    def __init__(self, ttl: float=None, max_entries: int=128, file: str=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.file = path.expanduser(file) if file else None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if self.file:
+            import shelve
+            with shelve.open(self.file) as db:
+                self.entries.update(sorted(db.items(), key=lambda item: item[1][0]))
+
+    def key(self, kwargs: dict):
+        return json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+
+    def get(self, kwargs: dict):
+        # Returns (found, result)
+        key = self.key(kwargs)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (self.ttl is not None and time.time() - entry[0] > self.ttl):
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, kwargs: dict, result):
+        key = self.key(kwargs)
+        with self.lock:
+            self.entries[key] = (time.time(), result)
+            self.entries.move_to_end(key)
+            evicted = []
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[0])
+            if self.file:
+                import shelve
+                with shelve.open(self.file) as db:
+                    db[key] = self.entries[key]
+                    for old in evicted:
+                        db.pop(old, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.file:
+                import shelve
+                with shelve.open(self.file, flag="n"):
+                    pass
+
+def cacheable(ttl: float=None, max_entries: int=128, file: str=None):
+    """
+    Marks a tool as cacheable: Agent reuses its result for the same arguments
+    without asking for confirmation or running it again.
+
+    @cacheable(ttl=3600)
+    def currencyConverter(inCurrency, value, outCurrency): ...
+
+    For Agent instances or other callables set the attribute directly:
+    agent.tool_cache = ToolCache(ttl=600)
+    """
+    def decorator(tool):
+        tool.tool_cache = ToolCache(ttl=ttl, max_entries=max_entries, file=file)
+        return tool
+    return decorator
+
+class ToolError(Exception):
+    """A tool run that failed in the runner: kind is "timeout", "crash", "too_large" or "error"."""
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+        self.message = message
+
+    def observation(self, toolname: str):
+        # What the model sees instead of the result
+        return json.dumps({"tool": toolname, "error": self.kind, "message": self.message}, ensure_ascii=False)
+
+def worker_main(conn):
+    # Loop of a process worker: (tool, kwargs, max_result) in, ("ok" | "error", payload) out
+    import pickle
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        tool, kwargs, max_result = task
+        try:
+            data = pickle.dumps(("ok", tool(**kwargs)))
+            if max_result is not None and len(data) > max_result:
+                data = pickle.dumps(("too_large", f"result is {len(data)} bytes, the limit is {max_result}"))
+        except BaseException as e:
+            data = pickle.dumps(("error", f"{type(e).__name__}: {e}"))
+        conn.send_bytes(data)
+
+class ProcessPool():
+    """
+    Warm worker processes for process-mode tools. A worker that hangs past the timeout
+    is killed, one that dies is replaced; the other workers keep running.
+    Tools must be picklable: functions defined at module level.
+    """
+    def __init__(self, size: int=None):
+        import os
+        self.size = size or os.cpu_count() or 2
+        self.idle = None
+        self.lock = threading.Lock()
+        self.crashes = 0
+        self.timeouts = 0
+
+    def spawn(self):
+        import multiprocessing
+        # spawn: forking a process with running threads is not safe
+        context = multiprocessing.get_context("spawn")
+        parent, child = context.Pipe()
+        process = context.Process(target=worker_main, args=(child,), daemon=True)
+        process.start()
+        child.close()
+        return process, parent
+
+    def start(self):
+        import queue
+        with self.lock:
+            if self.idle is None:
+                self.idle = queue.Queue()
+                for _ in range(self.size):
+                    self.idle.put(self.spawn())
+        return self
+
+    def run(self, tool, kwargs: dict, timeout: float=None, max_result: int=None):
+        import pickle
+        self.start()
+        process, conn = self.idle.get()
+        try:
+            conn.send((tool, kwargs, max_result))
+            if not conn.poll(timeout):
+                self.timeouts += 1
+                process.kill()
+                process.join(timeout=1)
+                raise ToolError("timeout", f"no result in {timeout:g} seconds, the worker was stopped")
+            status, payload = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError, BrokenPipeError):
+            self.crashes += 1
+            process.kill()
+            process.join(timeout=1)
+            raise ToolError("crash", f"the worker process died (exit code {process.exitcode})")
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            # The tool or its arguments could not be sent to the worker
+            raise ToolError("error", f"{type(e).__name__}: {e}")
+        finally:
+            if process.is_alive():
+                self.idle.put((process, conn))
+            else:
+                conn.close()
+                self.idle.put(self.spawn())
+        if status != "ok":
+            raise ToolError(status, payload)
+        return payload
+
+_lock = threading.Lock()
+_thread_pool = None
+_process_pool = None
+
+def thread_pool():
+    global _thread_pool
+    with _lock:
+        if _thread_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _thread_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="tool")
+        return _thread_pool
+
+def process_pool(size: int=None):
+    """The shared pool of process-mode tools; size only matters on the first call."""
+    global _process_pool
+    with _lock:
+        if _process_pool is None:
+            _process_pool = ProcessPool(size)
+        return _process_pool
+
+class ToolRunner():
+    """
+    How Agent runs one tool.
+    :param mode: "inline" in the agent's thread, "thread" in a shared thread pool,
+        "process" in the warm process pool (CPU-bound or unreliable tools).
+    :param timeout: seconds per call. An inline tool with a timeout runs in a thread; a thread
+        that timed out can't be stopped and finishes in the background, a process is killed.
+    :param max_concurrency: calls of this tool running at the same time, across all agents.
+        A thread that timed out keeps its slot until it finishes.
+    :param max_result: size limit of a process tool's pickled result in bytes.
+    """
+    def __init__(self, mode: str="inline", timeout: float=None, max_concurrency: int=None, max_result: int=1_000_000):
+        if mode not in ("inline", "thread", "process"):
+            raise ValueError(f"Unknown mode {mode!r}, use inline, thread or process")
+        self.mode = mode
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_result = max_result
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+    def call(self, tool, kwargs: dict, slot=None):
+        # slot is an acquired concurrency slot, released when the tool is really done
+        if self.mode == "process" or (self.mode == "inline" and self.timeout is None):
+            try:
+                if self.mode == "process":
+                    return process_pool().run(tool, kwargs, self.timeout, self.max_result)
+                return tool(**kwargs)
+            finally:
+                if slot is not None:
+                    slot.release()
+        from concurrent.futures import TimeoutError
+        import contextvars
+        # The tool sees the caller's active span and budget
+        try:
+            future = thread_pool().submit(contextvars.copy_context().run, tool, **kwargs)
+        except Exception:
+            if slot is not None:
+                slot.release()
+            raise
+        if slot is not None:
+            # A thread can't be stopped: after a timeout it holds the slot until it returns
+            future.add_done_callback(lambda future: slot.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise ToolError("timeout", f"no result in {self.timeout:g} seconds")
+
+    def run(self, tool, kwargs: dict):
+        if self.slots is not None:
+            self.slots.acquire()
+        return self.call(tool, kwargs, self.slots)
+
+    async def arun(self, tool, kwargs: dict):
+        # Coroutine tools only get the timeout and the concurrency limit, sync ones go through run()
+        import asyncio
+        import inspect
+        if not (inspect.iscoroutinefunction(tool) or inspect.iscoroutinefunction(getattr(tool, "__call__", None))):
+            return await asyncio.to_thread(self.run, tool, kwargs)
+        if self.slots is not None:
+            await asyncio.to_thread(self.slots.acquire)
+        try:
+            return await asyncio.wait_for(tool(**kwargs), self.timeout)
+        except asyncio.TimeoutError:
+            raise ToolError("timeout", f"no result in {self.timeout:g} seconds")
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+def execution(mode: str="inline", timeout: float=None, max_concurrency: int=None, max_result: int=1_000_000):
+    """
+    Sets how Agent runs a tool, see ToolRunner.
+
+    @execution("process", timeout=30, max_concurrency=2)
+    def render(scene: str): ...
+
+    Timeouts, crashes and oversized results reach the model as a JSON Observation
+    {"tool", "error", "message"}. For Agent instances set agent.tool_runner = ToolRunner(...).
+    """
+    def decorator(tool):
+        tool.tool_runner = ToolRunner(mode, timeout, max_concurrency, max_result)
+        return tool
+    return decorator
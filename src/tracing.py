@@ -0,0 +1,363 @@
+"""
+Structured events for LLM requests, tool confirmations, tool runs and nested agents.
+
+Every span becomes one event (a dict) when it ends:
+{"id", "parent", "trace", "kind", "name", "start", "duration", ...attributes}
+kind is "agent", "llm", "confirmation", "tool", "observation" or "route" (fastpath.FastPath).
+Attributes include iteration, prompt_tokens, completion_tokens, request_bytes, response_bytes,
+cached, error.
+Events go to the sinks of a Tracer: RingBuffer, JSONLSink, PrometheusExporter
+or any object with an emit(event) method.
+
+profile(events) sums them up per node of the agent tree (calls, latency, tokens, cache hits,
+errors) for visualize_agent(agent, profile=...), render_profile(), JSON or folded stacks:
+python tracing.py trace.jsonl --format folded > run.folded
+"""
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import os
+import threading
+import time
+
+# Span that is running right now; nested agents use it as their parent
+current_span = ContextVar("rovoam_current_span", default=None)
+
+def new_id():
+    return os.urandom(8).hex()
+
+class Span():
+    __slots__ = ("tracer", "id", "parent", "trace", "kind", "name", "start", "clock", "attrs")
+
+    def __init__(self, tracer, kind: str, name: str, parent=None, **attrs):
+        self.tracer = tracer
+        self.id = new_id()
+        self.parent = parent.id if parent is not None else None
+        self.trace = parent.trace if parent is not None else self.id
+        self.kind = kind
+        self.name = name
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        self.attrs = attrs
+
+    def end(self, **attrs):
+        # Returns the event and sends it to the sinks
+        event = {
+            "id": self.id,
+            "parent": self.parent,
+            "trace": self.trace,
+            "kind": self.kind,
+            "name": self.name,
+            "start": self.start,
+            "duration": time.perf_counter() - self.clock,
+        }
+        event.update(self.attrs)
+        event.update(attrs)
+        self.tracer.emit(event)
+        return event
+
+class Tracer():
+    def __init__(self, sinks: list=None):
+        self.sinks = sinks or []
+
+    def start(self, kind: str, name: str, parent: Span=None, **attrs):
+        # Without an explicit parent the span hangs under the active one (e.g. the tool call of a parent agent)
+        if parent is None:
+            parent = current_span.get()
+        return Span(self, kind, name, parent, **attrs)
+
+    def event(self, kind: str, name: str, parent: Span=None, **attrs):
+        # Zero-length span
+        return self.start(kind, name, parent, **attrs).end(duration=0.0)
+
+    def emit(self, event: dict):
+        for sink in self.sinks:
+            sink.emit(event)
+
+    @contextmanager
+    def activate(self, span: Span):
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+
+def render_trace(events: list):
+    # Text trace in the format of Agent.last_trace
+    parts = []
+    for event in events:
+        if event["kind"] == "llm":
+            parts.append("Assistant:\n" + event.get("content", ""))
+        elif event["kind"] == "tool" and event.get("cached"):
+            parts.append(f"Cache hit: {event['name']}")
+        elif event["kind"] == "observation":
+            parts.append(f"{event['name']}:\n{event.get('content', '')}")
+    return "\n\n".join(parts)
+
+class RingBuffer():
+    """Keeps the last size events in memory."""
+    def __init__(self, size: int=10000):
+        self.buffer = deque(maxlen=size)
+
+    def emit(self, event: dict):
+        self.buffer.append(event)
+
+    def events(self):
+        return list(self.buffer)
+
+    def clear(self):
+        self.buffer.clear()
+
+class JSONLSink():
+    """Appends every event as a JSON line to file."""
+    def __init__(self, file: str):
+        self.file = open(os.path.expanduser(file), "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def emit(self, event: dict):
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class PrometheusExporter():
+    """
+    Aggregates events into Prometheus counters. render() returns the text exposition format,
+    serve(port) exposes it on http://host:port/metrics.
+    """
+    def __init__(self, prefix: str="rovoam"):
+        self.prefix = prefix
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+        self.httpd = None
+
+    def add(self, metric: str, labels: dict, value: float):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] += value
+
+    def emit(self, event: dict):
+        if event["kind"] == "observation":
+            return
+        labels = {"kind": event["kind"], "name": event["name"]}
+        self.add("spans_total", labels, 1)
+        self.add("span_seconds_sum", labels, event["duration"])
+        if event.get("error"):
+            self.add("errors_total", labels, 1)
+        if event.get("cached"):
+            self.add("cache_hits_total", labels, 1)
+        for kind in ("prompt", "completion"):
+            if event.get(f"{kind}_tokens"):
+                self.add("tokens_total", {"model": event["name"], "type": kind}, event[f"{kind}_tokens"])
+        for direction in ("request", "response"):
+            if event.get(f"{direction}_bytes"):
+                self.add("payload_bytes_total", {"kind": event["kind"], "direction": direction}, event[f"{direction}_bytes"])
+
+    def render(self):
+        lines = []
+        with self.lock:
+            items = sorted(self.values.items())
+        seen = set()
+        for (metric, labels), value in items:
+            name = f"{self.prefix}_{metric}"
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} counter")
+            label_text = ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in labels)
+            lines.append(f"{name}{{{label_text}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int=9464, host: str="127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                body = exporter.render().encode()
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self.httpd
+
+def read_events(file: str):
+    # Events written by JSONLSink, a torn last line is skipped
+    events = []
+    with open(os.path.expanduser(file), encoding="utf-8") as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return events
+
+def self_times(events: list):
+    # Duration of every span minus its child spans; children running in parallel may cover more
+    children = defaultdict(float)
+    for event in events:
+        if event["parent"] is not None:
+            children[event["parent"]] += event["duration"]
+    return {event["id"]: max(0.0, event["duration"] - children[event["id"]]) for event in events}
+
+def node_paths(events: list):
+    """
+    Node of the agent tree every event belongs to: a tuple of agent and tool names.
+    A nested agent is the same node as the tool call that started it, LLM requests
+    and confirmations belong to their agent.
+    """
+    by_id = {event["id"]: event for event in events}
+    paths = {}
+
+    def node(event):
+        if event["id"] in paths:
+            return paths[event["id"]]
+        parent = by_id.get(event["parent"])
+        base = node(parent) if parent is not None else ()
+        if event["kind"] == "tool" or (event["kind"] == "agent" and (parent is None or parent["kind"] != "tool")):
+            base = base + (event["name"],)
+        paths[event["id"]] = base
+        return base
+
+    for event in events:
+        node(event)
+    return paths
+
+def profile(events: list, hot: float=0.2):
+    """
+    Run statistics per node of the agent tree from trace events of one or more runs
+    (RingBuffer.events() or read_events(file)).
+    Returns {path: {"calls", "mean", "p95", "total", "self", "share", "tokens",
+    "cache_hits", "cache_rate", "errors", "error_rate", "hot"}}.
+    Times are in seconds. tokens include the nodes below, self is the time spent in the node
+    itself (its LLM requests included), share is self of all the time; nodes with share >= hot are hot.
+    """
+    paths = node_paths(events)
+    selfs = self_times(events)
+    stats = {}
+
+    def node(path):
+        if path not in stats:
+            stats[path] = {"calls": 0, "durations": [], "self": 0.0, "tokens": 0, "cache_hits": 0, "errors": 0}
+        return stats[path]
+
+    for event in events:
+        path = paths[event["id"]]
+        if not path or event["kind"] == "observation":
+            continue
+        entry = node(path)
+        entry["self"] += selfs[event["id"]]
+        if event.get("error"):
+            entry["errors"] += 1
+        if event["kind"] == "llm":
+            tokens = (event.get("prompt_tokens") or 0) + (event.get("completion_tokens") or 0)
+            for i in range(1, len(path) + 1):
+                node(path[:i])["tokens"] += tokens
+        elif event["kind"] == "tool" or paths.get(event["parent"]) != path:
+            # The agent span of a nested agent is not a call of its own
+            entry["calls"] += 1
+            if event.get("cached"):
+                entry["cache_hits"] += 1
+            else:
+                entry["durations"].append(event["duration"])
+
+    spent = sum(entry["self"] for entry in stats.values()) or 1.0
+    result = {}
+    for path, entry in stats.items():
+        durations = sorted(entry.pop("durations"))
+        calls = entry["calls"]
+        result[path] = {
+            "calls": calls,
+            "mean": sum(durations) / len(durations) if durations else None,
+            "p95": durations[min(len(durations) - 1, int(0.95 * len(durations)))] if durations else None,
+            "total": sum(durations),
+            "self": entry["self"],
+            "share": entry["self"] / spent,
+            "tokens": entry["tokens"],
+            "cache_hits": entry["cache_hits"],
+            "cache_rate": entry["cache_hits"] / calls if calls else 0.0,
+            "errors": entry["errors"],
+            "error_rate": entry["errors"] / calls if calls else 0.0,
+            "hot": entry["self"] / spent >= hot,
+        }
+    return result
+
+def profile_json(stats: dict):
+    return json.dumps([{"path": list(path), **entry} for path, entry in sorted(stats.items())], ensure_ascii=False, indent=2)
+
+def folded_stacks(events: list):
+    """
+    Self time in milliseconds per stack in the folded format of flamegraph.pl and speedscope:
+    "Supervisor;researcher;llm gpt-4o 1520". LLM requests and confirmations are leaf frames.
+    """
+    paths = node_paths(events)
+    selfs = self_times(events)
+    totals = defaultdict(float)
+    for event in events:
+        stack = list(paths[event["id"]])
+        if not stack or event["kind"] == "observation":
+            continue
+        if event["kind"] in ("llm", "confirmation"):
+            stack.append(f"{event['kind']} {event['name']}")
+        totals[";".join(frame.replace(";", ":") for frame in stack)] += selfs[event["id"]] * 1000
+    return "".join(f"{stack} {round(ms)}\n" for stack, ms in sorted(totals.items()) if round(ms) > 0)
+
+def profile_label(entry: dict):
+    # Rich markup with the numbers of one node, hot nodes in red
+    if entry is None:
+        return "[dim]not called[/dim]"
+    parts = [f"{entry['calls']} calls"]
+    if entry["mean"] is not None:
+        parts.append(f"mean {entry['mean']:.2f}s, p95 {entry['p95']:.2f}s")
+    parts.append(f"{entry['tokens']} tokens")
+    if entry["cache_hits"]:
+        parts.append(f"cache {entry['cache_rate']:.0%}")
+    if entry["errors"]:
+        parts.append(f"errors {entry['error_rate']:.0%}")
+    parts.append(f"self {entry['share']:.0%}")
+    text = ", ".join(parts)
+    return f"[bold red]{text}[/bold red]" if entry["hot"] else f"[dim]{text}[/dim]"
+
+def render_profile(stats: dict, console=None):
+    """Prints the nodes of profile() as a tree, without the agents themselves."""
+    from rich.console import Console
+    from rich.tree import Tree
+    console = console or Console()
+    trees = {}
+    roots = []
+    for path in sorted(stats):
+        tree = Tree(f"[yellow]{path[-1]}[/yellow] {profile_label(stats[path])}")
+        trees[path] = tree
+        parent = trees.get(path[:-1])
+        if parent is not None:
+            parent.add(tree)
+        else:
+            roots.append(tree)
+    for tree in roots:
+        console.print(tree)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Profile of agent runs from a JSONL trace")
+    parser.add_argument("file", help="events written by JSONLSink")
+    parser.add_argument("--format", choices=["tree", "json", "folded"], default="tree")
+    parser.add_argument("--hot", type=float, default=0.2, help="share of the time that makes a node hot")
+    args = parser.parse_args()
+
+    events = read_events(args.file)
+    if args.format == "folded":
+        print(folded_stacks(events), end="")
+    elif args.format == "json":
+        print(profile_json(profile(events, args.hot)))
+    else:
+        render_profile(profile(events, args.hot))
@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# The modules live flat in src/, as main.py imports them
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "src"))
@@ -0,0 +1,18 @@
+import base64
+from attachments import AttachmentStore
+
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg" width="4000" height="10"><rect width="4000" height="10"/></svg>'
+TRUNCATED_PNG = b"\x89PNG\r\n\x1a\n" + b"\x00\x00\x00\rIHDR" + b"\x00\x00\x10\x00"
+
+def test_unreadable_images_are_stored_as_they_are(tmp_path):
+    store = AttachmentStore(str(tmp_path), max_side=2048)
+    for data, mime in ((SVG, "image/svg+xml"), (TRUNCATED_PNG, "image/png")):
+        ref = store.add_bytes(data, mime)
+        assert store.mime(ref) == mime
+        assert base64.b64decode(store.base64(ref)) == data
+
+def test_unreadable_image_file(tmp_path):
+    file = tmp_path / "drawing.svg"
+    file.write_bytes(SVG)
+    store = AttachmentStore(str(tmp_path / "store"), max_side=2048)
+    assert base64.b64decode(store.base64(store.add_file(str(file)))) == SVG
@@ -0,0 +1,28 @@
+import asyncio
+import time
+from mockserver import MockServer
+from client import get_client
+from rovoam import Agent, AsyncAgent, OUT_OF_BUDGET
+from budget import Budget
+
+ANSWER = OUT_OF_BUDGET[len("Answer:"):].strip()
+
+def test_deadline_on_slow_endpoint():
+    # The shared client retries timeouts, but not past the deadline
+    with MockServer(latency=2.0) as server:
+        server.script("slow", ["Answer: too late"])
+        client = get_client(server.url, "test")
+        start = time.monotonic()
+        answer = Agent(client=client, model="slow", budget=Budget(seconds=1.5))("hi")
+        assert answer == ANSWER
+        assert time.monotonic() - start < 2.5
+        events = list(Agent(client=client, model="slow", budget=Budget(seconds=1.5)).stream("hi"))
+        assert events[-1]["content"] == ANSWER
+
+def test_deadline_on_slow_endpoint_async():
+    with MockServer(latency=2.0) as server:
+        server.script("slow", ["Answer: too late"])
+        agent = AsyncAgent(client=get_client(server.url, "test", asynchronous=True), model="slow", budget=Budget(seconds=1.5))
+        start = time.monotonic()
+        assert asyncio.run(agent("hi")) == ANSWER
+        assert time.monotonic() - start < 2.5
@@ -0,0 +1,31 @@
+from openai import OpenAI
+from mockserver import MockServer
+from cache import ResponseCache
+from rovoam import Agent, Chat, Classifier
+
+def test_only_deterministic_requests_are_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    with MockServer() as server:
+        server.script("m", ["Answer: one", "Answer: two"])
+        client = OpenAI(api_key="test", base_url=server.url, max_retries=0)
+        # Without temperature the endpoint samples: every call goes out
+        assert Chat(client, "m", cache=cache)("hi") == "Answer: one"
+        assert Chat(client, "m", cache=cache)("hi") == "Answer: two"
+        assert cache.stats()["bypassed"] == 2
+        assert Agent(client, "m", cache=cache, temperature=0)("hi") == "one"
+        assert Agent(client, "m", cache=cache, temperature=0)("hi") == "one"
+        assert server.stats()["requests"] == 3
+        assert cache.stats()["hits"] == 1
+
+def test_cache_false_bypasses(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    with MockServer() as server:
+        server.script("m", ["a", "b"])
+        client = OpenAI(api_key="test", base_url=server.url, max_retries=0)
+        classifier = Classifier(client, "m", ["a", "b"], cache=cache, temperature=0)
+        assert classifier("text") == "a"
+        assert classifier("text") == "a"
+        classifier.cache = False
+        assert classifier("text") == "b"
+        assert Classifier(client, "m", ["a", "b"], cache=False, temperature=0)("text") == "a"
+        assert server.stats()["requests"] == 3
@@ -0,0 +1,19 @@
+import json
+from mockserver import MockServer
+from client import get_client
+from rovoam import Agent
+from fastpath import FastPath
+
+def test_decisions_go_to_log(tmp_path):
+    # The agent's tracer has no sinks, the log still gets every decision
+    with MockServer() as server:
+        server.script("m", ["chat", "Hello!", "agent", "Answer: 4"])
+        log = tmp_path / "routes.jsonl"
+        door = FastPath(Agent(client=get_client(server.url, "test"), model="m"), log=str(log))
+        assert door("hi") == "Hello!"
+        assert door("what is 2+2 today?") == "4"
+        events = [json.loads(line) for line in log.read_text().splitlines()]
+        assert [(e["kind"], e["route"], e["reason"]) for e in events] == [
+            ("route", "chat", "classifier"),
+            ("route", "agent", "classifier"),
+        ]
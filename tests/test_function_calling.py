@@ -0,0 +1,39 @@
+import openai
+import pytest
+from openai import OpenAI
+from mockserver import MockServer
+from rovoam import Agent
+
+def allow(toolname, description):
+    return True
+
+def lookup(key: str):
+    """
+    lookup.
+    Returns the value stored under key
+    key: name of the value
+    """
+    return f"value of {key}"
+
+def test_fallback_to_text_protocol_after_a_tool_turn():
+    with MockServer() as server:
+        server.script("m", [
+            {"tool_calls": [{"name": "lookup", "arguments": {"key": "a"}}]},
+            {"error": 400, "message": "This model does not support tools"},
+            "Answer: value of a",
+        ])
+        agent = Agent(OpenAI(api_key="test", base_url=server.url, max_retries=0), "m", tools=[lookup], confirmation_handler=allow, function_calling=True)
+        assert agent("get a") == "value of a"
+        assert not agent.function_calling
+        last = server.log[-1]
+        assert "tools" not in last
+        assert all(m["role"] != "tool" and "tool_calls" not in m for m in last["messages"])
+        assert any(m["content"] == "Observation: value of a" for m in last["messages"])
+
+def test_other_bad_requests_are_raised():
+    with MockServer() as server:
+        server.script("m", [{"error": 400, "message": "This model's maximum context length is 8192 tokens"}])
+        agent = Agent(OpenAI(api_key="test", base_url=server.url, max_retries=0), "m", tools=[lookup], confirmation_handler=allow, function_calling=True)
+        with pytest.raises(openai.BadRequestError):
+            agent("get a")
+        assert agent.function_calling
@@ -0,0 +1,20 @@
+from openai import OpenAI
+from mockserver import MockServer
+from server import AgentServer
+from rovoam import Agent, Chat
+
+def test_usage_is_counted_or_left_out():
+    with MockServer() as server:
+        server.script("m", ["Answer: hello"])
+        client = OpenAI(api_key="test", base_url=server.url, max_retries=0)
+        targets = {"agent": lambda: Agent(client, "m"), "chat": lambda: Chat(client, "m")}
+        with AgentServer(targets, port=0) as agents:
+            api = OpenAI(api_key="test", base_url=agents.url, max_retries=0)
+            response = api.chat.completions.create(model="agent", messages=[{"role": "user", "content": "hi"}])
+            assert response.choices[0].message.content == "hello"
+            # The ReAct prompt and the question, not just the question
+            assert response.usage.prompt_tokens == server.stats()["prompt_tokens"]
+            chunks = list(api.chat.completions.create(model="agent", messages=[{"role": "user", "content": "hi"}], stream=True, stream_options={"include_usage": True}))
+            assert chunks[-1].usage.prompt_tokens > 100
+            response = api.chat.completions.create(model="chat", messages=[{"role": "user", "content": "hi"}])
+            assert response.usage is None
@@ -0,0 +1,29 @@
+from openai import OpenAI
+from mockserver import MockServer
+from rovoam import Agent
+from toolindex import ToolIndex
+
+def make_tool(name: str, doc: str):
+    def tool(key: str):
+        return f"{name} of {key}"
+    tool.__name__ = name
+    tool.__doc__ = f"{name}.\n{doc}\nkey: what to look up"
+    return tool
+
+TOOLS = [make_tool(name, doc) for name, doc in (
+    ("weather", "Current weather and forecast for a city"),
+    ("currency", "Converts an amount between currencies"),
+    ("calendar", "Events of the user's calendar for a date"),
+    ("news", "Latest news headlines on a topic"),
+    ("translate", "Translates text to another language"),
+)]
+
+def test_last_saved_covers_the_whole_turn():
+    with MockServer() as server:
+        server.script("m", ['Action: {"tool": "weather", "key": "Paris"}\nPAUSE', "Answer: sunny"])
+        index = ToolIndex(top_k=1)
+        agent = Agent(OpenAI(api_key="test", base_url=server.url, max_retries=0), "m", tools=TOOLS, tool_index=index, confirmation_handler=lambda *args: True)
+        assert agent("What is the weather in Paris?") == "sunny"
+        assert server.stats()["requests"] == 2
+        assert index.last_saved > 0
+        assert index.last_saved == index.total_saved